@@ -1,13 +1,19 @@
 import httpx
 
 class OllamaClient:
-    def __init__(self, model: str, temperature: float = 0.3, max_tokens: int = 160, base_url: str = "http://127.0.0.1:11434", repeat_penalty: float = 1.2, stop: list = None):
+    def __init__(self, model: str, temperature: float = 0.3, max_tokens: int = 160, base_url: str = "http://127.0.0.1:11434", repeat_penalty: float = 1.2, stop: list = None,
+                 connect_timeout: float = 3.0, read_timeout: float = 60.0):
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.base_url = base_url.rstrip("/")
         self.repeat_penalty = repeat_penalty
         self.stop = stop if stop is not None else ["OBS_TOOL", "USER:", "ASSISTANT:", "TOOL:"]
+        # one keep-alive pool for every agent step instead of a new connection per call
+        self._client = httpx.Client(base_url=self.base_url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+    def close(self) -> None:
+        self._client.close()
 
     def generate(self, prompt: str, json_mode: bool = True) -> str:
         payload = {
@@ -24,7 +30,6 @@ class OllamaClient:
         }
         if json_mode:
             payload["format"] = "json"
-        with httpx.Client(timeout=60) as client:
-            r = client.post(f"{self.base_url}/api/generate", json=payload)
-            r.raise_for_status()
-            return r.json().get("response", "")
\ No newline at end of file
+        r = self._client.post("/api/generate", json=payload)
+        r.raise_for_status()
+        return r.json().get("response", "")
\ No newline at end of file
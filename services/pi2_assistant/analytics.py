@@ -0,0 +1,260 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:  # analytics endpoints answer 503 without them
+    np = pd = None
+
+from history_index import parse_timestamp
+
+# Cross-period expense analytics.
+#
+# Every stored period of a user is flattened into one pandas frame of expense
+# rows (id, timestamp, integer cents, category, merchant, period) sorted by
+# timestamp, so a date range is two searchsorted calls and group-by / rolling
+# queries are vectorized. Frames are built per period and cached under the
+# backend signature of that period: after a save only the changed month is
+# re-read, and the per-user frame is re-assembled from the cached blocks.
+
+GROUP_KEYS = ("category", "merchant", "month")
+
+
+class AnalyticsUnavailable(RuntimeError):
+    """pandas / NumPy are not installed."""
+
+
+class ExpenseFrame:
+    """Read-only, timestamp-sorted expenses of one user across all periods."""
+
+    def __init__(self, frame: "pd.DataFrame"):
+        self.frame = frame
+        self._ts = frame["ts"].to_numpy(dtype="datetime64[ns]")
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def window(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        category: Optional[str] = None,
+    ) -> "pd.DataFrame":
+        """Rows with start <= ts < end, optionally for one category (aware bounds are converted like the rows)."""
+        lo = 0 if start is None else int(np.searchsorted(self._ts, np.datetime64(_local_naive(start), "ns"), side="left"))
+        hi = len(self._ts) if end is None else int(np.searchsorted(self._ts, np.datetime64(_local_naive(end), "ns"), side="left"))
+        frame = self.frame.iloc[lo:max(lo, hi)]
+        if category is not None:
+            frame = frame[frame["category"] == category]
+        return frame
+
+
+def _amount(cents: Any) -> float:
+    return round(float(cents) / 100.0, 2)
+
+
+def _month_labels(frame: "pd.DataFrame") -> "pd.Series":
+    return frame["ts"].dt.to_period("M").astype(str)
+
+
+def range_totals(frame: "pd.DataFrame") -> Dict[str, Any]:
+    count = int(len(frame))
+    cents = int(frame["cents"].sum()) if count else 0
+    return {
+        "total": _amount(cents),
+        "count": count,
+        "avg_tx": _amount(cents / count) if count else 0.0,
+    }
+
+
+def group_totals(frame: "pd.DataFrame", by: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Totals per category, merchant or month ("YYYY-MM"); months oldest first, otherwise largest first."""
+    if by not in GROUP_KEYS:
+        raise ValueError(f"Unsupported group key: {by}")
+    if frame.empty:
+        return []
+    keys = _month_labels(frame) if by == "month" else frame[by]
+    grouped = frame["cents"].groupby(keys, observed=True).agg(["sum", "count"])
+    if by == "month":
+        grouped = grouped.sort_index()
+    else:
+        grouped = grouped.sort_values("sum", ascending=False, kind="stable")
+    if limit is not None:
+        grouped = grouped.head(limit)
+    return [
+        {"key": str(key), "total": _amount(row["sum"]), "count": int(row["count"]), "avg_tx": _amount(row["sum"] / row["count"])}
+        for key, row in grouped.iterrows()
+    ]
+
+
+def monthly_by_category(frame: "pd.DataFrame", start: datetime, end: datetime) -> Dict[str, Any]:
+    """Month x category spend over [start, end), with empty months filled in."""
+    start, end = _local_naive(start), _local_naive(end)
+    months = pd.period_range(start=start, end=end - timedelta(microseconds=1), freq="M")
+    labels = [str(m) for m in months]
+    if frame.empty:
+        return {"months": labels, "categories": {}, "totals": [0.0] * len(labels)}
+    table = frame.pivot_table(
+        index=_month_labels(frame), columns="category", values="cents", aggfunc="sum", fill_value=0, observed=True
+    ).reindex(labels, fill_value=0)
+    order = table.sum().sort_values(ascending=False, kind="stable").index
+    return {
+        "months": labels,
+        "categories": {str(cat): [_amount(v) for v in table[cat].to_numpy()] for cat in order},
+        "totals": [_amount(v) for v in table.sum(axis=1).to_numpy()],
+    }
+
+
+def rolling_daily(expenses: ExpenseFrame, start: datetime, end: datetime, window: int, category: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Daily spend over [start, end) with a trailing ``window``-day average (earlier days feed the first points)."""
+    start, end = _local_naive(start), _local_naive(end)
+    first_day = pd.Timestamp(start).normalize()
+    days = pd.date_range(first_day, pd.Timestamp(end - timedelta(microseconds=1)).normalize(), freq="D")
+    history_start = first_day - pd.Timedelta(days=window - 1)
+    frame = expenses.window(history_start.to_pydatetime(), end, category)
+    daily = frame["cents"].groupby(frame["ts"].dt.normalize()).sum()
+    daily = daily.reindex(pd.date_range(history_start, days[-1] if len(days) else first_day, freq="D"), fill_value=0)
+    averages = daily.rolling(window, min_periods=1).mean()
+    return [
+        {"date": day.date().isoformat(), "total": _amount(daily[day]), "rolling_avg": _amount(averages[day])}
+        for day in days
+    ]
+
+
+def monthly_average(frame: "pd.DataFrame") -> float:
+    """Spend divided by the number of distinct months that had any (0.0 when empty)."""
+    if frame.empty:
+        return 0.0
+    return float(frame["cents"].sum()) / 100.0 / max(int(_month_labels(frame).nunique()), 1)
+
+
+def _local_naive(ts: datetime) -> datetime:
+    # same instant HistoryIndex sorts by; offsets become local wall time, the
+    # convention of the frame's "ts" column (rows and query bounds alike)
+    return datetime.fromtimestamp(ts.timestamp()) if ts.tzinfo is not None else ts
+
+
+def expense_block(rows: List[Dict[str, Any]], period: str, merchant_label: Callable[[Dict[str, Any]], str]) -> "pd.DataFrame":
+    """One period's dated expense rows as a frame (undated rows cannot be placed in time)."""
+    ids: List[str] = []
+    stamps: List[datetime] = []
+    cents: List[int] = []
+    categories: List[str] = []
+    merchants: List[str] = []
+    for row in rows:
+        if row.get("type", "expense") != "expense":
+            continue
+        ts = parse_timestamp(row.get("timestamp"))
+        if ts is None:
+            continue
+        try:
+            ts = _local_naive(ts)
+        except (OverflowError, OSError, ValueError):
+            continue
+        ids.append(str(row.get("id") or ""))
+        stamps.append(ts)
+        cents.append(int(round(float(row.get("amount", 0.0) or 0.0) * 100)))
+        categories.append(row.get("category") or "other")
+        merchants.append(merchant_label(row))
+    return pd.DataFrame({
+        "id": pd.Series(ids, dtype=object),
+        "ts": pd.Series(pd.to_datetime(stamps), dtype="datetime64[ns]"),
+        "cents": np.asarray(cents, dtype=np.int64),
+        "category": pd.Series(categories, dtype=object),
+        "merchant": pd.Series(merchants, dtype=object),
+        "period": period,
+    })
+
+
+class AnalyticsEngine:
+    """Builds and caches ExpenseFrames per user.
+
+    ``list_periods(user)``, ``load_rows(user, period)`` and
+    ``signature(user, period)`` come from the state backend; a period block is
+    reused while its signature is unchanged. Whole-user frames are kept for
+    the ``max_users`` most recently queried users.
+    """
+
+    def __init__(
+        self,
+        list_periods: Callable[[str], List[str]],
+        load_rows: Callable[[str, str], List[Dict[str, Any]]],
+        signature: Callable[[str, str], Optional[Hashable]],
+        merchant_label: Callable[[Dict[str, Any]], str],
+        max_users: int = 16,
+    ):
+        self._list_periods = list_periods
+        self._load_rows = load_rows
+        self._signature = signature
+        self._merchant_label = merchant_label
+        self.max_users = max(1, max_users)
+        self._lock = threading.Lock()
+        self._frames: "OrderedDict[str, Tuple[Tuple, ExpenseFrame]]" = OrderedDict()
+        self._blocks: Dict[Tuple[str, str], Tuple[Optional[Hashable], "pd.DataFrame"]] = {}
+
+    @property
+    def available(self) -> bool:
+        return pd is not None
+
+    def frame(self, user_id: str) -> ExpenseFrame:
+        if pd is None:
+            raise AnalyticsUnavailable("Analytics needs pandas and numpy")
+        signatures = tuple((period, self._signature(user_id, period)) for period in self._list_periods(user_id))
+        with self._lock:
+            cached = self._frames.get(user_id)
+            if cached is not None and cached[0] == signatures:
+                self._frames.move_to_end(user_id)
+                return cached[1]
+
+        blocks = [self._period_block(user_id, period, sig) for period, sig in signatures if sig is not None]
+        expenses = ExpenseFrame(_assemble(blocks))
+        with self._lock:
+            self._frames[user_id] = (signatures, expenses)
+            self._frames.move_to_end(user_id)
+            live = {period for period, _ in signatures}
+            for key in [k for k in self._blocks if k[0] == user_id and k[1] not in live]:
+                del self._blocks[key]
+            while len(self._frames) > self.max_users:
+                evicted, _ = self._frames.popitem(last=False)
+                for key in [k for k in self._blocks if k[0] == evicted]:
+                    del self._blocks[key]
+        return expenses
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._frames.clear()
+                self._blocks.clear()
+                return
+            self._frames.pop(user_id, None)
+            for key in [k for k in self._blocks if k[0] == user_id]:
+                del self._blocks[key]
+
+    def _period_block(self, user_id: str, period: str, signature: Hashable) -> "pd.DataFrame":
+        key = (user_id, period)
+        with self._lock:
+            cached = self._blocks.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        # a save racing this read only leaves a newer block under the older
+        # signature, which is rebuilt on the next lookup
+        block = expense_block(self._load_rows(user_id, period), period, self._merchant_label)
+        with self._lock:
+            self._blocks[key] = (signature, block)
+        return block
+
+
+def _assemble(blocks: List["pd.DataFrame"]) -> "pd.DataFrame":
+    if blocks:
+        frame = pd.concat(blocks, ignore_index=True)
+    else:
+        frame = expense_block([], "", lambda row: "")
+    # a row copied into a later period file counts once
+    frame = frame[~(frame["id"].duplicated(keep="last") & (frame["id"] != ""))]
+    frame = frame.sort_values(["ts", "id"], kind="stable").reset_index(drop=True)
+    for column in ("category", "merchant", "period"):
+        frame[column] = frame[column].astype("category")
+    return frame
@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Set
+
+from state_response import dumps
+
+# Per-user change feed for Server-Sent Events.
+#
+# Saves publish one event per user; every open /api/stream connection owns a
+# Subscription with a bounded buffer. Events are encoded once, at publish
+# time, and handed to each subscriber's event loop (publishers may run on
+# worker threads). A subscriber that falls more than ``max_events`` behind
+# has its buffer replaced by a single "resync" event: the client refetches
+# state instead of the server holding an unbounded backlog.
+
+
+def format_event(event: str, data: Any, event_id: Optional[int] = None) -> bytes:
+    head = b"" if event_id is None else b"id: %d\n" % event_id
+    return head + b"event: " + event.encode("utf-8") + b"\ndata: " + dumps(data) + b"\n\n"
+
+
+HEARTBEAT = b": ping\n\n"
+RESYNC = format_event("resync", {"reason": "buffer overflow"})
+
+
+class Subscription:
+    def __init__(self, user_id: str, max_events: int):
+        self.user_id = user_id
+        self.max_events = max_events
+        self.dropped = 0
+        self._loop = asyncio.get_running_loop()
+        self._events: Deque[bytes] = deque()
+        self._ready = asyncio.Event()
+
+    def deliver(self, payload: bytes) -> None:
+        """Queue an encoded event; safe to call from any thread."""
+        try:
+            self._loop.call_soon_threadsafe(self._push, payload)
+        except RuntimeError:  # loop already closed: the connection is gone
+            pass
+
+    def _push(self, payload: bytes) -> None:
+        if len(self._events) >= self.max_events:
+            self.dropped += len(self._events)
+            self._events.clear()
+            payload = RESYNC
+        self._events.append(payload)
+        self._ready.set()
+
+    async def next(self, timeout: float) -> Optional[bytes]:
+        """Next encoded event, or None after ``timeout`` seconds without one."""
+        if not self._events:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._events.popleft()
+
+
+class ChangeFeed:
+    def __init__(self, max_events: int = 256):
+        self.max_events = max(1, max_events)
+        self._guard = threading.Lock()
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._ids = itertools.count(1)
+
+    def subscribe(self, user_id: str) -> Subscription:
+        """Register a subscriber; call from the connection's event loop."""
+        subscription = Subscription(user_id, self.max_events)
+        with self._guard:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._guard:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def has_subscribers(self, user_id: str) -> bool:
+        with self._guard:
+            return bool(self._subscribers.get(user_id))
+
+    def publish(self, user_id: str, event: str, data: Any) -> int:
+        """Encode and fan out one event; returns the number of subscribers reached."""
+        with self._guard:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        if not subscribers:
+            return 0
+        payload = format_event(event, data, next(self._ids))
+        for subscription in subscribers:
+            subscription.deliver(payload)
+        return len(subscribers)
+
+    def __len__(self) -> int:
+        with self._guard:
+            return sum(len(subs) for subs in self._subscribers.values())
@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+# Bounded TTL/LRU cache of model chat replies.
+#
+# Keys are (user_id, state version, normalized message, language); the state
+# version covers the period, its persisted revision and the day, so any save
+# already makes older entries unreachable. Saves and note/RAG changes also
+# drop the user's entries outright so they do not linger until evicted.
+# Only replies produced by the model are stored, never fallbacks.
+
+ChatKey = Tuple[str, Hashable, str, str]
+
+
+def normalize_message(message: str) -> str:
+    """Case-, accent-, punctuation- and whitespace-insensitive form of a chat message."""
+    text = unicodedata.normalize("NFKD", message or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    text = re.sub(r"[^\w\s]", "", text)
+    return " ".join(text.split())
+
+
+class ChatCache:
+    def __init__(self, max_entries: int = 256, ttl: float = 600.0):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[ChatKey, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: ChatKey) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            reply, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key: ChatKey, reply: str) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (reply, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            stale = [k for k in self._entries if k[0] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = self.misses = self.expired = self.evictions = self.invalidations = 0
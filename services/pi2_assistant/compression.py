@@ -0,0 +1,160 @@
+import re
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+from metrics import ResponseMetrics
+
+# ASGI middleware that gzip/brotli-compresses responses and feeds
+# ResponseMetrics.
+#
+# A single-body response is compressed once it reaches ``minimum_size``. A
+# streamed response (history batches, /export) is compressed chunk by chunk
+# and flushed after every chunk, so clients still receive rows as they are
+# produced. Server-Sent Events and responses that already carry a
+# Content-Encoding pass through untouched.
+
+_SERVER_TIMING_ENCODE = re.compile(r"encode;dur=([0-9.]+)")
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best supported coding from an Accept-Encoding header: br (when installed), then gzip."""
+    offered: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        offered[name.strip()] = quality
+    for coding in (("br",) if brotli is not None else ()) + ("gzip",):
+        if offered.get(coding, offered.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app: Callable,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        metrics: Optional[ResponseMetrics] = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.metrics = metrics
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        await self.app(scope, receive, _Responder(self, scope, send, encoding).send)
+
+
+class _Responder:
+    def __init__(self, owner: CompressionMiddleware, scope: Dict[str, Any], send: Callable, encoding: Optional[str]):
+        self.owner = owner
+        self.scope = scope
+        self._send = send
+        self.encoding = encoding
+        self.start: Optional[Dict[str, Any]] = None
+        self.compressor: Optional[_Compressor] = None
+        self.media_type = ""
+        self.encode_ms: Optional[float] = None
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_ms = 0.0
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(raw=start["headers"])
+            self.media_type = headers.get("content-type", "")
+            timing = _SERVER_TIMING_ENCODE.search(headers.get("server-timing", ""))
+            self.encode_ms = float(timing.group(1)) if timing else None
+            if self._compressible(start["status"], headers, body, more_body):
+                self.compressor = _Compressor(self.encoding, self.owner.gzip_level, self.owner.brotli_quality)
+                out = self._compress(body, final=not more_body)
+                headers["Content-Encoding"] = self.encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(out))
+                    headers.append("Server-Timing", "compress;dur=%.2f" % self.compress_ms)
+                message = {"type": "http.response.body", "body": out, "more_body": more_body}
+            await self._send(start)
+        elif self.compressor is not None:
+            message = {"type": "http.response.body", "body": self._compress(body, final=not more_body), "more_body": more_body}
+
+        self.raw_bytes += len(body)
+        self.wire_bytes += len(message.get("body", b""))
+        await self._send(message)
+        if not more_body:
+            self._record()
+
+    def _compressible(self, status: int, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if self.encoding is None or status in (204, 304) or "content-encoding" in headers:
+            return False
+        if self.media_type.startswith("text/event-stream"):
+            return False
+        return more_body or len(body) >= self.owner.minimum_size
+
+    def _compress(self, data: bytes, final: bool) -> bytes:
+        started = time.perf_counter()
+        out = self.compressor.compress(data, final)
+        self.compress_ms += (time.perf_counter() - started) * 1000
+        return out
+
+    def _record(self) -> None:
+        if self.owner.metrics is None:
+            return
+        route = self.scope.get("route")
+        self.owner.metrics.record(
+            getattr(route, "path", None) or "unmatched",
+            self.media_type,
+            self.compressor.encoding if self.compressor else None,
+            self.raw_bytes,
+            self.wire_bytes,
+            self.encode_ms,
+            self.compress_ms,
+        )
@@ -0,0 +1,218 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pure-Python reductions over the same arrays
+    np = None
+
+from history_index import HistoryIndex
+
+# Columnar, read-only view of a state's expense rows for aggregation.
+#
+# Rows are laid out in timestamp order (undated rows last, at +inf) as typed
+# arrays: amount in integer cents, epoch seconds, month number and interned
+# category / merchant codes. Totals become bincount / slice sums (NumPy when
+# installed, plain loops over the arrays otherwise) and time windows are a
+# bisect over the sorted epochs. The dict rows in state["history"] stay the
+# source of truth; like HistoryIndex, the view is told about every row change
+# (add/discard) so a single edit never rebuilds it.
+
+UNDATED = float("inf")
+
+
+class StringTable:
+    """Interns strings to small integer codes."""
+
+    __slots__ = ("values", "codes")
+
+    def __init__(self) -> None:
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class ExpenseRecord:
+    """Lightweight row view returned by HistoryColumns.record()."""
+
+    __slots__ = ("row", "amount", "timestamp", "category", "merchant")
+
+    def __init__(self, row: Dict[str, Any], amount: float, timestamp: Optional[datetime], category: str, merchant: str):
+        self.row = row
+        self.amount = amount
+        self.timestamp = timestamp
+        self.category = category
+        self.merchant = merchant
+
+
+class HistoryColumns:
+    def __init__(self, index: HistoryIndex, merchant_label: Callable[[Dict[str, Any]], str]):
+        self.categories = StringTable()
+        self.merchants = StringTable()
+        self.cents = array("q")
+        self.epochs = array("d")
+        # int64 everywhere ("l" is 32-bit on Windows)
+        self.months = array("q")  # year * 12 + month - 1, -1 when undated
+        self.category_codes = array("q")
+        self.merchant_codes = array("q")
+        self.rows: List[Dict[str, Any]] = []
+        self._index = index
+        self._merchant_label = merchant_label
+        self._epochs_by_id: Dict[str, float] = {}
+
+        for row in index.window():
+            if row.get("type") == "expense":
+                self._insert(len(self.rows), row)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _insert(self, pos: int, row: Dict[str, Any]) -> None:
+        ts = self._index.timestamp_of(row)
+        epoch = ts.timestamp() if ts else UNDATED
+        self._epochs_by_id[HistoryIndex._row_id(row)] = epoch
+        self.rows.insert(pos, row)
+        self.cents.insert(pos, int(round(float(row.get("amount", 0.0) or 0.0) * 100)))
+        self.epochs.insert(pos, epoch)
+        self.months.insert(pos, ts.year * 12 + ts.month - 1 if ts else -1)
+        self.category_codes.insert(pos, self.categories.intern(row.get("category") or "other"))
+        self.merchant_codes.insert(pos, self.merchants.intern(self._merchant_label(row)))
+
+    def add(self, row: Dict[str, Any]) -> None:
+        """Place a new (or edited) row; call after HistoryIndex.add so its timestamp is parsed."""
+        self.discard(row)
+        if row.get("type") != "expense":
+            return
+        ts = self._index.timestamp_of(row)
+        if ts is None:
+            self._insert(len(self.rows), row)
+            return
+        # same (epoch, id) order as the index among rows sharing a timestamp
+        epoch, row_id = ts.timestamp(), HistoryIndex._row_id(row)
+        pos = bisect_left(self.epochs, epoch)
+        end = bisect_right(self.epochs, epoch, pos)
+        while pos < end and HistoryIndex._row_id(self.rows[pos]) < row_id:
+            pos += 1
+        self._insert(pos, row)
+
+    def discard(self, row: Dict[str, Any]) -> bool:
+        """Drop a row by id; False when it was not in the view."""
+        row_id = HistoryIndex._row_id(row)
+        epoch = self._epochs_by_id.pop(row_id, None)
+        if epoch is None:
+            return False
+        pos = bisect_left(self.epochs, epoch)
+        while pos < len(self.rows) and HistoryIndex._row_id(self.rows[pos]) != row_id:
+            pos += 1
+        for column in (self.rows, self.cents, self.epochs, self.months, self.category_codes, self.merchant_codes):
+            del column[pos]
+        return True
+
+    def span(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Tuple[int, int]:
+        """Position range of dated rows with start <= timestamp < end."""
+        lo = 0 if start is None else bisect_left(self.epochs, start.timestamp())
+        hi = bisect_left(self.epochs, UNDATED if end is None else end.timestamp(), lo)
+        return lo, hi
+
+    def record(self, pos: int) -> ExpenseRecord:
+        row = self.rows[pos]
+        return ExpenseRecord(
+            row,
+            self.cents[pos] / 100.0,
+            self._index.timestamp_of(row),
+            self.categories.values[self.category_codes[pos]],
+            self.merchants.values[self.merchant_codes[pos]],
+        )
+
+    def _positions(self, lo: int, hi: int, category: Optional[str]) -> Iterable[int]:
+        if category is None:
+            return range(lo, hi)
+        code = self.categories.codes.get(category)
+        if code is None:
+            return ()
+        codes = self.category_codes
+        return (pos for pos in range(lo, hi) if codes[pos] == code)
+
+    def _selected(self, lo: int, hi: int, category: Optional[str]):
+        """NumPy positions in [lo, hi), optionally for one category."""
+        if category is None:
+            return np.arange(lo, hi)
+        codes = _column(self.category_codes)[lo:hi]
+        return lo + np.flatnonzero(codes == self.categories.codes.get(category, -1))
+
+    def total_cents(self, lo: int = 0, hi: Optional[int] = None, category: Optional[str] = None) -> Tuple[int, int]:
+        """(sum of cents, row count) over positions [lo, hi), optionally for one category."""
+        hi = len(self.rows) if hi is None else hi
+        if np is not None:
+            cents = _column(self.cents)[self._selected(lo, hi, category)]
+            return int(cents.sum()), int(cents.size)
+        total = count = 0
+        for pos in self._positions(lo, hi, category):
+            total += self.cents[pos]
+            count += 1
+        return total, count
+
+    def category_totals(self) -> Dict[str, Tuple[int, int]]:
+        """category -> (cents, transactions) over every expense row."""
+        if np is not None:
+            codes = _column(self.category_codes)
+            cents = np.bincount(codes, weights=_column(self.cents), minlength=len(self.categories))
+            counts = np.bincount(codes, minlength=len(self.categories))
+            return {
+                name: (int(round(cents[code])), int(counts[code]))
+                for code, name in enumerate(self.categories.values)
+                if counts[code]
+            }
+        totals: Dict[str, List[int]] = {}
+        for code, cents_value in zip(self.category_codes, self.cents):
+            bucket = totals.setdefault(self.categories.values[code], [0, 0])
+            bucket[0] += cents_value
+            bucket[1] += 1
+        return {name: (bucket[0], bucket[1]) for name, bucket in totals.items()}
+
+    def merchant_counts(self) -> Counter:
+        """Merchant label -> number of expense rows."""
+        if np is not None:
+            counts = np.bincount(_column(self.merchant_codes), minlength=len(self.merchants))
+            return Counter({name: int(counts[code]) for code, name in enumerate(self.merchants.values) if counts[code]})
+        return Counter(self.merchants.values[code] for code in self.merchant_codes)
+
+    def merchant_cents(self, lo: int, hi: int, category: Optional[str] = None) -> Counter:
+        """Merchant label -> cents spent over positions [lo, hi)."""
+        if np is not None:
+            selected = self._selected(lo, hi, category)
+            codes = _column(self.merchant_codes)[selected]
+            sums = np.bincount(codes, weights=_column(self.cents)[selected], minlength=len(self.merchants))
+            counts = np.bincount(codes, minlength=len(self.merchants))
+            return Counter({name: int(round(sums[code])) for code, name in enumerate(self.merchants.values) if counts[code]})
+        totals: Counter = Counter()
+        for pos in self._positions(lo, hi, category):
+            totals[self.merchants.values[self.merchant_codes[pos]]] += self.cents[pos]
+        return totals
+
+    def distinct_months(self, lo: int, hi: int, category: Optional[str] = None) -> int:
+        if np is not None:
+            return int(np.unique(_column(self.months)[self._selected(lo, hi, category)]).size)
+        return len({self.months[pos] for pos in self._positions(lo, hi, category)})
+
+    def positions(self, lo: int, hi: int, category: Optional[str] = None) -> List[int]:
+        if np is not None:
+            return self._selected(lo, hi, category).tolist()
+        return list(self._positions(lo, hi, category))
+
+
+def _column(values: array):
+    """Zero-copy NumPy view of an int64 ("q") array column."""
+    return np.frombuffer(values, dtype=np.int64) if len(values) else np.zeros(0, dtype=np.int64)
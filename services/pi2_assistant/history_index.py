@@ -0,0 +1,147 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Key = Tuple[float, str]
+
+# key of rows without a usable timestamp: older than any dated row
+UNDATED_EPOCH = float("-inf")
+
+# Timestamp-sorted view over a state's history rows.
+#
+# Each row's ISO timestamp is parsed once, when the row enters the index; the
+# (epoch, id) key is kept in a sorted list next to the row so period windows and
+# "last N days" filters are two binary searches instead of a scan that parses
+# every string. The id makes the order total, which is what keyset pagination
+# (older_than) resumes from. Rows whose timestamp does not parse are kept
+# aside and never match a time window.
+#
+# The index is in-memory only (state["_history_index"]) and must be told
+# about every history change: _apply_history_delta does that for endpoints.
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", ""))
+    except Exception:
+        return None
+
+
+class HistoryIndex:
+    def __init__(self, rows: Iterable[Dict[str, Any]] = ()):
+        self._keys: List[Key] = []
+        self._rows: List[Dict[str, Any]] = []
+        self._parsed: Dict[str, Tuple[Optional[float], Optional[datetime]]] = {}
+        self._undated: List[Dict[str, Any]] = []
+
+        dated: List[Tuple[Key, Dict[str, Any]]] = []
+        for row in rows:
+            epoch, ts = self._parse(row)
+            row_id = self._row_id(row)
+            self._parsed[row_id] = (epoch, ts)
+            if epoch is None:
+                self._undated.append(row)
+            else:
+                dated.append(((epoch, row_id), row))
+        dated.sort(key=lambda item: item[0])
+        self._keys = [key for key, _ in dated]
+        self._rows = [row for _, row in dated]
+
+    @staticmethod
+    def _row_id(row: Dict[str, Any]) -> str:
+        return str(row.get("id") or id(row))
+
+    @staticmethod
+    def _parse(row: Dict[str, Any]) -> Tuple[Optional[float], Optional[datetime]]:
+        ts = parse_timestamp(row.get("timestamp"))
+        if ts is None:
+            return None, None
+        try:
+            return ts.timestamp(), ts
+        except (OverflowError, OSError, ValueError):
+            return None, None
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._undated)
+
+    def add(self, row: Dict[str, Any]) -> Optional[float]:
+        """Index a new (or re-timestamped) row; returns its epoch."""
+        self.discard(row)
+        epoch, ts = self._parse(row)
+        row_id = self._row_id(row)
+        self._parsed[row_id] = (epoch, ts)
+        if epoch is None:
+            self._undated.append(row)
+        else:
+            key = (epoch, row_id)
+            pos = bisect_right(self._keys, key)
+            self._keys.insert(pos, key)
+            self._rows.insert(pos, row)
+        return epoch
+
+    def discard(self, row: Dict[str, Any]) -> Optional[float]:
+        """Drop a row by id; returns the epoch it was indexed under."""
+        row_id = self._row_id(row)
+        parsed = self._parsed.pop(row_id, None)
+        if parsed is None:
+            return None
+        epoch = parsed[0]
+        if epoch is None:
+            self._undated = [r for r in self._undated if self._row_id(r) != row_id]
+            return None
+        pos = bisect_left(self._keys, (epoch, row_id))
+        if pos < len(self._keys) and self._keys[pos] == (epoch, row_id):
+            del self._keys[pos]
+            del self._rows[pos]
+        return epoch
+
+    def timestamp_of(self, row: Dict[str, Any]) -> Optional[datetime]:
+        parsed = self._parsed.get(self._row_id(row))
+        return parsed[1] if parsed else None
+
+    def window(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        newest_first: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """Rows with start <= timestamp < end (either bound optional).
+
+        Without bounds, rows whose timestamp does not parse come last.
+        """
+        lo = 0 if start is None else bisect_left(self._keys, (start.timestamp(),))
+        hi = len(self._keys) if end is None else bisect_left(self._keys, (end.timestamp(),), lo)
+        undated = self._undated if start is None and end is None else []
+        if newest_first:
+            positions = range(hi - 1, lo - 1, -1)
+        else:
+            positions = range(lo, hi)
+        yield from (self._rows[pos] for pos in positions)
+        yield from list(undated)
+
+    def older_than(
+        self,
+        key: Optional[Key] = None,
+        start: Optional[datetime] = None,
+    ) -> Iterator[Tuple[Key, Dict[str, Any]]]:
+        """(key, row) pairs newest first, strictly before ``key`` and not before ``start``.
+
+        Undated rows follow the dated ones (keyed at UNDATED_EPOCH, by id) unless
+        ``start`` is given. Feed the last key of a page back in for the next one.
+        """
+        lo = 0 if start is None else bisect_left(self._keys, (start.timestamp(),))
+        hi = len(self._keys) if key is None else max(lo, bisect_left(self._keys, key))
+        for pos in range(hi - 1, lo - 1, -1):
+            yield self._keys[pos], self._rows[pos]
+        if start is not None:
+            return
+        undated = sorted((((UNDATED_EPOCH, self._row_id(r)), r) for r in self._undated), key=lambda item: item[0])
+        for undated_key, row in reversed(undated):
+            if key is None or undated_key < key:
+                yield undated_key, row
+
+    def ids(self) -> List[str]:
+        """Indexed row ids in timestamp order (undated last); used by aggregate verification."""
+        return [self._row_id(r) for r in self._rows] + [self._row_id(r) for r in self._undated]
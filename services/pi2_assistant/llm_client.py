@@ -0,0 +1,260 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+import httpx
+
+# Async Ollama client for the API server.
+#
+# One httpx.AsyncClient (keep-alive pool) is shared by every chat request, so
+# a generation in flight only occupies a socket, never the event loop. The
+# app lifespan opens and closes it; a request that arrives without a running
+# lifespan (tests, embedded use) gets a client created on first use. A
+# client is bound to the event loop it was created on and is replaced if
+# it is used from another loop. Every generate call sends ``keep_alive`` so
+# the model (and its prompt cache) stays resident between chats.
+#
+# OllamaHealth probes the server in a background task (fast when healthy,
+# exponential backoff while it is down) so chat requests read a cached
+# status instead of paying a /api/tags round trip each. While the server or
+# the configured model is known to be down the circuit is open and callers
+# go straight to their fallback; the next successful probe closes it.
+
+
+class OllamaError(RuntimeError):
+    """Error reported by Ollama inside a streamed response, or a stream cut off before "done"."""
+
+
+def parse_keep_alive(value: Optional[str]) -> Union[str, int, None]:
+    """Ollama takes a number of seconds or a duration string ("30m"); "-1" keeps the model loaded."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+class AsyncOllamaClient:
+    def __init__(
+        self,
+        host: str,
+        model: str,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        max_connections: int = 4,
+        keepalive_expiry: float = 30.0,
+        keep_alive: Union[str, int, None] = None,
+    ):
+        self.host = host.rstrip("/")
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        self._http()
+
+    async def aclose(self) -> None:
+        client, self._client, self._loop = self._client, None, None
+        if client is not None:
+            await client.aclose()
+
+    def _http(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # a client left on another (finished) loop cannot be closed from here; drop it
+            self._client = httpx.AsyncClient(base_url=self.host, timeout=self.timeout, limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    async def tags(self, timeout: float = 3.0) -> List[str]:
+        """Installed model names; raises httpx.HTTPError when the server is unreachable."""
+        response = await self._http().get("/api/tags", timeout=timeout)
+        response.raise_for_status()
+        return [model.get("name", "") for model in response.json().get("models", [])]
+
+    async def loaded(self, timeout: float = 3.0) -> List[str]:
+        """Models currently held in memory (/api/ps)."""
+        response = await self._http().get("/api/ps", timeout=timeout)
+        response.raise_for_status()
+        return [model.get("name", "") for model in response.json().get("models", [])]
+
+    def _payload(self, prompt: str, options: Optional[Dict[str, Any]], stream: bool, fields: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {"model": self.model, "prompt": prompt, "stream": stream, "options": options or {}}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        payload.update(fields)
+        return payload
+
+    async def generate(self, prompt: str, options: Optional[Dict[str, Any]] = None, **fields: Any) -> Dict[str, Any]:
+        """Non-streaming /api/generate; raises httpx.HTTPError on transport or HTTP errors."""
+        payload = self._payload(prompt, options, False, fields)
+        response = await self._http().post("/api/generate", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    async def generate_stream(self, prompt: str, options: Optional[Dict[str, Any]] = None, **fields: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Streaming /api/generate: yields each NDJSON chunk as it arrives; the last one has "done": true.
+
+        Closing the iterator early closes the connection, which stops the generation.
+        """
+        payload = self._payload(prompt, options, True, fields)
+        async with self._http().stream("POST", "/api/generate", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise OllamaError(chunk["error"])
+                yield chunk
+                if chunk.get("done"):
+                    return
+        raise OllamaError("stream ended before the final chunk")
+
+
+def _same_model(name: str, wanted: str) -> bool:
+    return name == wanted or name == f"{wanted}:latest" or f"{name}:latest" == wanted
+
+
+class OllamaHealth:
+    """Cached Ollama liveness and model list, refreshed by a background task."""
+
+    def __init__(
+        self,
+        client: AsyncOllamaClient,
+        interval: float = 30.0,
+        min_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        probe_timeout: float = 3.0,
+    ):
+        self.client = client
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.online: Optional[bool] = None
+        self.models: List[str] = []
+        self.loaded: List[str] = []
+        self.failures = 0
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.latency_ms: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    @property
+    def model_installed(self) -> Optional[bool]:
+        if not self.online:
+            return None
+        return any(_same_model(name, self.client.model) for name in self.models)
+
+    @property
+    def circuit(self) -> str:
+        if self.online is None:
+            return "unknown"
+        return "closed" if self.allow() else "open"
+
+    def allow(self) -> bool:
+        """False while the server or the configured model is known to be down."""
+        return self.online is not False and self.model_installed is not False
+
+    async def check(self) -> bool:
+        started = time.perf_counter()
+        try:
+            models = await self.client.tags(timeout=self.probe_timeout)
+        except Exception as exc:
+            self._failed(exc)
+            return False
+        self.latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        try:
+            self.loaded = await self.client.loaded(timeout=self.probe_timeout)
+        except Exception:
+            self.loaded = []  # older servers have no /api/ps
+        self.models = models
+        self.online = True
+        self.failures = 0
+        self.error = None
+        self.checked_at = time.time()
+        return True
+
+    async def ensure_fresh(self) -> None:
+        """Probe inline only when no background task keeps the status current."""
+        if self.running:
+            return
+        if self.checked_at is None or time.time() - self.checked_at >= self._delay():
+            await self.check()
+
+    def record_success(self) -> None:
+        if not self.online:
+            self.online, self.failures, self.error = True, 0, None
+            self.wake()
+
+    def record_failure(self, error: BaseException) -> None:
+        """A call could not reach the server: open the circuit and re-probe."""
+        self._failed(error)
+        self.wake()
+
+    def _failed(self, error: BaseException) -> None:
+        self.online = False
+        self.failures += 1
+        self.error = f"{type(error).__name__}: {error}"
+        self.checked_at = time.time()
+
+    def _delay(self) -> float:
+        if self.online is False:
+            return min(self.max_backoff, self.min_backoff * 2 ** max(0, self.failures - 1))
+        return self.interval
+
+    def wake(self) -> None:
+        if self._wake is not None:
+            self._wake.set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await self.check()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._delay())
+            except asyncio.TimeoutError:
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "status": {True: "online", False: "offline", None: "unknown"}[self.online],
+            "circuit": self.circuit,
+            "model": self.client.model,
+            "model_installed": self.model_installed,
+            "models": self.models,
+            "loaded": self.loaded,
+            "latency_ms": self.latency_ms,
+            "failures": self.failures,
+            "error": self.error,
+            "checked_at": self.checked_at,
+            "next_check_in": round(self._delay(), 1),
+        }
@@ -0,0 +1,111 @@
+import threading
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Optional
+
+# Per-route response metrics for /api/metrics.
+#
+# CompressionMiddleware records every finished response: the body size as
+# encoded by the endpoint (raw) and as sent (wire), the encode time the
+# response reported in its Server-Timing header, and the compression time.
+# Routes are keyed by their path template ("/api/period/{period_key}"), so
+# the table stays bounded no matter which ids or periods are requested.
+#
+# LatencyMetrics keeps the last ``window`` samples of named timings (chat
+# time-to-first-token and friends) for percentile summaries.
+
+
+class ResponseMetrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._routes: Dict[str, Dict[str, Any]] = {}
+
+    def record(
+        self,
+        route: str,
+        media_type: str,
+        encoding: Optional[str],
+        raw_bytes: int,
+        wire_bytes: int,
+        encode_ms: Optional[float] = None,
+        compress_ms: float = 0.0,
+    ) -> None:
+        with self._lock:
+            entry = self._routes.get(route)
+            if entry is None:
+                entry = self._routes[route] = {
+                    "responses": 0,
+                    "raw_bytes": 0,
+                    "wire_bytes": 0,
+                    "encoded": 0,
+                    "encode_ms": 0.0,
+                    "compress_ms": 0.0,
+                    "encodings": Counter(),
+                    "media_types": Counter(),
+                }
+            entry["responses"] += 1
+            entry["raw_bytes"] += raw_bytes
+            entry["wire_bytes"] += wire_bytes
+            if encode_ms is not None:
+                entry["encoded"] += 1
+                entry["encode_ms"] += encode_ms
+            entry["compress_ms"] += compress_ms
+            entry["encodings"][encoding or "identity"] += 1
+            entry["media_types"][media_type.split(";")[0].strip() or "none"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Totals and per-response averages per route; ``ratio`` is wire / raw bytes."""
+        with self._lock:
+            routes = {route: dict(entry, encodings=dict(entry["encodings"]), media_types=dict(entry["media_types"]))
+                      for route, entry in self._routes.items()}
+        for entry in routes.values():
+            count = entry["responses"]
+            entry["avg_raw_bytes"] = round(entry["raw_bytes"] / count, 1)
+            entry["avg_wire_bytes"] = round(entry["wire_bytes"] / count, 1)
+            entry["ratio"] = round(entry["wire_bytes"] / entry["raw_bytes"], 3) if entry["raw_bytes"] else None
+            entry["avg_encode_ms"] = round(entry["encode_ms"] / entry["encoded"], 3) if entry["encoded"] else None
+            entry["avg_compress_ms"] = round(entry["compress_ms"] / count, 3)
+            entry["encode_ms"] = round(entry["encode_ms"], 3)
+            entry["compress_ms"] = round(entry["compress_ms"], 3)
+        return dict(sorted(routes.items()))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._routes.clear()
+
+
+class LatencyMetrics:
+    def __init__(self, window: int = 1000):
+        self.window = max(1, window)
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Counter = Counter()
+
+    def record(self, name: str, ms: float) -> None:
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(ms)
+            self._counts[name] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per name: total count, and avg/p50/p95/max over the retained samples (ms)."""
+        with self._lock:
+            copies = {name: sorted(samples) for name, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result: Dict[str, Dict[str, Any]] = {}
+        for name, values in sorted(copies.items()):
+            last = len(values) - 1
+            result[name] = {
+                "count": counts[name],
+                "avg_ms": round(sum(values) / len(values), 1),
+                "p50_ms": round(values[last // 2], 1),
+                "p95_ms": round(values[int(last * 0.95)], 1),
+                "max_ms": round(values[last], 1),
+            }
+        return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
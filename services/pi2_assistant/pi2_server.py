@@ -1,35 +1,70 @@
 ﻿import os
+import asyncio
+import base64
+import csv
+import io
+import hashlib
+import heapq
 import json
 import logging
 import math
 import re
-import threading
+import time
 from calendar import monthrange
 from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 import unicodedata
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from uuid import uuid4
 from copy import deepcopy
-
-import requests
-from requests.exceptions import Timeout, ConnectionError
-
+from itertools import chain, islice
+
+import httpx
+
+import analytics
+from analytics import AnalyticsEngine, AnalyticsUnavailable
+from change_feed import HEARTBEAT, ChangeFeed, format_event
+from chat_cache import ChatCache, ChatKey, normalize_message
+from compression import CompressionMiddleware, brotli
+from history_columns import HistoryColumns
+from history_index import UNDATED_EPOCH, HistoryIndex, Key, parse_timestamp
+from llm_client import AsyncOllamaClient, OllamaError, OllamaHealth, parse_keep_alive
+from metrics import LatencyMetrics, ResponseMetrics
 from rag_mem import RagIndex, MemoryStore
+from state_cache import StateCache
+from state_locks import KeyedLocks, LockTimeout
+from state_response import MsgpackResponse, PublicState, StateResponse, StreamingStateResponse, dumps, msgpack, negotiated_response, packb, wants_msgpack
+from state_store import PeriodManifest, create_state_backend
+from statement_import import ImportRow, RowError, parse_statement
 from xu_guard import is_recent_duplicate
 
-from fastapi import FastAPI, Request, HTTPException, APIRouter, Query
+from fastapi import FastAPI, Request, HTTPException, APIRouter, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("xubudget")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # pooled keep-alive connections to Ollama and its health monitor for the life of the server
+    await OLLAMA.start()
+    OLLAMA_HEALTH.start()
+    try:
+        yield
+    finally:
+        await OLLAMA_HEALTH.stop()
+        await OLLAMA.aclose()
+
+
 # FastAPI app
-app = FastAPI(title="Xubudget API")
+app = FastAPI(title="Xubudget API", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -38,18 +73,81 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "Server-Timing"],
+)
+
+# Compression (brotli when installed, else gzip) for bodies from this size; streamed bodies always
+COMPRESS_MIN_BYTES = int(os.getenv("XU_COMPRESS_MIN", "1024"))
+RESPONSE_METRICS = ResponseMetrics()
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESS_MIN_BYTES,
+    gzip_level=int(os.getenv("XU_GZIP_LEVEL", "6")),
+    brotli_quality=int(os.getenv("XU_BROTLI_QUALITY", "4")),
+    metrics=RESPONSE_METRICS,
 )
 
 # Router com prefixo /api
 api = APIRouter(prefix="/api")
 
-# Diretorio de states
-STATES_DIR = Path(__file__).parent / "states"
+# Diretorio de states (XU_STATES_DIR points tests and scratch runs elsewhere)
+STATES_DIR = Path(os.getenv("XU_STATES_DIR") or Path(__file__).parent / "states")
 STATES_DIR.mkdir(exist_ok=True)
 
 CATEGORIES_PATH = Path(__file__).parent / "categories.json"
 DEFAULT_EMOJI = "??"
-STATE_LOCK = threading.Lock()
+
+# Fields recomputed by _refresh_financials on every load (not worth journaling)
+DERIVED_STATE_FIELDS = (
+    "monthly_spent",
+    "remaining",
+    "icons",
+    "period_start",
+    "period_end",
+    "period_label",
+    "days_in_period",
+    "day_index",
+    "days_remaining",
+    "is_current_period",
+    "next_period",
+    "available_periods",
+)
+
+# State persistence: "json" (one file per user/period) or "sqlite"
+STATE_BACKEND_KIND = os.getenv("XU_STATE_BACKEND", "json")
+STATE_BACKEND = create_state_backend(
+    STATE_BACKEND_KIND,
+    STATES_DIR,
+    db_path=os.getenv("XU_STATE_DB"),
+    # JSON only: append mutations to a journal and compact it in the background
+    journal=os.getenv("XU_STATE_JOURNAL", "1") == "1",
+    volatile_keys=DERIVED_STATE_FIELDS,
+    max_ops=int(os.getenv("XU_JOURNAL_MAX_OPS", "500")),
+    max_bytes=int(os.getenv("XU_JOURNAL_MAX_BYTES", str(1 << 20))),
+)
+STATE_CACHE = StateCache(max_entries=int(os.getenv("XU_STATE_CACHE_SIZE", "64")))
+# One writer per (user, period): load -> mutate -> save runs under this lock
+STATE_LOCKS = KeyedLocks()
+STATE_LOCK_TIMEOUT = float(os.getenv("XU_STATE_LOCK_TIMEOUT", "10"))
+# Re-check every incremental aggregate update against a full recompute (slow; for tests/debugging)
+VERIFY_AGGREGATES = os.getenv("XU_VERIFY_AGGREGATES", "0") == "1"
+# Aggregate over typed array columns (NumPy when installed) instead of the dict rows
+HISTORY_COLUMNS = os.getenv("XU_HISTORY_COLUMNS", "0") == "1"
+# GET /state and /period stream the history array in batches past this many rows
+STREAM_HISTORY_MIN = int(os.getenv("XU_STREAM_HISTORY_MIN", "5000"))
+# users whose cross-period analytics frames stay in memory
+ANALYTICS_MAX_USERS = int(os.getenv("XU_ANALYTICS_USERS", "16"))
+# /api/stream: events buffered per connection before it is told to resync, and heartbeat seconds
+STREAM_BUFFER = int(os.getenv("XU_STREAM_BUFFER", "256"))
+STREAM_HEARTBEAT = float(os.getenv("XU_STREAM_HEARTBEAT", "15"))
+CHANGE_FEED = ChangeFeed(max_events=STREAM_BUFFER)
+# /api/import: rows applied between event-loop yields, and per-row errors echoed back
+IMPORT_BATCH = int(os.getenv("XU_IMPORT_BATCH", "500"))
+IMPORT_MAX_ERRORS = int(os.getenv("XU_IMPORT_MAX_ERRORS", "100"))
+# /api/batch: operations accepted per request
+BATCH_MAX_OPS = int(os.getenv("XU_BATCH_MAX_OPS", "500"))
+# /api/export: rows encoded per streamed chunk
+EXPORT_CHUNK_ROWS = int(os.getenv("XU_EXPORT_CHUNK_ROWS", "500"))
 
 MEMORY_STORE = MemoryStore(STATES_DIR)
 RAG_INDEX_PATH = STATES_DIR / "rag_index.json"
@@ -78,7 +176,35 @@ _bootstrap_rag_corpus()
 
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "deepseek-r1:7b")
-OLLAMA_TIMEOUT = 10
+# seconds to open a connection / to wait for generated bytes
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "10"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "4"))
+# how long Ollama keeps the model loaded after a chat ("-1": forever, "" leaves the server default)
+OLLAMA_KEEP_ALIVE = parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "30m"))
+OLLAMA = AsyncOllamaClient(
+    OLLAMA_HOST,
+    OLLAMA_MODEL,
+    connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+    read_timeout=OLLAMA_TIMEOUT,
+    max_connections=OLLAMA_MAX_CONNECTIONS,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+)
+# background /api/tags probe: every OLLAMA_HEALTH_INTERVAL s while up, backing off to OLLAMA_HEALTH_MAX_BACKOFF s while down
+OLLAMA_HEALTH = OllamaHealth(
+    OLLAMA,
+    interval=float(os.getenv("OLLAMA_HEALTH_INTERVAL", "30")),
+    max_backoff=float(os.getenv("OLLAMA_HEALTH_MAX_BACKOFF", "60")),
+    probe_timeout=OLLAMA_CONNECT_TIMEOUT,
+)
+CHAT_OPTIONS = {"temperature": 0.7, "num_predict": 200}
+# chat latencies (ttft_ms, stream_ms, generate_ms, prefill_ms) reported by /api/metrics
+CHAT_METRICS = LatencyMetrics(window=int(os.getenv("XU_CHAT_METRICS_WINDOW", "1000")))
+# model replies reused for the same question while the user's state is unchanged (XU_CHAT_CACHE_TTL=0 disables)
+CHAT_CACHE = ChatCache(
+    max_entries=int(os.getenv("XU_CHAT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("XU_CHAT_CACHE_TTL", "600")),
+)
 
 
 def _load_categories() -> List[Dict[str, Any]]:
@@ -193,11 +319,6 @@ def _month_key(dt: Optional[datetime] = None) -> str:
     return f"{dt.year}_{dt.month:02d}"
 
 
-def _state_file(user_id: str, month_key: Optional[str] = None) -> Path:
-    month_key = month_key or _month_key()
-    return STATES_DIR / f"{user_id}_{month_key}.json"
-
-
 def _extract_period_from_path(path: Path, user_id: str) -> Optional[str]:
     stem = path.stem
     if not stem.startswith(f"{user_id}_"):
@@ -211,19 +332,9 @@ def _extract_period_from_path(path: Path, user_id: str) -> Optional[str]:
     return f"{year}_{month}"
 
 
-def _list_state_files(user_id: str) -> List[Tuple[str, Path]]:
-    items: List[Tuple[str, Path]] = []
-    for path in STATES_DIR.glob(f"{user_id}_*.json"):
-        period_key = _extract_period_from_path(path, user_id)
-        if period_key:
-            items.append((period_key, path))
-    items.sort(key=lambda item: item[0])
-    return items
-
-
-def _latest_state_path(user_id: str) -> Optional[Tuple[str, Path]]:
-    items = _list_state_files(user_id)
-    return items[-1] if items else None
+def _latest_period_key(user_id: str) -> Optional[str]:
+    periods = PERIOD_MANIFEST.periods(user_id)
+    return periods[-1] if periods else None
 
 
 def _start_new_period_from_template(
@@ -251,12 +362,13 @@ def _start_new_period_from_template(
         'period': month_key,
         'previous_period': previous_period,
         'period_started_at': datetime.now().isoformat(),
+        'schema_version': STATE_SCHEMA_VERSION,
     }
     return new_state
 
 
 def _available_periods_for_user(user_id: str, current_period: Optional[str] = None) -> List[str]:
-    periods = [key for key, _ in _list_state_files(user_id)]
+    periods = PERIOD_MANIFEST.periods(user_id)
     if current_period and current_period not in periods:
         periods.append(current_period)
     return sorted(set(periods))
@@ -337,38 +449,12 @@ def _period_context_payload(user_id: str, current_period: str) -> List[Dict[str,
     return sorted(payloads, key=lambda item: item['id'], reverse=True)
 
 
-def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
-    if not value:
-        return None
-    try:
-        return datetime.fromisoformat(value.replace("Z", ""))
-    except Exception:
-        return None
-
-
 def _legacy_state_file(user_id: str) -> Path:
     return STATES_DIR / f"{user_id}.json"
 
 
-def _ensure_state_schema(state: Dict[str, Any], user_id: str) -> Dict[str, Any]:
-    state.setdefault("user_id", user_id)
-    state.setdefault("currency", "CAD")
-    state.setdefault("budget", 0.0)
-    state.setdefault("monthly_spent", 0.0)
-    state.setdefault("remaining", 0.0)
-    state.setdefault("history", [])
-    state.setdefault("incomes", [])
-    state.setdefault("goals", [])
-    state.setdefault("category_budgets", {})
-    state.setdefault("settings", {})
-    state.setdefault("icons", [])
-    state.setdefault("active_icons", [])
-    state.setdefault("merchant_rules", {})
-    state.setdefault("subcategory_budgets", {})
-
-    state["settings"].setdefault("budget_mode", "standard")
-
-    # Normalize history entries
+def _migrate_state_v1(state: Dict[str, Any], user_id: str) -> None:
+    """v0 -> v1: normalize every history entry, income and goal."""
     for entry in state["history"]:
         entry.setdefault("id", str(uuid4()))
         entry.setdefault("type", "expense")
@@ -386,7 +472,6 @@ def _ensure_state_schema(state: Dict[str, Any], user_id: str) -> Dict[str, Any]:
         income["timestamp"] = income.get("timestamp") or datetime.now().isoformat()
         income["source"] = income.get("source") or income.get("description") or "Income"
 
-    # Normalize goals
     normalized_goals = []
     for goal in state["goals"]:
         goal.setdefault("id", str(uuid4()))
@@ -398,97 +483,145 @@ def _ensure_state_schema(state: Dict[str, Any], user_id: str) -> Dict[str, Any]:
         normalized_goals.append(goal)
     state["goals"] = normalized_goals
 
-    # Recalculate totals
-    _recalculate_totals(state, user_id)
+
+# schema_version -> migration that upgrades a state from that version to the next.
+# Append a new entry (never edit an old one) when the stored format changes.
+STATE_MIGRATIONS: Dict[int, Callable[[Dict[str, Any], str], None]] = {
+    0: _migrate_state_v1,
+}
+STATE_SCHEMA_VERSION = max(STATE_MIGRATIONS) + 1
+
+
+def _ensure_state_schema(state: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    state.setdefault("user_id", user_id)
+    state.setdefault("currency", "CAD")
+    state.setdefault("budget", 0.0)
+    state.setdefault("monthly_spent", 0.0)
+    state.setdefault("remaining", 0.0)
+    state.setdefault("history", [])
+    state.setdefault("incomes", [])
+    state.setdefault("goals", [])
+    state.setdefault("category_budgets", {})
+    state.setdefault("settings", {})
+    state.setdefault("icons", [])
+    state.setdefault("active_icons", [])
+    state.setdefault("merchant_rules", {})
+    state.setdefault("subcategory_budgets", {})
+
+    state["settings"].setdefault("budget_mode", "standard")
+
+    # Current files skip the per-row pass; older ones are upgraded step by step
+    version = int(state.get("schema_version") or 0)
+    if version > STATE_SCHEMA_VERSION:
+        logger.warning("State for %s has schema_version %s, newer than %s", user_id, version, STATE_SCHEMA_VERSION)
+    while version < STATE_SCHEMA_VERSION:
+        STATE_MIGRATIONS[version](state, user_id)
+        version += 1
+        # rows changed outside the change tracker: next save rewrites the period
+        state["_migrated"] = True
+    state["schema_version"] = version
 
     return state
 
 
-def _recalculate_totals(state: Dict[str, Any], user_id: str) -> None:
-    """Recalculate all totals and derived fields"""
-    period_key = state.get("period") or _current_period_key()
-    period_start, period_end = _period_start_end(period_key)
-    
-    expenses = [e for e in state.get("history", []) if e.get("type") == "expense"]
-    incomes = [i for i in state.get("history", []) if i.get("type") == "income"] + state.get("incomes", [])
-
-    monthly_expenses: List[Dict[str, Any]] = []
-    for exp in expenses:
-        ts = _parse_timestamp(exp.get("timestamp"))
-        if ts and period_start <= ts < period_end:
-            monthly_expenses.append(exp)
-
-    total_spent = sum(e["amount"] for e in monthly_expenses)
-    state["monthly_spent"] = round(total_spent, 2)
+def _persist_migration(state: Dict[str, Any], key: Tuple[str, str]) -> None:
+    """Write an upgraded state back once so later loads take the fast path."""
+    try:
+        # non-blocking: a transaction that already holds the lock saves it on exit
+        with STATE_LOCKS.hold(key, timeout=0):
+            save_user_state(state)
+    except LockTimeout:
+        return
+    except Exception as exc:
+        logger.warning("Failed persisting schema migration for %s/%s: %s", key[0], key[1], exc)
+        return
+    logger.info("Migrated %s/%s to schema_version %s", key[0], key[1], STATE_SCHEMA_VERSION)
 
-    budgets = state.get("category_budgets", {})
-    if not budgets and CATEGORIES:
-        budgets = {cat["id"]: float(cat.get("budget", 0.0) or 0.0) for cat in CATEGORIES}
-        state["category_budgets"] = budgets
 
-    total_budget = state.get("budget") or sum(budgets.values())
-    state["budget"] = round(total_budget, 2)
-    state["remaining"] = round(total_budget - total_spent, 2)
+def _period_manifest_entry(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Manifest metadata for a loaded (refreshed) state."""
+    return {
+        "entries": len(state.get("history", [])),
+        "spent": round(float(state.get("_spent_total", 0.0)), 2),
+        "budget": round(float(state.get("budget", 0.0) or 0.0), 2),
+        "rollup": _period_rollup(state),
+    }
 
-    spend_by_category: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"spent": 0.0, "transactions": 0})
-    merchants: Counter[str] = Counter()
-    for exp in monthly_expenses:
-        cat_id = exp.get("category") or "other"
-        spend_by_category[cat_id]["spent"] += exp["amount"]
-        spend_by_category[cat_id]["transactions"] += 1
-        merchant = exp.get("merchant") or exp.get("description") or "Unknown"
-        merchants[merchant.strip() or "Unknown"] += 1
 
-    state["_category_totals"] = spend_by_category
-    state["_top_merchants"] = merchants
+def _describe_stored_period(user_id: str, period_key: str, raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Manifest metadata straight from a stored period, without caching it."""
+    state = _ensure_state_schema(raw, user_id)
+    state["period"] = period_key
+    # period context lists the user's periods, i.e. reads the manifest being rebuilt
+    _refresh_financials(state, period_context=False)
+    return _period_manifest_entry(state)
 
 
-def load_user_state(
-    user_id: str = "default",
-    period: Optional[str] = None,
-    create_if_missing: bool = True,
-) -> Dict[str, Any]:
+# states/manifests/{user}.json: the periods each user has, so listing them never globs STATES_DIR
+PERIOD_MANIFEST = PeriodManifest(STATES_DIR / "manifests", STATE_BACKEND, describe=_describe_stored_period)
+
+
+def rebuild_period_rollups(user_ids: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """Regenerate period manifests and rollups from storage; returns user -> period count."""
+    if user_ids is None:
+        return PERIOD_MANIFEST.rebuild_all()
+    return {user_id: len(PERIOD_MANIFEST.rebuild(user_id)) for user_id in user_ids}
+
+
+def _resolve_period_key(period: Optional[str]) -> str:
     month_key = period or _current_period_key()
     if "-" in month_key:
         month_key = _period_key_from_external(month_key)
     if not re.fullmatch(r"\d{4}_[0-1]\d", month_key):
         raise ValueError(f"Invalid period format: {month_key}")
+    return month_key
+
+
+def load_user_state(
+    user_id: str = "default",
+    period: Optional[str] = None,
+    create_if_missing: bool = True,
+) -> Dict[str, Any]:
+    month_key = _resolve_period_key(period)
+
+    cache_key = (user_id, month_key)
+    signature = STATE_BACKEND.signature(user_id, month_key)
+    if signature is not None or create_if_missing:
+        cached = STATE_CACHE.get(cache_key, signature)
+        if cached is not None:
+            if cached.get("_refreshed_on") != datetime.now().date().isoformat():
+                # day_index / days_remaining move at midnight
+                _refresh_financials(cached)
+            return cached
 
-    monthly_path = _state_file(user_id, month_key)
     legacy_path = _legacy_state_file(user_id)
 
-    raw: Dict[str, Any]
-    source_path: Path
+    raw: Optional[Dict[str, Any]] = STATE_BACKEND.load(user_id, month_key)
+    persisted = raw is not None
 
-    if monthly_path.exists():
-        raw = json.loads(monthly_path.read_text(encoding="utf-8"))
-        source_path = monthly_path
-    else:
+    if raw is None:
         if not create_if_missing:
             raise FileNotFoundError(f"State for period {month_key} not found")
 
         template_state: Optional[Dict[str, Any]] = None
         previous_period: Optional[str] = None
 
-        monthly_path.parent.mkdir(parents=True, exist_ok=True)
-
-        template_entry: Optional[Tuple[str, Path]] = None
+        template_key: Optional[str] = None
+        template_raw: Optional[Dict[str, Any]] = None
         prev_key = _previous_period_key(month_key)
         if prev_key:
-            prev_path = _state_file(user_id, prev_key)
-            if prev_path.exists():
-                template_entry = (prev_key, prev_path)
-
-        if template_entry is None:
-            latest_entry = _latest_state_path(user_id)
-            if latest_entry:
-                template_entry = latest_entry
-
-        if template_entry:
-            previous_period, template_path = template_entry
-            template_raw = json.loads(template_path.read_text(encoding="utf-8"))
+            template_raw = STATE_BACKEND.load(user_id, prev_key)
+            if template_raw is not None:
+                template_key = prev_key
+
+        if template_raw is None:
+            template_key = _latest_period_key(user_id)
+            if template_key:
+                template_raw = STATE_BACKEND.load(user_id, template_key)
+
+        if template_raw is not None:
             template_state = _ensure_state_schema(template_raw, user_id)
-            previous_period = template_state.get("period") or previous_period
+            previous_period = template_state.get("period") or template_key
         elif legacy_path.exists():
             template_raw = json.loads(legacy_path.read_text(encoding="utf-8"))
             template_state = _ensure_state_schema(template_raw, user_id)
@@ -496,7 +629,6 @@ def load_user_state(
 
         if template_state is not None:
             raw = _start_new_period_from_template(template_state, user_id, month_key, previous_period)
-            source_path = monthly_path
         else:
             raw = {
                 "user_id": user_id,
@@ -510,30 +642,172 @@ def load_user_state(
                 "settings": {"budget_mode": "standard"},
                 "icons": [],
                 "active_icons": [],
+                "schema_version": STATE_SCHEMA_VERSION,
             }
-            source_path = monthly_path
 
     state = _ensure_state_schema(raw, user_id)
     if not state.get("period"):
-        derived_period = _extract_period_from_path(source_path, user_id)
-        state["period"] = derived_period or month_key
+        state["period"] = month_key
     state.setdefault("period_started_at", datetime.now().isoformat())
     if "previous_period" not in state:
         state["previous_period"] = None
-    state["_path"] = source_path
+    state["_persisted"] = persisted
+    state["_version"] = 0
     _refresh_financials(state)
+    STATE_CACHE.put(cache_key, state, signature)
+    if persisted and not PERIOD_MANIFEST.has(user_id, month_key):
+        # period file appeared outside the server (copied in, restored from backup)
+        _record_in_manifest(state, user_id, month_key)
+    if persisted and state.get("_migrated"):
+        _persist_migration(state, cache_key)
     return state
 
 
 def save_user_state(state: Dict[str, Any]) -> None:
-    path: Path = state.get("_path") or _state_file(state.get("user_id", "default"))
+    user_id = state.get("user_id", "default")
+    period_key = state.get("period") or _current_period_key()
+    changes = state.pop("_changes", None)
+    new_period = not state.get("_persisted")
+    if new_period or state.pop("_migrated", False):
+        # first write of a new period or of an upgraded schema: rewrite everything
+        changes = None
+    # persisted, so ETags stay valid across restarts and backends
+    state["revision"] = int(state.get("revision") or 0) + 1
     state_copy = {k: v for k, v in state.items() if not k.startswith("_")}
-    with STATE_LOCK:
-        path.write_text(json.dumps(state_copy, ensure_ascii=False, indent=2), encoding="utf-8")
-    logger.debug("State saved to %s", path)
+    cache_key = (user_id, period_key)
+    try:
+        STATE_BACKEND.save(user_id, period_key, state_copy, changes)
+    except Exception:
+        # the cached object holds changes that never reached storage
+        STATE_CACHE.invalidate(cache_key)
+        raise
+    state["_persisted"] = True
+    state["_version"] = state.get("_version", 0) + 1
+    _record_in_manifest(state, user_id, period_key)
+    _publish_change(state, user_id, period_key, changes)
+    CHAT_CACHE.invalidate_user(user_id)
+    if new_period:
+        # other cached periods list the available periods
+        STATE_CACHE.invalidate_user(user_id)
+    STATE_CACHE.put(cache_key, state, STATE_BACKEND.signature(user_id, period_key))
+    logger.debug("State saved to %s backend (%s/%s)", STATE_BACKEND.name, user_id, period_key)
+
+
+def _change_public(state: Dict[str, Any], change: Dict[str, Any]) -> Dict[str, Any]:
+    coll = change["coll"]
+    if change["op"] == "upsert":
+        return {"op": "upsert", "coll": coll, "row": change["row"]}
+    if change["op"] == "delete":
+        return {"op": "delete", "coll": coll, "id": change["id"]}
+    if change["op"] == "put":
+        return {"op": "put", "coll": coll, "key": change["key"], "value": state.get(coll, {}).get(change["key"])}
+    # "replace" of a map and "field" both hand listeners the new value
+    return {"op": "replace", "coll": coll, "value": state.get(coll)}
+
+
+def _publish_change(state: Dict[str, Any], user_id: str, period_key: str, changes: Optional[List[Dict[str, Any]]]) -> None:
+    """Push a saved mutation to the user's /stream listeners (nothing to do without any)."""
+    if not CHANGE_FEED.has_subscribers(user_id):
+        return
+    try:
+        CHANGE_FEED.publish(user_id, "change", {
+            "period": _period_key_to_external(period_key),
+            "revision": state.get("revision"),
+            # None: the whole state was rewritten, refetch it
+            "changes": None if changes is None else [_change_public(state, change) for change in changes],
+            "totals": _state_totals(state),
+        })
+    except Exception as exc:
+        logger.warning("Failed publishing change for %s/%s: %s", user_id, period_key, exc)
+
+
+def _record_in_manifest(state: Dict[str, Any], user_id: str, period_key: str) -> None:
+    try:
+        PERIOD_MANIFEST.record(user_id, period_key, _period_manifest_entry(state))
+    except Exception as exc:
+        # the manifest is rebuildable from the period files; never fail a save over it
+        logger.warning("Failed updating period manifest for %s/%s: %s", user_id, period_key, exc)
+
+
+def _finish_transaction(state: Dict[str, Any], version: int, error: Optional[BaseException]) -> None:
+    if error is None:
+        if state.get("_version") == version:
+            save_user_state(state)
+        return
+    if state.get("_version") == version:
+        # the cached object may hold half-applied, unsaved changes
+        state.pop("_changes", None)
+        STATE_CACHE.invalidate((state.get("user_id", "default"), state.get("period") or _current_period_key()))
+
+
+@contextmanager
+def state_transaction(user_id: str = "default", period: Optional[str] = None, create_if_missing: bool = True):
+    """Load, mutate and save a state under its (user, period) lock.
+
+    The state is saved on a clean exit unless the body already saved it; on
+    an exception nothing is written and the cached copy is dropped.
+    """
+    key = (user_id, _resolve_period_key(period))
+    with STATE_LOCKS.hold(key, timeout=STATE_LOCK_TIMEOUT):
+        state = load_user_state(user_id, period=key[1], create_if_missing=create_if_missing)
+        version = state.get("_version", 0)
+        try:
+            yield state
+        except BaseException as exc:
+            _finish_transaction(state, version, exc)
+            raise
+        _finish_transaction(state, version, None)
+
+
+@asynccontextmanager
+async def state_transaction_async(user_id: str = "default", period: Optional[str] = None, create_if_missing: bool = True):
+    """Async twin of state_transaction for endpoints; waiting never blocks the event loop."""
+    key = (user_id, _resolve_period_key(period))
+    try:
+        async with STATE_LOCKS.hold_async(key, timeout=STATE_LOCK_TIMEOUT):
+            state = load_user_state(user_id, period=key[1], create_if_missing=create_if_missing)
+            version = state.get("_version", 0)
+            try:
+                yield state
+            except BaseException as exc:
+                _finish_transaction(state, version, exc)
+                raise
+            _finish_transaction(state, version, None)
+    except LockTimeout:
+        raise HTTPException(status_code=503, detail="State is busy, try again")
+
+
+def _record_change(state: Dict[str, Any], change: Dict[str, Any]) -> None:
+    state.setdefault("_changes", []).append(change)
+    # derived views of the changed state
+    state.pop("_summary", None)
+    if change["coll"] == "incomes":
+        state.pop("_income_index", None)
+
+
+def _track_row(state: Dict[str, Any], collection: str, entry: Dict[str, Any], index: Optional[int] = None) -> None:
+    """Record an inserted/updated row so the backend only writes that row."""
+    _record_change(state, {"op": "upsert", "coll": collection, "row": entry, "index": index})
 
 
-def _refresh_financials(state: Dict[str, Any]) -> None:
+def _track_delete(state: Dict[str, Any], collection: str, entry_id: str) -> None:
+    _record_change(state, {"op": "delete", "coll": collection, "id": entry_id})
+
+
+def _track_key(state: Dict[str, Any], field: str, key: str) -> None:
+    _record_change(state, {"op": "put", "coll": field, "key": key})
+
+
+def _track_replace(state: Dict[str, Any], field: str) -> None:
+    _record_change(state, {"op": "replace", "coll": field})
+
+
+def _track_field(state: Dict[str, Any], field: str) -> None:
+    """Record a changed top-level value; the backend rewrites the header, not every row."""
+    _record_change(state, {"op": "field", "coll": field})
+
+
+def _refresh_financials(state: Dict[str, Any], period_context: bool = True) -> None:
     user_id = state.get("user_id", "default")
     period_key = state.get("period") or _current_period_key()
     try:
@@ -543,46 +817,79 @@ def _refresh_financials(state: Dict[str, Any]) -> None:
         period_start, period_end = _period_start_end(period_key)
         state["period"] = period_key
 
-    state["_path"] = state.get("_path") or _state_file(user_id, period_key)
+    state.pop("_summary", None)
+    # rows are normalized once by the schema migrations, not on every refresh
+    index = HistoryIndex(state.get("history", []))
+    state["_history_index"] = index
 
-    expenses = [e for e in state.get("history", []) if e.get("type") == "expense"]
-    incomes = [i for i in state.get("history", []) if i.get("type") == "income"] + state.get("incomes", [])
+    spend_by_category: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"spent": 0.0, "transactions": 0})
+    merchants: Counter[str] = Counter()
+    if HISTORY_COLUMNS:
+        columns = state["_history_columns"] = HistoryColumns(index, _merchant_label)
+        state["_spent_total"] = columns.total_cents(*columns.span(period_start, period_end))[0] / 100.0
+        for cat_id, (cents, count) in columns.category_totals().items():
+            spend_by_category[cat_id] = {"spent": cents / 100.0, "transactions": count}
+        merchants = columns.merchant_counts()
+    else:
+        # a view built lazily by a reader belongs to the index being replaced
+        state.pop("_history_columns", None)
+        state["_spent_total"] = sum(
+            e["amount"] for e in index.window(period_start, period_end) if e.get("type") == "expense"
+        )
+        for exp in state.get("history", []):
+            if exp.get("type") != "expense":
+                continue
+            cat_id = exp.get("category") or "other"
+            spend_by_category[cat_id]["spent"] += exp["amount"]
+            spend_by_category[cat_id]["transactions"] += 1
+            merchants[_merchant_label(exp)] += 1
 
-    for entry in expenses + incomes:
-        entry["amount"] = float(entry.get("amount", 0.0) or 0.0)
-        entry["timestamp"] = entry.get("timestamp") or datetime.now().isoformat()
-        entry.setdefault("id", str(uuid4()))
+    state["_category_totals"] = spend_by_category
+    state["_top_merchants"] = merchants
+
+    _refresh_budget_totals(state)
+    if period_context:
+        _refresh_period_fields(state, user_id, period_key, period_start, period_end)
+
+
+def _merchant_label(entry: Dict[str, Any]) -> str:
+    merchant = entry.get("merchant") or entry.get("description") or "Unknown"
+    return merchant.strip() or "Unknown"
+
+
+def _analytics_rows(user_id: str, period_key: str) -> List[Dict[str, Any]]:
+    raw = STATE_BACKEND.load(user_id, period_key)
+    return [] if raw is None else _ensure_state_schema(raw, user_id)["history"]
+
+
+# cross-period expense frames for /analytics, rebuilt per period as backend signatures change
+ANALYTICS = AnalyticsEngine(
+    PERIOD_MANIFEST.periods, _analytics_rows, STATE_BACKEND.signature, _merchant_label,
+    max_users=ANALYTICS_MAX_USERS,
+)
 
-    monthly_expenses: List[Dict[str, Any]] = []
-    for exp in expenses:
-        ts = _parse_timestamp(exp.get("timestamp"))
-        if ts and period_start <= ts < period_end:
-            monthly_expenses.append(exp)
 
-    total_spent = sum(e["amount"] for e in monthly_expenses)
+def _refresh_budget_totals(state: Dict[str, Any]) -> None:
+    """Recompute budget/remaining and the icon grid from the cached aggregates (O(categories))."""
+    state.pop("_summary", None)
+    total_spent = state.get("_spent_total", 0.0)
     state["monthly_spent"] = round(total_spent, 2)
 
     budgets = state.get("category_budgets", {})
     if not budgets and CATEGORIES:
         budgets = {cat["id"]: float(cat.get("budget", 0.0) or 0.0) for cat in CATEGORIES}
         state["category_budgets"] = budgets
+        _track_replace(state, "category_budgets")
 
     total_budget = state.get("budget") or sum(budgets.values())
     state["budget"] = round(total_budget, 2)
     state["remaining"] = round(total_budget - total_spent, 2)
 
-    spend_by_category: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"spent": 0.0, "transactions": 0})
-    merchants: Counter[str] = Counter()
-    for exp in expenses:
-        cat_id = exp.get("category") or "other"
-        spend_by_category[cat_id]["spent"] += exp["amount"]
-        spend_by_category[cat_id]["transactions"] += 1
-        merchant = exp.get("merchant") or exp.get("description") or "Unknown"
-        merchants[merchant.strip() or "Unknown"] += 1
+    _rebuild_icons(state)
 
-    state["_category_totals"] = spend_by_category
-    state["_top_merchants"] = merchants
 
+def _rebuild_icons(state: Dict[str, Any]) -> None:
+    spend_by_category = state.get("_category_totals", {})
     icons = []
     for cat in CATEGORIES:
         cat_id = cat.get("id")
@@ -615,6 +922,14 @@ def _refresh_financials(state: Dict[str, Any]) -> None:
     icons.sort(key=lambda x: (-x["active"], -x["spent"]))
     state["icons"] = icons
 
+
+def _refresh_period_fields(
+    state: Dict[str, Any],
+    user_id: str,
+    period_key: str,
+    period_start: datetime,
+    period_end: datetime,
+) -> None:
     days_in_month = monthrange(period_start.year, period_start.month)[1]
     now = datetime.now()
     is_current_period = period_key == _current_period_key()
@@ -636,10 +951,211 @@ def _refresh_financials(state: Dict[str, Any]) -> None:
         except ValueError:
             pass
     state["available_periods"] = _period_context_payload(user_id, period_key)
+    state["_refreshed_on"] = now.date().isoformat()
+
+
+def _apply_history_delta(
+    state: Dict[str, Any],
+    before: Optional[Dict[str, Any]],
+    after: Optional[Dict[str, Any]],
+    refresh_totals: bool = True,
+) -> None:
+    """Apply one history row change (insert: before=None, delete: after=None) to the aggregates.
+
+    Keeps monthly_spent, remaining, per-category spent/transactions, merchant
+    counts, icons and the timestamp index in step without rescanning history.
+    Every history mutation (income rows included) must go through here.
+    Bulk callers pass ``refresh_totals=False`` and call _refresh_budget_totals
+    once after the batch.
+    """
+    state.pop("_summary", None)
+    if "_category_totals" not in state or "_spent_total" not in state:
+        _refresh_financials(state)
+        return
+
+    totals = state["_category_totals"]
+    merchants = state["_top_merchants"]
+    index = _history_index(state)
+    columns = state.get("_history_columns")
+    period_start, period_end = _period_start_end(state.get("period") or _current_period_key())
+    start_epoch, end_epoch = period_start.timestamp(), period_end.timestamp()
+
+    for row, sign in ((before, -1), (after, 1)):
+        if not row:
+            continue
+        epoch = index.discard(row) if sign < 0 else index.add(row)
+        if columns is not None:
+            if sign < 0:
+                columns.discard(row)
+            else:
+                columns.add(row)
+        if row.get("type") != "expense":
+            continue
+        amount = float(row.get("amount", 0.0) or 0.0)
+        cat_id = row.get("category") or "other"
+        bucket = totals.setdefault(cat_id, {"spent": 0.0, "transactions": 0})
+        bucket["spent"] += sign * amount
+        bucket["transactions"] += sign
+        if bucket["transactions"] <= 0:
+            del totals[cat_id]
+
+        merchant = _merchant_label(row)
+        merchants[merchant] += sign
+        if merchants[merchant] <= 0:
+            del merchants[merchant]
+
+        if epoch is not None and start_epoch <= epoch < end_epoch:
+            state["_spent_total"] += sign * amount
+
+    if not refresh_totals:
+        return
+    _refresh_budget_totals(state)
+    if VERIFY_AGGREGATES:
+        mismatches = _verify_aggregates(state)
+        if mismatches:
+            raise RuntimeError("Incremental aggregates diverged: " + "; ".join(mismatches))
+
+
+def _history_columns(state: Dict[str, Any]) -> HistoryColumns:
+    columns = state.get("_history_columns")
+    if columns is None:
+        columns = state["_history_columns"] = HistoryColumns(_history_index(state), _merchant_label)
+    return columns
+
+
+def _history_index(state: Dict[str, Any]) -> HistoryIndex:
+    index = state.get("_history_index")
+    if index is None:
+        index = state["_history_index"] = HistoryIndex(state.get("history", []))
+    return index
+
+
+def _verify_aggregates(state: Dict[str, Any], tolerance: float = 0.005) -> List[str]:
+    """Compare the incrementally maintained aggregates against a full recompute."""
+    expected = dict(state)
+    expected["_changes"] = []
+    expected.pop("_category_totals", None)
+    _refresh_financials(expected)
+
+    mismatches: List[str] = []
+    for key in ("monthly_spent", "remaining", "budget"):
+        if abs(float(state.get(key, 0.0)) - float(expected.get(key, 0.0))) > tolerance:
+            mismatches.append(f"{key}: {state.get(key)} != {expected.get(key)}")
+
+    actual_totals = state.get("_category_totals", {})
+    expected_totals = expected["_category_totals"]
+    for cat_id in set(actual_totals) | set(expected_totals):
+        got = actual_totals.get(cat_id, {"spent": 0.0, "transactions": 0})
+        want = expected_totals.get(cat_id, {"spent": 0.0, "transactions": 0})
+        if got["transactions"] != want["transactions"] or abs(got["spent"] - want["spent"]) > tolerance:
+            mismatches.append(f"category {cat_id}: {dict(got)} != {dict(want)}")
+
+    if +state.get("_top_merchants", Counter()) != +expected["_top_merchants"]:
+        mismatches.append("merchant counts differ")
+
+    if sorted(_history_index(state).ids()) != sorted(expected["_history_index"].ids()):
+        mismatches.append("history index differs")
+
+    columns = state.get("_history_columns")
+    if columns is not None and "_history_columns" in expected:
+        if _column_rows(columns) != _column_rows(expected["_history_columns"]):
+            mismatches.append("columnar view differs")
+
+    got_icons = {icon["id"]: icon for icon in state.get("icons", [])}
+    want_icons = {icon["id"]: icon for icon in expected["icons"]}
+    if got_icons != want_icons:
+        mismatches.append("icons differ")
+    return mismatches
+
+
+def _column_rows(columns: HistoryColumns) -> List[Tuple[Any, ...]]:
+    return [
+        (record.row.get("id"), columns.cents[pos], columns.epochs[pos], columns.months[pos], record.category, record.merchant)
+        for pos, record in ((pos, columns.record(pos)) for pos in range(len(columns)))
+    ]
+
+
+def _state_public(state: Dict[str, Any]) -> PublicState:
+    """Public view of a state for StateResponse payloads (encoded once, without "_" keys)."""
+    return PublicState(state)
+
+
+def _state_response(content: Any, state: Dict[str, Any], packed: bool = False) -> Response:
+    """Stream JSON for users with a long history; encode the rest (and MessagePack) in one go."""
+    if packed:
+        return MsgpackResponse(content, headers={"Vary": "Accept"})
+    if len(state.get("history", [])) >= STREAM_HISTORY_MIN:
+        return StreamingStateResponse(content, headers={"Vary": "Accept"})
+    return StateResponse(content, headers={"Vary": "Accept"})
+
+
+def _state_etag(state: Dict[str, Any], representation: str = "") -> str:
+    """Weak ETag for anything rendered from one state: changes on save, at midnight and when periods are added.
+
+    Endpoints that negotiate their encoding pass it as ``representation`` so
+    JSON and MessagePack bodies never share a validator.
+    """
+    token = "\x1f".join(str(part) for part in (
+        state.get("user_id"),
+        state.get("period"),
+        state.get("revision", 0),
+        state.get("_refreshed_on"),
+        len(state.get("available_periods") or ()),
+    ))
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).hexdigest()
+    return f'W/"{digest}-{representation}"' if representation else f'W/"{digest}"'
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 response when If-None-Match already names the current ETag (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    current = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or (candidate[2:] if candidate.startswith("W/") else candidate) == current:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+
+def _conditional_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def _prefers_minimal(request: Request) -> bool:
+    prefer = request.headers.get("prefer", "")
+    return any(token.strip().lower() == "return=minimal" for token in re.split(r"[,;]", prefer))
+
+
+def _state_totals(state: Dict[str, Any]) -> Dict[str, Any]:
+    """The aggregate numbers a client needs after a mutation (O(categories))."""
+    return {
+        "budget": state.get("budget", 0.0),
+        "monthly_spent": state.get("monthly_spent", 0.0),
+        "remaining": state.get("remaining", 0.0),
+        "categories": {
+            cat_id: {"spent": round(data.get("spent", 0.0), 2), "transactions": data.get("transactions", 0)}
+            for cat_id, data in state.get("_category_totals", {}).items()
+        },
+    }
 
-def _state_public(state: Dict[str, Any]) -> Dict[str, Any]:
-    data = {k: v for k, v in state.items() if not k.startswith("_")}
-    return json.loads(json.dumps(data, ensure_ascii=False))
+
+def _mutation_response(request: Request, content: Any, state: Dict[str, Any]) -> StateResponse:
+    """Full response by default; with "Prefer: return=minimal", drop the state echo for the totals.
+
+    Build it after the transaction has exited: the save bumps the revision,
+    and the echoed state and ETag must name the stored version.
+    """
+    headers = _conditional_headers(_state_etag(state))
+    if not _prefers_minimal(request):
+        return StateResponse(content, headers=headers)
+    if isinstance(content, PublicState):
+        content = {"status": "ok"}
+    else:
+        content = {k: v for k, v in content.items() if k != "state"}
+    content["totals"] = _state_totals(state)
+    return StateResponse(content, headers={**headers, "Preference-Applied": "return=minimal"})
 
 
 def _get_user_id(request: Request, override: Optional[str] = None) -> str:
@@ -669,40 +1185,108 @@ def _load_state_for_request(request: Request, period: Optional[str], allow_creat
         raise HTTPException(status_code=404, detail="Period not found")
 
 
+def _expense_item(exp: Dict[str, Any]) -> Dict[str, Any]:
+    cat_payload = _category_payload(exp.get("category"))
+    return {
+        "id": exp.get("id"),
+        "amount": round(float(exp.get("amount", 0.0)), 2),
+        "description": exp.get("description"),
+        "category": exp.get("category"),
+        "category_name": cat_payload.get("name"),
+        "emoji": cat_payload.get("emoji", DEFAULT_EMOJI),
+        "timestamp": exp.get("timestamp"),
+        "merchant": exp.get("merchant") or "",
+    }
+
+
+def _expense_pairs(state: Dict[str, Any], after: Optional[Key] = None) -> Iterable[Tuple[Key, Dict[str, Any]]]:
+    return ((key, e) for key, e in _history_index(state).older_than(after) if e.get("type") == "expense")
+
+
 def _list_expenses(state: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
-    expenses = [e for e in state.get("history", []) if e.get("type") == "expense"]
-    expenses.sort(key=lambda e: e.get("timestamp", ""), reverse=True)
-    results = []
-    for exp in expenses[:limit]:
-        cat_payload = _category_payload(exp.get("category"))
-        results.append({
-            "id": exp.get("id"),
-            "amount": round(float(exp.get("amount", 0.0)), 2),
-            "description": exp.get("description"),
-            "category": exp.get("category"),
-            "category_name": cat_payload.get("name"),
-            "emoji": cat_payload.get("emoji", DEFAULT_EMOJI),
-            "timestamp": exp.get("timestamp"),
-            "merchant": exp.get("merchant") or "",
-        })
-    return results
+    return [_expense_item(exp) for _, exp in islice(_expense_pairs(state), limit)]
+
+
+def _income_index(state: Dict[str, Any]) -> HistoryIndex:
+    """Timestamp index over state["incomes"]; dropped by _track_row/_track_delete on income changes."""
+    index = state.get("_income_index")
+    if index is None:
+        index = state["_income_index"] = HistoryIndex(state.get("incomes", []))
+    return index
+
+
+def _income_item(inc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": inc.get("id"),
+        "amount": round(float(inc.get("amount", 0.0)), 2),
+        "description": inc.get("description") or inc.get("source") or "Income",
+        "source": inc.get("source") or "Income",
+        "timestamp": inc.get("timestamp"),
+    }
 
 
-def _list_incomes(state: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
-    incomes = [i for i in state.get("incomes", [])]
+def _income_pairs(state: Dict[str, Any], after: Optional[Key] = None) -> Iterable[Tuple[Key, Dict[str, Any]]]:
     # include income-type entries stored in history
-    incomes.extend(e for e in state.get("history", []) if e.get("type") == "income")
-    incomes.sort(key=lambda e: e.get("timestamp", ""), reverse=True)
-    items = []
-    for inc in incomes[:limit]:
-        items.append({
-            "id": inc.get("id"),
-            "amount": round(float(inc.get("amount", 0.0)), 2),
-            "description": inc.get("description") or inc.get("source") or "Income",
-            "source": inc.get("source") or "Income",
-            "timestamp": inc.get("timestamp"),
-        })
-    return items
+    history_incomes = ((key, e) for key, e in _history_index(state).older_than(after) if e.get("type") == "income")
+    return heapq.merge(_income_index(state).older_than(after), history_incomes, key=lambda pair: pair[0], reverse=True)
+
+
+def _encode_cursor(period_key: str, key: Optional[Key]) -> str:
+    position = None if key is None else [None if key[0] == UNDATED_EPOCH else key[0], key[1]]
+    raw = json.dumps({"p": period_key, "k": position}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, Optional[Key]]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        period_key = str(payload["p"])
+        _period_key_to_datetime(period_key)
+        key = None
+        if payload.get("k") is not None:
+            epoch, row_id = payload["k"]
+            key = (UNDATED_EPOCH if epoch is None else float(epoch), str(row_id))
+    except (ValueError, KeyError, TypeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    return period_key, key
+
+
+def _older_stored_period(user_id: str, period_key: str, not_before: Optional[datetime] = None) -> Optional[str]:
+    earlier = [p for p in PERIOD_MANIFEST.periods(user_id) if p < period_key]
+    if not earlier:
+        return None
+    if not_before is not None and _period_start_end(earlier[-1])[1] <= not_before:
+        return None
+    return earlier[-1]
+
+
+def _paginate(
+    request: Request,
+    period: Optional[str],
+    cursor: Optional[str],
+    limit: int,
+    pairs: Callable[[Dict[str, Any], Optional[Key]], Iterable[Tuple[Key, Dict[str, Any]]]],
+    not_before: Optional[datetime] = None,
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]], Optional[str]]:
+    """One newest-first page: (state, rows, next_cursor).
+
+    ``pairs(state, after)`` yields (key, row) newest first from keyset
+    ``after``. Pages stay within one period; when a period runs out the
+    cursor points at the start of the previous stored period, so scrolling
+    crosses months and every request costs O(limit).
+    """
+    after = None
+    if cursor:
+        period_key, after = _decode_cursor(cursor)
+        period = _period_key_to_external(period_key)
+    state = _load_state_for_request(request, period, allow_create=True)
+    page = list(islice(pairs(state, after), limit + 1))
+    rows = [row for _, row in page[:limit]]
+    period_key = state.get("period") or _current_period_key()
+    if len(page) > limit:
+        return state, rows, _encode_cursor(period_key, page[limit - 1][0])
+    older = _older_stored_period(state.get("user_id", "default"), period_key, not_before)
+    return state, rows, _encode_cursor(older, None) if older else None
 
 
 def _expense_public(exp: Dict[str, Any]) -> Dict[str, Any]:
@@ -764,40 +1348,32 @@ def _remove_entry(items: List[Dict[str, Any]], entry_id: str, type_filter: Optio
 
 
 
-def _timeline_items(state: Dict[str, Any], days: int, limit: int) -> List[Dict[str, Any]]:
-    cutoff = datetime.now() - timedelta(days=days)
-    events: List[Dict[str, Any]] = []
-    for exp in state.get("history", []):
-        ts = datetime.fromisoformat(exp.get("timestamp", datetime.now().isoformat()).replace("Z", ""))
-        if ts < cutoff:
-            continue
-        entry = {
-            "id": exp.get("id"),
-            "type": exp.get("type", "expense"),
-            "amount": round(float(exp.get("amount", 0.0)), 2),
-            "description": exp.get("description"),
-            "timestamp": exp.get("timestamp"),
-        }
-        if entry["type"] == "expense":
-            cat_payload = _category_payload(exp.get("category"))
-            entry.update({
-                "category": exp.get("category"),
-                "category_name": cat_payload.get("name"),
-                "emoji": cat_payload.get("emoji", DEFAULT_EMOJI),
-            })
-        else:
-            entry.update({
-                "category": "income",
-                "category_name": exp.get("source") or "Income",
-                "emoji": "??",
-            })
-        events.append(entry)
-
-    events.sort(key=lambda e: e.get("timestamp", ""), reverse=True)
-    return events[:limit]
+def _timeline_entry(exp: Dict[str, Any]) -> Dict[str, Any]:
+    entry = {
+        "id": exp.get("id"),
+        "type": exp.get("type", "expense"),
+        "amount": round(float(exp.get("amount", 0.0)), 2),
+        "description": exp.get("description"),
+        "timestamp": exp.get("timestamp"),
+    }
+    if entry["type"] == "expense":
+        cat_payload = _category_payload(exp.get("category"))
+        entry.update({
+            "category": exp.get("category"),
+            "category_name": cat_payload.get("name"),
+            "emoji": cat_payload.get("emoji", DEFAULT_EMOJI),
+        })
+    else:
+        entry.update({
+            "category": "income",
+            "category_name": exp.get("source") or "Income",
+            "emoji": "??",
+        })
+    return entry
 
 
-def _build_dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
+def _category_breakdown(state: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], float, float]:
+    """Per-category budget/spend rows (most spent first) plus overall budget and spent."""
     totals = state.get("_category_totals", {})
     categories_payload: List[Dict[str, Any]] = []
     overall_budget = 0.0
@@ -840,9 +1416,17 @@ def _build_dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
         overall_budget += budget
 
     categories_payload.sort(key=lambda c: c["spent"], reverse=True)
-    primary = categories_payload[:8]
-    secondary = categories_payload[8:]
+    return categories_payload, overall_budget, overall_spent
+
 
+def _ui_totals(
+    state: Dict[str, Any],
+    categories_payload: List[Dict[str, Any]],
+    overall_budget: float,
+    overall_spent: float,
+) -> Tuple[float, float, List[str]]:
+    """(budget, spent, category ids) over the UI's primary categories."""
+    totals = state.get("_category_totals", {})
     ui_total_budget = 0.0
     ui_total_spent = 0.0
     ui_category_ids: List[str] = []
@@ -859,11 +1443,36 @@ def _build_dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
         ui_category_ids.append(cat_id)
 
     if not ui_category_ids:
-        ui_category_ids = [c.get("id") for c in primary if c.get("id")]
+        ui_category_ids = [c.get("id") for c in categories_payload[:8] if c.get("id")]
         ui_total_budget = overall_budget
         ui_total_spent = overall_spent
+    return ui_total_budget, ui_total_spent, ui_category_ids
 
-    ui_available = ui_total_budget - ui_total_spent
+
+def _period_rollup(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Headline totals of one period, kept in its manifest entry for /periods."""
+    categories_payload, overall_budget, overall_spent = _category_breakdown(state)
+    ui_total_budget, ui_total_spent, _ = _ui_totals(state, categories_payload, overall_budget, overall_spent)
+    return {
+        "total_spent": round(ui_total_spent, 2),
+        "total_budget": round(ui_total_budget, 2),
+        "available_amount": round(ui_total_budget - ui_total_spent, 2),
+        "expense_count": len(state.get("history", [])),
+        "categories": {
+            c["id"]: {"budget": c["budget"], "spent": c["spent"], "transactions": c["transactions"]}
+            for c in categories_payload
+        },
+    }
+
+
+def _build_dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
+    categories_payload, overall_budget, overall_spent = _category_breakdown(state)
+    primary = categories_payload[:8]
+    secondary = categories_payload[8:]
+    ui_total_budget, ui_total_spent, ui_category_ids = _ui_totals(
+        state, categories_payload, overall_budget, overall_spent
+    )
+    ui_available = ui_total_budget - ui_total_spent
 
     period_key = state.get("period") or _current_period_key()
     period_label = state.get("period_label") or _format_period_label(period_key)
@@ -932,6 +1541,21 @@ def _build_dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+def _dashboard_summary(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Shared, read-only summary of a state, built once per (saved version, refresh day).
+
+    Stored on the state itself, so it is per (user, period) and goes away with
+    the cached state; any tracked mutation or aggregate refresh drops it.
+    """
+    token = (state.get("_version", 0), state.get("_refreshed_on"))
+    cached = state.get("_summary")
+    if cached is not None and cached[0] == token:
+        return cached[1]
+    summary = _build_dashboard_summary(state)
+    state["_summary"] = (token, summary)
+    return summary
+
+
 def _build_safe_to_spend(summary: Dict[str, Any]) -> Dict[str, Any]:
     days_in_period = summary.get("days_in_period") or monthrange(datetime.now().year, datetime.now().month)[1]
     day_index = summary.get("day_index") or datetime.now().day
@@ -970,41 +1594,107 @@ def _build_daily_briefing(summary: Dict[str, Any]) -> str:
     return "Keep tracking your expenses to maintain budget control."
 
 
-def _build_category_analysis(state: Dict[str, Any], category_name: str) -> Dict[str, Any]:
-    category_id = _normalize_category(category_name)
-    cat_payload = CATEGORY_BY_ID.get(category_id) or CATEGORY_BY_NAME.get(category_id)
-    display_name = (cat_payload or {}).get("name", category_name.title())
-    budget = float(state.get("category_budgets", {}).get(category_id, (cat_payload or {}).get("budget", 0.0) or 0.0))
+CategoryWindow = Tuple[float, int, float, Counter, List[Tuple[datetime, Dict[str, Any]]]]
 
-    now = datetime.now()
-    month_start = datetime(now.year, now.month, 1)
-    next_month = datetime(now.year, now.month, monthrange(now.year, now.month)[1]) + timedelta(days=1)
 
-    expenses: List[Dict[str, Any]] = []
-    for entry in state.get("history", []):
+def _category_window_rows(
+    state: Dict[str, Any], category_id: str, recent_cut: Optional[datetime], month_start: datetime, next_month: datetime
+) -> CategoryWindow:
+    """(month total, month count, recent monthly average, month merchant totals, 10 latest) from the dict rows.
+
+    Without ``recent_cut`` the average is skipped (0.0).
+    """
+    index = _history_index(state)
+    recent_expenses: List[Dict[str, Any]] = []
+    for entry in index.window(start=recent_cut or month_start):
         if entry.get("type") != "expense":
             continue
-        ts = _parse_timestamp(entry.get("timestamp"))
-        if not ts:
-            continue
         if _normalize_category(entry.get("category")) != category_id:
             continue
-        expenses.append({"ts": ts, **entry})
+        recent_expenses.append({"ts": index.timestamp_of(entry), **entry})
 
-    monthly = [e for e in expenses if month_start <= e["ts"] < next_month]
+    monthly = [e for e in recent_expenses if month_start <= e["ts"] < next_month]
     monthly_total = sum(e.get("amount", 0.0) for e in monthly)
-    tx_count = len(monthly)
-    avg_tx = monthly_total / tx_count if tx_count else 0.0
 
-    recent_cut = month_start - timedelta(days=90)
-    recent_expenses = [e for e in expenses if e["ts"] >= recent_cut]
-    recent_months = { (e["ts"].year, e["ts"].month) for e in recent_expenses } or {(now.year, now.month)}
-    avg_recent = (sum(e.get("amount", 0.0) for e in recent_expenses) / max(len(recent_months), 1)) if recent_expenses else 0.0
+    recent_months = {(e["ts"].year, e["ts"].month) for e in recent_expenses} or {(month_start.year, month_start.month)}
+    avg_recent = 0.0
+    if recent_cut is not None and recent_expenses:
+        avg_recent = sum(e.get("amount", 0.0) for e in recent_expenses) / max(len(recent_months), 1)
 
     merchant_counter: Counter[str] = Counter()
     for e in monthly:
-        merchant_name = e.get("merchant") or e.get("description") or "Unknown"
-        merchant_counter[merchant_name.strip() or "Unknown"] += e.get("amount", 0.0)
+        merchant_counter[_merchant_label(e)] += e.get("amount", 0.0)
+
+    latest = [(e["ts"], e) for e in sorted(monthly, key=lambda item: item["ts"], reverse=True)[:10]]
+    return monthly_total, len(monthly), avg_recent, merchant_counter, latest
+
+
+def _category_window_columns(
+    state: Dict[str, Any], category_id: str, recent_cut: Optional[datetime], month_start: datetime, next_month: datetime
+) -> CategoryWindow:
+    """Same result as _category_window_rows, from vectorized reductions over the columnar view."""
+    columns = _history_columns(state)
+    month_lo, month_hi = columns.span(month_start, next_month)
+
+    month_cents, tx_count = columns.total_cents(month_lo, month_hi, category_id)
+    avg_recent = 0.0
+    if recent_cut is not None:
+        recent_lo, recent_hi = columns.span(start=recent_cut)
+        recent_cents, recent_count = columns.total_cents(recent_lo, recent_hi, category_id)
+        recent_months = columns.distinct_months(recent_lo, recent_hi, category_id) or 1
+        avg_recent = (recent_cents / 100.0 / recent_months) if recent_count else 0.0
+
+    merchant_counter: Counter[str] = Counter({
+        name: cents / 100.0 for name, cents in columns.merchant_cents(month_lo, month_hi, category_id).items()
+    })
+    latest = []
+    for pos in reversed(columns.positions(month_lo, month_hi, category_id)[-10:]):
+        record = columns.record(pos)
+        latest.append((record.timestamp, record.row))
+    return month_cents / 100.0, tx_count, avg_recent, merchant_counter, latest
+
+
+def _category_recent_cut(now: datetime) -> datetime:
+    """Start of the 90 days before the current month that avg_recent covers."""
+    return datetime(now.year, now.month, 1) - timedelta(days=90)
+
+
+def _analytics_recent_average(user_id: str, category_id: str, recent_cut: datetime) -> Optional[float]:
+    """avg_recent across every stored period (None without pandas); reads period files, so run it off the loop."""
+    if not ANALYTICS.available:
+        return None
+    recent = ANALYTICS.frame(user_id).window(recent_cut, category=category_id)
+    return analytics.monthly_average(recent)
+
+
+def _build_category_analysis(
+    state: Dict[str, Any], category_name: str, avg_recent: Optional[float] = None
+) -> Dict[str, Any]:
+    """Month spend, merchants and latest rows of one category.
+
+    ``avg_recent`` comes from _analytics_recent_average when pandas is
+    installed. Without it the average is computed from this period's rows
+    only: rows of earlier months stored in their own period files are not
+    read, so it can be lower than the analytics figure.
+    """
+    category_id = _normalize_category(category_name)
+    cat_payload = CATEGORY_BY_ID.get(category_id) or CATEGORY_BY_NAME.get(category_id)
+    display_name = (cat_payload or {}).get("name", category_name.title())
+    budget = float(state.get("category_budgets", {}).get(category_id, (cat_payload or {}).get("budget", 0.0) or 0.0))
+
+    now = datetime.now()
+    month_start = datetime(now.year, now.month, 1)
+    next_month = datetime(now.year, now.month, monthrange(now.year, now.month)[1]) + timedelta(days=1)
+
+    recent_cut = _category_recent_cut(now) if avg_recent is None else None
+    window_stats = _category_window_columns if HISTORY_COLUMNS else _category_window_rows
+    monthly_total, tx_count, local_avg, merchant_counter, latest = window_stats(
+        state, category_id, recent_cut, month_start, next_month
+    )
+    if avg_recent is None:
+        avg_recent = local_avg
+    avg_tx = monthly_total / tx_count if tx_count else 0.0
+
     top_merchants = [
         {"name": name, "total": round(amount, 2)}
         for name, amount in merchant_counter.most_common(5)
@@ -1012,12 +1702,12 @@ def _build_category_analysis(state: Dict[str, Any], category_name: str) -> Dict[
 
     recent_transactions = [
         {
-            "timestamp": e["ts"].isoformat(),
+            "timestamp": ts.isoformat(),
             "amount": round(e.get("amount", 0.0), 2),
             "description": e.get("description", ""),
             "merchant": e.get("merchant") or "",
         }
-        for e in sorted(monthly, key=lambda item: item["ts"], reverse=True)[:10]
+        for ts, e in latest
     ]
 
     remaining = budget - monthly_total
@@ -1042,7 +1732,16 @@ def _build_category_analysis(state: Dict[str, Any], category_name: str) -> Dict[
     }
 
 
-def _add_expense(state: Dict[str, Any], amount: float, description: str, category: Optional[str], timestamp: Optional[str] = None, merchant: Optional[str] = None) -> Dict[str, Any]:
+def _add_expense(
+    state: Dict[str, Any],
+    amount: float,
+    description: str,
+    category: Optional[str],
+    timestamp: Optional[str] = None,
+    merchant: Optional[str] = None,
+    import_id: Optional[str] = None,
+    refresh_totals: bool = True,
+) -> Dict[str, Any]:
     state.setdefault("merchant_rules", {})
     merchant_display = merchant or description or ""
     merchant_key = _normalize_merchant_name(merchant_display)
@@ -1062,15 +1761,18 @@ def _add_expense(state: Dict[str, Any], amount: float, description: str, categor
         "timestamp": timestamp or datetime.now().isoformat(),
         "merchant": merchant_display,
     }
+    if import_id:
+        expense["import_id"] = import_id
 
     if merchant_key and normalized_category not in (None, "other"):
         existing = state["merchant_rules"].get(merchant_key)
         if not existing:
             state["merchant_rules"][merchant_key] = normalized_category
+            _track_key(state, "merchant_rules", merchant_key)
 
     state.setdefault("history", []).insert(0, expense)
-    _refresh_financials(state)
-    save_user_state(state)
+    _track_row(state, "history", expense, index=0)
+    _apply_history_delta(state, None, expense, refresh_totals=refresh_totals)
     cat_payload = _category_payload(expense["category"])
     response = {
         "id": expense["id"],
@@ -1084,7 +1786,7 @@ def _add_expense(state: Dict[str, Any], amount: float, description: str, categor
     return response
 
 
-def _add_income(state: Dict[str, Any], amount: float, source: str, timestamp: Optional[str] = None) -> Dict[str, Any]:
+def _add_income(state: Dict[str, Any], amount: float, source: str, timestamp: Optional[str] = None, import_id: Optional[str] = None) -> Dict[str, Any]:
     income = {
         "id": str(uuid4()),
         "type": "income",
@@ -1093,9 +1795,10 @@ def _add_income(state: Dict[str, Any], amount: float, source: str, timestamp: Op
         "description": source or "Income",
         "timestamp": timestamp or datetime.now().isoformat(),
     }
+    if import_id:
+        income["import_id"] = import_id
     state.setdefault("incomes", []).insert(0, income)
-    _refresh_financials(state)
-    save_user_state(state)
+    _track_row(state, "incomes", income, index=0)
     return {
         "id": income["id"],
         "amount": round(income["amount"], 2),
@@ -1216,66 +1919,28 @@ class IntentRequest(BaseModel):
     user_id: Optional[str] = None
 
 
-# --- Endpoints basicos ---
-@app.get("/healthz")
-async def healthz():
-    return {"ok": True, "timestamp": datetime.now().isoformat()}
-
-
-@api.get("/healthz")
-async def api_healthz():
-    return await healthz()
-
-
-@api.get("/categories")
-async def get_categories():
-    return {"categories": CATEGORIES}
+class BatchOperation(BaseModel):
+    op: str
+    id: Optional[str] = None
+    data: Dict[str, Any] = {}
 
 
-@api.get("/state")
-async def get_state(request: Request):
-    user_id = _get_user_id(request)
-    state = load_user_state(user_id)
-    return _state_public(state)
-
-
-@api.get("/timeline")
-async def timeline(request: Request, days: int = Query(30, ge=1, le=180), limit: int = Query(200, ge=1, le=1000), period: Optional[str] = Query(None)):
-    state = _load_state_for_request(request, period, allow_create=True)
-    items = _timeline_items(state, days, limit)
-    return items
-
-
-@api.get("/expenses")
-async def list_expenses(request: Request, limit: int = Query(50, ge=1, le=500), period: Optional[str] = Query(None)):
-    state = _load_state_for_request(request, period, allow_create=True)
-    items = _list_expenses(state, limit)
-    return {"items": items, "total": len(state.get("history", []))}
-
-
-@api.post("/add_expense")
-async def add_expense(payload: AddExpenseRequest):
-    user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    expense = _add_expense(
-        state,
-        amount=payload.amount,
-        description=payload.description,
-        category=payload.subcategory or payload.category,
-        timestamp=payload.timestamp,
-        merchant=payload.merchant,
-    )
-    return {"status": "ok", "expense": expense, "state": _state_public(state)}
+class BatchRequest(BaseModel):
+    user_id: Optional[str] = None
+    period: Optional[str] = None
+    atomic: bool = False
+    operations: List[BatchOperation]
 
 
-@api.patch("/expenses/{expense_id}")
-async def update_expense(expense_id: str, payload: UpdateExpenseRequest):
-    user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
+# Mutation helpers shared by the single-entity endpoints and /batch. Callers
+# applying several changes pass refresh_totals=False and call
+# _refresh_budget_totals once at the end.
+def _update_expense(state: Dict[str, Any], expense_id: str, payload: UpdateExpenseRequest, refresh_totals: bool = True) -> Optional[Dict[str, Any]]:
     entry = _find_expense_entry(state, expense_id)
     if not entry:
-        raise HTTPException(status_code=404, detail="Expense not found")
+        return None
 
+    before = dict(entry)
     if payload.amount is not None:
         entry["amount"] = float(payload.amount)
     if payload.description is not None:
@@ -1287,46 +1952,37 @@ async def update_expense(expense_id: str, payload: UpdateExpenseRequest):
     if payload.merchant is not None:
         entry["merchant"] = payload.merchant
 
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "expense": _expense_public(entry), "state": _state_public(state)}
-
-
-@api.delete("/expenses/{expense_id}")
-async def delete_expense(expense_id: str, user_id: str = Query("default", alias="user_id")):
-    state = load_user_state(user_id)
-    history = state.get("history", [])
-    if not _remove_entry(history, expense_id, type_filter="expense"):
-        raise HTTPException(status_code=404, detail="Expense not found")
-
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "expense_id": expense_id, "state": _state_public(state)}
+    _track_row(state, "history", entry)
+    _apply_history_delta(state, before, entry, refresh_totals=refresh_totals)
+    return entry
 
 
-@api.get("/incomes")
-async def list_incomes(request: Request, limit: int = Query(50, ge=1, le=500), period: Optional[str] = Query(None)):
-    state = _load_state_for_request(request, period, allow_create=True)
-    items = _list_incomes(state, limit)
-    return {"items": items, "total": len(state.get("incomes", []))}
+def _delete_expense(state: Dict[str, Any], expense_id: str, refresh_totals: bool = True) -> bool:
+    entry = _find_expense_entry(state, expense_id)
+    if not entry or not _remove_entry(state.get("history", []), expense_id, type_filter="expense"):
+        return False
+    _track_delete(state, "history", expense_id)
+    _apply_history_delta(state, entry, None, refresh_totals=refresh_totals)
+    return True
 
 
-@api.post("/add_income")
-async def add_income(payload: AddIncomeRequest):
-    user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    income = _add_income(state, payload.amount, payload.source, payload.timestamp)
-    return {"status": "ok", "income": income, "state": _state_public(state)}
+def _reclassify_expense(state: Dict[str, Any], expense_id: str, new_category: str, refresh_totals: bool = True) -> Optional[Dict[str, Any]]:
+    target = next((entry for entry in state.get("history", []) if entry.get("id") == expense_id), None)
+    if not target:
+        return None
+    before = dict(target)
+    target["category"] = _normalize_category(new_category)
+    _track_row(state, "history", target)
+    _apply_history_delta(state, before, target, refresh_totals=refresh_totals)
+    return target
 
 
-@api.patch("/incomes/{income_id}")
-async def update_income(income_id: str, payload: UpdateIncomeRequest):
-    user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
+def _update_income(state: Dict[str, Any], income_id: str, payload: UpdateIncomeRequest, refresh_totals: bool = True) -> Optional[Dict[str, Any]]:
     primary, history_entry = _find_income_entries(state, income_id)
     if not primary and not history_entry:
-        raise HTTPException(status_code=404, detail="Income not found")
+        return None
 
+    history_before = dict(history_entry) if history_entry else None
     targets = [entry for entry in (primary, history_entry) if entry]
     if payload.amount is not None:
         for entry in targets:
@@ -1341,191 +1997,774 @@ async def update_income(income_id: str, payload: UpdateIncomeRequest):
     if payload.timestamp is not None:
         for entry in targets:
             entry["timestamp"] = payload.timestamp
-
-    _refresh_financials(state)
-    save_user_state(state)
-    current = primary or history_entry
-    return {"status": "ok", "income": _income_public(current), "state": _state_public(state)}
+    if primary:
+        _track_row(state, "incomes", primary)
+    if history_entry:
+        _track_row(state, "history", history_entry)
+        # income rows do not feed the spending totals, only the timestamp index
+        _apply_history_delta(state, history_before, history_entry, refresh_totals=refresh_totals)
+    return primary or history_entry
 
 
-@api.delete("/incomes/{income_id}")
-async def delete_income(income_id: str, user_id: str = Query("default", alias="user_id")):
-    state = load_user_state(user_id)
+def _delete_income(state: Dict[str, Any], income_id: str, refresh_totals: bool = True) -> bool:
     primary, history_entry = _find_income_entries(state, income_id)
     removed = False
     if primary and _remove_entry(state.get("incomes", []), income_id):
+        _track_delete(state, "incomes", income_id)
         removed = True
     if history_entry and _remove_entry(state.get("history", []), income_id, type_filter="income"):
+        _track_delete(state, "history", income_id)
+        _apply_history_delta(state, history_entry, None, refresh_totals=refresh_totals)
         removed = True
-    if not removed:
-        raise HTTPException(status_code=404, detail="Income not found")
+    return removed
 
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "income_id": income_id, "state": _state_public(state)}
+
+def _add_goal(state: Dict[str, Any], payload: GoalCreateRequest) -> Dict[str, Any]:
+    goal = {
+        "id": str(uuid4()),
+        "name": payload.name,
+        "target_amount": float(payload.target_amount),
+        "saved_amount": float(payload.saved_amount or 0.0),
+        "status": payload.status or "active",
+        "created_at": datetime.now().isoformat(),
+    }
+    goals = state.setdefault("goals", [])
+    goals.append(goal)
+    _track_row(state, "goals", goal, index=len(goals) - 1)
+    return goal
+
+
+def _update_goal(state: Dict[str, Any], goal_id: str, payload: GoalUpdateRequest) -> Optional[Dict[str, Any]]:
+    goal = next((g for g in state.setdefault("goals", []) if g.get("id") == goal_id), None)
+    if not goal:
+        return None
+
+    if payload.name is not None:
+        goal["name"] = payload.name
+    if payload.target_amount is not None:
+        goal["target_amount"] = float(payload.target_amount)
+    if payload.saved_amount is not None:
+        goal["saved_amount"] = float(payload.saved_amount)
+    if payload.status is not None:
+        goal["status"] = payload.status
+
+    _track_row(state, "goals", goal)
+    return goal
+
+
+def _delete_goal(state: Dict[str, Any], goal_id: str) -> bool:
+    goals = state.get("goals", [])
+    new_goals = [g for g in goals if g.get("id") != goal_id]
+    if len(new_goals) == len(goals):
+        return False
+    state["goals"] = new_goals
+    _track_delete(state, "goals", goal_id)
+    return True
+
+
+def _set_category_budget(state: Dict[str, Any], category_id: str, budget: float) -> str:
+    cat_id = _normalize_category(category_id)
+    state["category_budgets"][cat_id] = float(budget)
+    _track_key(state, "category_budgets", cat_id)
+    return cat_id
+
+
+# --- Endpoints basicos ---
+@app.get("/healthz")
+async def healthz():
+    # cached status only: health checks never wait on Ollama
+    ollama = OLLAMA_HEALTH.status()
+    return {
+        "ok": True,
+        "timestamp": datetime.now().isoformat(),
+        "ollama": {key: ollama[key] for key in ("status", "circuit", "model", "model_installed", "checked_at")},
+    }
+
+
+@api.get("/healthz")
+async def api_healthz():
+    return await healthz()
+
+
+@api.get("/stream")
+async def stream(request: Request):
+    """Server-Sent Events: a "change" event (deltas + totals) after every save of this user's state."""
+    user_id = _get_user_id(request)
+
+    async def events():
+        # subscribe inside the body so the finally below always runs for it (a client that
+        # disconnects before the body starts never subscribes); saves after this point reach
+        # the client, and "ready" carries the revision it starts from
+        subscription = CHANGE_FEED.subscribe(user_id)
+        try:
+            state = load_user_state(user_id)
+            yield format_event("ready", {
+                "user_id": user_id,
+                "period": _period_key_to_external(state.get("period") or _current_period_key()),
+                "revision": state.get("revision", 0),
+                "etag": _state_etag(state),
+            })
+            while not await request.is_disconnected():
+                payload = await subscription.next(STREAM_HEARTBEAT)
+                yield HEARTBEAT if payload is None else payload
+        finally:
+            CHANGE_FEED.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api.get("/categories")
+async def get_categories():
+    return {"categories": CATEGORIES}
+
+
+@api.get("/state", response_class=StateResponse)
+async def get_state(request: Request):
+    user_id = _get_user_id(request)
+    state = load_user_state(user_id)
+    packed = wants_msgpack(request.headers.get("accept"))
+    etag = _state_etag(state, "mp" if packed else "")
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        cached.headers["Vary"] = "Accept"
+        return cached
+    response = _state_response(_state_public(state), state, packed)
+    response.headers.update(_conditional_headers(etag))
+    return response
+
+
+@api.get("/timeline")
+async def timeline(
+    request: Request,
+    days: int = Query(30, ge=1, le=180),
+    limit: int = Query(200, ge=1, le=1000),
+    period: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+):
+    cutoff = datetime.now() - timedelta(days=days)
+    _, rows, next_cursor = _paginate(
+        request, period, cursor, limit,
+        lambda state, after: _history_index(state).older_than(after, start=cutoff),
+        not_before=cutoff,
+    )
+    # the body stays a bare list for existing clients
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return negotiated_response(request.headers.get("accept"), [_timeline_entry(exp) for exp in rows], headers)
+
+
+@api.get("/expenses")
+async def list_expenses(request: Request, limit: int = Query(50, ge=1, le=500), period: Optional[str] = Query(None), cursor: Optional[str] = Query(None)):
+    state, rows, next_cursor = _paginate(request, period, cursor, limit, _expense_pairs)
+    content = {"items": [_expense_item(exp) for exp in rows], "total": len(state.get("history", [])), "next_cursor": next_cursor}
+    return negotiated_response(request.headers.get("accept"), content)
+
+
+@api.post("/add_expense", response_class=StateResponse)
+async def add_expense(payload: AddExpenseRequest, request: Request):
+    user_id = payload.user_id or "default"
+    async with state_transaction_async(user_id) as state:
+        expense = _add_expense(
+            state,
+            amount=payload.amount,
+            description=payload.description,
+            category=payload.subcategory or payload.category,
+            timestamp=payload.timestamp,
+            merchant=payload.merchant,
+        )
+    return _mutation_response(request, {"status": "ok", "expense": expense, "state": _state_public(state)}, state)
+
+
+@api.patch("/expenses/{expense_id}", response_class=StateResponse)
+async def update_expense(expense_id: str, payload: UpdateExpenseRequest, request: Request):
+    user_id = payload.user_id or "default"
+    async with state_transaction_async(user_id) as state:
+        entry = _update_expense(state, expense_id, payload)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Expense not found")
+    return _mutation_response(request, {"status": "ok", "expense": _expense_public(entry), "state": _state_public(state)}, state)
+
+
+@api.delete("/expenses/{expense_id}", response_class=StateResponse)
+async def delete_expense(expense_id: str, request: Request, user_id: str = Query("default", alias="user_id")):
+    async with state_transaction_async(user_id) as state:
+        if not _delete_expense(state, expense_id):
+            raise HTTPException(status_code=404, detail="Expense not found")
+    return _mutation_response(request, {"status": "ok", "expense_id": expense_id, "state": _state_public(state)}, state)
+
+
+@api.get("/incomes")
+async def list_incomes(request: Request, limit: int = Query(50, ge=1, le=500), period: Optional[str] = Query(None), cursor: Optional[str] = Query(None)):
+    state, rows, next_cursor = _paginate(request, period, cursor, limit, _income_pairs)
+    return {"items": [_income_item(inc) for inc in rows], "total": len(state.get("incomes", [])), "next_cursor": next_cursor}
+
+
+@api.post("/add_income", response_class=StateResponse)
+async def add_income(payload: AddIncomeRequest, request: Request):
+    user_id = payload.user_id or "default"
+    async with state_transaction_async(user_id) as state:
+        income = _add_income(state, payload.amount, payload.source, payload.timestamp)
+    return _mutation_response(request, {"status": "ok", "income": income, "state": _state_public(state)}, state)
+
+
+@api.patch("/incomes/{income_id}", response_class=StateResponse)
+async def update_income(income_id: str, payload: UpdateIncomeRequest, request: Request):
+    user_id = payload.user_id or "default"
+    async with state_transaction_async(user_id) as state:
+        current = _update_income(state, income_id, payload)
+        if not current:
+            raise HTTPException(status_code=404, detail="Income not found")
+    return _mutation_response(request, {"status": "ok", "income": _income_public(current), "state": _state_public(state)}, state)
+
+
+@api.delete("/incomes/{income_id}", response_class=StateResponse)
+async def delete_income(income_id: str, request: Request, user_id: str = Query("default", alias="user_id")):
+    async with state_transaction_async(user_id) as state:
+        if not _delete_income(state, income_id):
+            raise HTTPException(status_code=404, detail="Income not found")
+    return _mutation_response(request, {"status": "ok", "income_id": income_id, "state": _state_public(state)}, state)
+
+
+def _statement_format(content_type: str) -> Optional[str]:
+    content_type = content_type.lower()
+    if "ofx" in content_type or "qfx" in content_type:
+        return "ofx"
+    if "csv" in content_type:
+        return "csv"
+    return None
+
+
+def _stored_import_ids(state: Dict[str, Any]) -> Set[str]:
+    return {
+        row["import_id"]
+        for key in ("history", "incomes")
+        for row in state.get(key, [])
+        if isinstance(row, dict) and row.get("import_id")
+    }
+
+
+def _import_batch(state: Dict[str, Any], rows: List[ImportRow], seen: Set[str], counts: Dict[str, int]) -> None:
+    """Apply one batch of parsed rows to a period's state; rows whose import_id is in ``seen`` are skipped."""
+    # a known (possibly empty) change set: a batch of duplicates rewrites nothing
+    state.setdefault("_changes", [])
+    for row in rows:
+        if row.import_id in seen:
+            counts["duplicates"] += 1
+            continue
+        seen.add(row.import_id)
+        timestamp = row.timestamp.isoformat()
+        if row.amount < 0:
+            _add_expense(
+                state,
+                amount=-row.amount,
+                description=row.description or row.merchant or "Imported expense",
+                category=row.category,
+                timestamp=timestamp,
+                merchant=row.merchant or None,
+                import_id=row.import_id,
+                refresh_totals=False,
+            )
+            counts["expenses"] += 1
+        elif row.amount > 0:
+            _add_income(state, row.amount, row.description or row.merchant or "Income", timestamp, import_id=row.import_id)
+            counts["incomes"] += 1
+        else:
+            counts["skipped"] += 1
+    _refresh_budget_totals(state)
+
+
+async def _import_rows(user_id: str, period_key: str, rows: List[ImportRow]) -> Dict[str, int]:
+    """Import one period's rows, committing every IMPORT_BATCH rows in its own transaction."""
+    counts = {"expenses": 0, "incomes": 0, "duplicates": 0, "skipped": 0}
+    seen: Set[str] = set()
+    seen_revision: Optional[int] = None
+    for start in range(0, len(rows), IMPORT_BATCH):
+        async with state_transaction_async(user_id, period=period_key, create_if_missing=True) as state:
+            if seen_revision is None or state.get("revision") != seen_revision:
+                # first batch, or another request saved this period in between
+                seen = _stored_import_ids(state)
+            _import_batch(state, rows[start:start + IMPORT_BATCH], seen, counts)
+        seen_revision = state.get("revision")
+        # the period lock is released between batches, so other requests get a turn
+        await asyncio.sleep(0)
+    return counts
+
+
+@api.post("/import")
+async def import_statement(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ofx)$"),
+    dayfirst: bool = Query(False),
+    expenses_positive: bool = Query(False),
+    user_id: Optional[str] = Query(None),
+):
+    """Bulk-import a CSV or OFX/QFX statement sent as the raw request body.
+
+    Rows are parsed while the body streams in, routed to the period of their
+    date, and committed to that period in batches of IMPORT_BATCH rows.
+    """
+    user_id = _get_user_id(request, user_id)
+    fmt = format or _statement_format(request.headers.get("content-type", ""))
+    started = time.perf_counter()
+    by_period: Dict[str, List[ImportRow]] = defaultdict(list)
+    errors: List[Dict[str, Any]] = []
+    error_count = 0
+    parsed = 0
+    try:
+        async for result in parse_statement(request.stream(), fmt, dayfirst=dayfirst, expenses_positive=expenses_positive):
+            if isinstance(result, RowError):
+                error_count += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({"line": result.line, "error": str(result)})
+                continue
+            parsed += 1
+            by_period[_month_key(result.timestamp)].append(result)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    totals = {"expenses": 0, "incomes": 0, "duplicates": 0, "skipped": 0}
+    periods: Dict[str, Dict[str, int]] = {}
+    for period_key in sorted(by_period):
+        counts = await _import_rows(user_id, period_key, by_period[period_key])
+        periods[_period_key_to_external(period_key)] = counts
+        for key, value in counts.items():
+            totals[key] += value
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        "Imported %s rows for %s into %d period(s) in %.1f ms (%d errors)",
+        parsed, user_id, len(periods), elapsed * 1000, error_count,
+    )
+    return {
+        "status": "ok",
+        "format": fmt or "auto",
+        "rows": parsed + error_count,
+        "imported": {"expenses": totals["expenses"], "incomes": totals["incomes"]},
+        "duplicates": totals["duplicates"],
+        "skipped": totals["skipped"],
+        "periods": periods,
+        "error_count": error_count,
+        "errors": errors,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "rows_per_sec": round((parsed + error_count) / elapsed, 1) if elapsed > 0 else None,
+    }
 
 
 @api.post("/set_budget_mode")
 async def set_budget_mode(payload: BudgetModeRequest):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    state["settings"]["budget_mode"] = payload.mode
-    save_user_state(state)
-    return {"status": "ok", "mode": payload.mode}
+    async with state_transaction_async(user_id) as state:
+        state["settings"]["budget_mode"] = payload.mode
+        _track_field(state, "settings")
+        return {"status": "ok", "mode": payload.mode}
 
 
 @api.post("/activate_icon")
 async def activate_icon(payload: ActivateIconRequest):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    cat_id = _normalize_category(payload.category_id)
-    if payload.amount is not None:
-        state["category_budgets"][cat_id] = float(payload.amount)
-    if cat_id not in state.get("active_icons", []):
-        state["active_icons"].append(cat_id)
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "category_id": cat_id}
+    async with state_transaction_async(user_id) as state:
+        cat_id = _normalize_category(payload.category_id)
+        if payload.amount is not None:
+            state["category_budgets"][cat_id] = float(payload.amount)
+            _track_key(state, "category_budgets", cat_id)
+        if cat_id not in state.get("active_icons", []):
+            state["active_icons"].append(cat_id)
+            _track_field(state, "active_icons")
+        _refresh_budget_totals(state)
+        return {"status": "ok", "category_id": cat_id}
 
 
 @api.get("/icons")
-async def list_icons(request: Request):
+async def list_icons(request: Request, response: Response):
     user_id = _get_user_id(request)
     state = load_user_state(user_id)
+    etag = _state_etag(state)
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        return cached
+    response.headers.update(_conditional_headers(etag))
     return {"items": state.get("icons", [])}
 
 
 @api.post("/set_category_budget")
 async def set_category_budget(payload: SetCategoryBudgetRequest):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    cat_id = _normalize_category(payload.category_id)
-    state["category_budgets"][cat_id] = float(payload.budget)
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "category_id": cat_id, "budget": float(payload.budget)}
+    async with state_transaction_async(user_id) as state:
+        cat_id = _set_category_budget(state, payload.category_id, payload.budget)
+        _refresh_budget_totals(state)
+        return {"status": "ok", "category_id": cat_id, "budget": float(payload.budget)}
 
 
-@api.post("/set_budget")
-async def set_budget(payload: SetBudgetRequest):
+@api.post("/set_budget", response_class=StateResponse)
+async def set_budget(payload: SetBudgetRequest, request: Request):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    state["budget"] = float(payload.budget)
-    _refresh_financials(state)
-    save_user_state(state)
-    return _state_public(state)
+    async with state_transaction_async(user_id) as state:
+        state["budget"] = float(payload.budget)
+        _track_field(state, "budget")
+        _refresh_budget_totals(state)
+    return _mutation_response(request, _state_public(state), state)
 
 
 @api.get("/budget_structure")
 async def budget_structure(request: Request):
     user_id = _get_user_id(request)
     state = load_user_state(user_id)
-    public_state = _state_public(state)
     return {
         "user_id": user_id,
         "total_budget": state.get("budget", 0.0),
         "category_budgets": state.get("category_budgets", {}),
         "subcategory_budgets": state.get("subcategory_budgets", {}),
-        "icons": public_state.get("icons", []),
+        "icons": state.get("icons", []),
     }
 
 
 @api.post("/set_subcategory_budget_v2")
 async def set_subcategory_budget_v2(payload: SubcategoryBudgetRequest):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    cat_id = _normalize_category(payload.category)
-    sub_id = _normalize_category(payload.subcategory)
-    state.setdefault("subcategory_budgets", {}).setdefault(cat_id, {})[sub_id] = float(payload.monthly_budget)
-    save_user_state(state)
+    async with state_transaction_async(user_id) as state:
+        cat_id = _normalize_category(payload.category)
+        sub_id = _normalize_category(payload.subcategory)
+        state.setdefault("subcategory_budgets", {}).setdefault(cat_id, {})[sub_id] = float(payload.monthly_budget)
+        _track_field(state, "subcategory_budgets")
+        return {
+            "status": "ok",
+            "category": cat_id,
+            "subcategory": sub_id,
+            "monthly_budget": float(payload.monthly_budget),
+        }
+
+
+def _period_list_item(period_key: str, rollup: Dict[str, Any]) -> Dict[str, Any]:
+    is_current = period_key == _current_period_key()
+    days_remaining = 0
+    if is_current:
+        now = datetime.now()
+        days_remaining = max(0, monthrange(now.year, now.month)[1] - now.day)
     return {
-        "status": "ok",
-        "category": cat_id,
-        "subcategory": sub_id,
-        "monthly_budget": float(payload.monthly_budget),
+        "period": _period_key_to_external(period_key),
+        "label": _format_period_label(period_key),
+        "total_spent": rollup.get("total_spent"),
+        "total_budget": rollup.get("total_budget"),
+        "available_amount": rollup.get("available_amount"),
+        "expense_count": rollup.get("expense_count"),
+        "is_current": is_current,
+        "days_remaining": days_remaining,
     }
 
 
 @api.get("/periods")
 async def list_periods(request: Request):
     user_id = _get_user_id(request)
-    items: List[Dict[str, Any]] = []
-    seen: set[str] = set()
-
-    for period_key, _ in reversed(_list_state_files(user_id)):
-        try:
-            state = load_user_state(user_id, period=period_key, create_if_missing=False)
-        except FileNotFoundError:
-            continue
-        summary = _build_dashboard_summary(state)
-        items.append({
-            "period": summary.get("period"),
-            "label": summary.get("period_label"),
-            "total_spent": summary.get("total_spent"),
-            "total_budget": summary.get("total_budget"),
-            "available_amount": summary.get("available_amount"),
-            "expense_count": len(state.get("history", [])),
-            "is_current": summary.get("is_current_period", False),
-            "days_remaining": summary.get("days_remaining"),
-        })
-        if summary.get("period"):
-            seen.add(summary["period"])
+    rollups = {period_key: meta.get("rollup") for period_key, meta in PERIOD_MANIFEST.entries(user_id).items()}
 
     current_key = _current_period_key()
-    current_external = _period_key_to_external(current_key)
-    if current_external not in seen:
-        state = load_user_state(user_id, period=current_key, create_if_missing=True)
-        summary = _build_dashboard_summary(state)
-        items.insert(0, {
-            "period": summary.get("period"),
-            "label": summary.get("period_label"),
-            "total_spent": summary.get("total_spent"),
-            "total_budget": summary.get("total_budget"),
-            "available_amount": summary.get("available_amount"),
-            "expense_count": len(state.get("history", [])),
-            "is_current": summary.get("is_current_period", True),
-            "days_remaining": summary.get("days_remaining"),
-        })
+    if current_key not in rollups:
+        # not stored yet: list the period a first visit would create
+        rollups[current_key] = _period_rollup(load_user_state(user_id, period=current_key, create_if_missing=True))
 
-    items.sort(key=lambda item: item["period"], reverse=True)
+    items: List[Dict[str, Any]] = []
+    for period_key in sorted(rollups, reverse=True):
+        rollup = rollups[period_key]
+        if rollup is None:
+            # manifest entry written before rollups existed: backfill it once
+            try:
+                state = load_user_state(user_id, period=period_key, create_if_missing=False)
+            except FileNotFoundError:
+                continue
+            _record_in_manifest(state, user_id, period_key)
+            rollup = _period_rollup(state)
+        items.append(_period_list_item(period_key, rollup))
     return {"periods": items}
 
 
-@api.get("/period/{period}")
+@api.post("/periods/rebuild")
+async def rebuild_periods(request: Request):
+    user_id = _get_user_id(request)
+    # reads and describes every stored period: keep it off the event loop
+    counts = await run_in_threadpool(rebuild_period_rollups, [user_id])
+    return {"ok": True, "user_id": user_id, "periods": counts.get(user_id, 0)}
+
+
+@api.get("/period/{period}", response_class=StateResponse)
 async def get_period(period: str, request: Request):
     state = _load_state_for_request(request, period, allow_create=False)
-    summary = _build_dashboard_summary(state)
-    return {
+    packed = wants_msgpack(request.headers.get("accept"))
+    etag = _state_etag(state, "mp" if packed else "")
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        cached.headers["Vary"] = "Accept"
+        return cached
+    summary = _dashboard_summary(state)
+    response = _state_response({
         "summary": summary,
         "state": _state_public(state),
-    }
+    }, state, packed)
+    response.headers.update(_conditional_headers(etag))
+    return response
 
 
 @api.get("/dashboard_summary")
-async def dashboard_summary(request: Request, period: Optional[str] = Query(None)):
+async def dashboard_summary(request: Request, response: Response, period: Optional[str] = Query(None)):
     state = _load_state_for_request(request, period, allow_create=True)
-    summary = _build_dashboard_summary(state)
+    etag = _state_etag(state)
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        return cached
+    summary = _dashboard_summary(state)
+    response.headers.update(_conditional_headers(etag))
     return summary
 
 
 @api.get("/safe_to_spend")
 async def safe_to_spend(request: Request, period: Optional[str] = Query(None)):
     state = _load_state_for_request(request, period, allow_create=True)
-    summary = _build_dashboard_summary(state)
+    summary = _dashboard_summary(state)
     return _build_safe_to_spend(summary)
 
 
 @api.get("/category_analysis/{category_name}")
 async def category_analysis(category_name: str, request: Request, period: Optional[str] = Query(None)):
     state = _load_state_for_request(request, period, allow_create=True)
-    return _build_category_analysis(state, category_name)
+    avg_recent = await run_in_threadpool(
+        _analytics_recent_average,
+        state.get("user_id", "default"),
+        _normalize_category(category_name),
+        _category_recent_cut(datetime.now()),
+    )
+    return _build_category_analysis(state, category_name, avg_recent)
+
+
+def _parse_range_param(value: Optional[str], name: str) -> Optional[datetime]:
+    if value is None:
+        return None
+    parsed = parse_timestamp(value)
+    if parsed is None:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: expected an ISO date")
+    return parsed
+
+
+def _analytics_frame(request: Request) -> analytics.ExpenseFrame:
+    try:
+        return ANALYTICS.frame(_get_user_id(request))
+    except AnalyticsUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+
+
+@api.get("/analytics/range")
+async def analytics_range(request: Request, start: Optional[str] = Query(None), end: Optional[str] = Query(None), category: Optional[str] = Query(None)):
+    start_at, end_at = _parse_range_param(start, "start"), _parse_range_param(end, "end")
+    cat_id = _normalize_category(category) if category else None
+    frame = _analytics_frame(request).window(start_at, end_at, cat_id)
+    return {"start": start, "end": end, "category": cat_id, **analytics.range_totals(frame)}
+
+
+@api.get("/analytics/group/{by}")
+async def analytics_group(
+    by: str,
+    request: Request,
+    start: Optional[str] = Query(None),
+    end: Optional[str] = Query(None),
+    category: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+):
+    if by not in analytics.GROUP_KEYS:
+        raise HTTPException(status_code=400, detail=f"Group by one of: {', '.join(analytics.GROUP_KEYS)}")
+    start_at, end_at = _parse_range_param(start, "start"), _parse_range_param(end, "end")
+    cat_id = _normalize_category(category) if category else None
+    frame = _analytics_frame(request).window(start_at, end_at, cat_id)
+    return {"by": by, "start": start, "end": end, "category": cat_id, "items": analytics.group_totals(frame, by, limit)}
+
+
+@api.get("/analytics/monthly")
+async def analytics_monthly(request: Request, months: int = Query(12, ge=1, le=120), category: Optional[str] = Query(None)):
+    """Spend per category per month for the last ``months`` months (the current one included)."""
+    current_start, end_at = _period_start_end(_current_period_key())
+    start_at = current_start
+    for _ in range(months - 1):
+        start_at = _period_start_end(_previous_period_key(_month_key(start_at)))[0]
+    cat_id = _normalize_category(category) if category else None
+    frame = _analytics_frame(request).window(start_at, end_at, cat_id)
+    return analytics.monthly_by_category(frame, start_at, end_at)
+
+
+@api.get("/analytics/rolling")
+async def analytics_rolling(
+    request: Request,
+    days: int = Query(90, ge=1, le=730),
+    window: int = Query(30, ge=1, le=365),
+    category: Optional[str] = Query(None),
+):
+    """Daily spend for the last ``days`` days with a trailing ``window``-day average."""
+    end_at = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    start_at = end_at - timedelta(days=days)
+    cat_id = _normalize_category(category) if category else None
+    series = analytics.rolling_daily(_analytics_frame(request), start_at, end_at, window, cat_id)
+    return {"days": days, "window": window, "category": cat_id, "items": series}
+
+
+EXPORT_COLUMNS = ("id", "type", "period", "timestamp", "amount", "category", "merchant", "description", "source")
+
+
+def _epoch_of(value: Optional[str]) -> Optional[float]:
+    parsed = parse_timestamp(value)
+    if parsed is None:
+        return None
+    try:
+        return parsed.timestamp()
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def _export_rows(
+    user_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    category: Optional[str] = None,
+    entry_type: Optional[str] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yield the user's entries oldest period first, reading one stored period at a time.
+
+    Rows are read from the backend rather than load_user_state so an export
+    neither refreshes every month nor evicts hot states from STATE_CACHE.
+    Undated rows are only exported when no date range is given.
+    """
+    start_epoch = start.timestamp() if start else None
+    end_epoch = end.timestamp() if end else None
+    for period_key in PERIOD_MANIFEST.periods(user_id):
+        raw = STATE_BACKEND.load(user_id, period_key)
+        if raw is None:
+            continue
+        state = _ensure_state_schema(raw, user_id)
+        period = _period_key_to_external(period_key)
+        seen = set()
+        rows: List[Tuple[float, str, Dict[str, Any]]] = []
+        # income rows may sit in both "incomes" and "history" under one id
+        for entry in chain(state.get("history", []), state.get("incomes", [])):
+            if not isinstance(entry, dict):
+                continue
+            entry_id = str(entry.get("id") or "")
+            if entry_id:
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+            kind = entry.get("type") or "expense"
+            if entry_type and kind != entry_type:
+                continue
+            if category and (kind != "expense" or (entry.get("category") or "other") != category):
+                continue
+            epoch = _epoch_of(entry.get("timestamp"))
+            if start_epoch is not None or end_epoch is not None:
+                if epoch is None:
+                    continue
+                if (start_epoch is not None and epoch < start_epoch) or (end_epoch is not None and epoch >= end_epoch):
+                    continue
+            rows.append((UNDATED_EPOCH if epoch is None else epoch, entry_id, {
+                "id": entry_id,
+                "type": kind,
+                "period": period,
+                "timestamp": entry.get("timestamp"),
+                "amount": round(float(entry.get("amount", 0.0) or 0.0), 2),
+                "category": (entry.get("category") or "other") if kind == "expense" else None,
+                "merchant": entry.get("merchant") or "",
+                "description": entry.get("description") or "",
+                "source": entry.get("source") if kind == "income" else None,
+            }))
+        del state, raw, seen
+        rows.sort(key=lambda item: (item[0], item[1]))
+        for _, _, row in rows:
+            yield row
+
+
+def _ndjson_chunks(rows: Iterator[Dict[str, Any]]) -> Iterator[bytes]:
+    while True:
+        batch = list(islice(rows, EXPORT_CHUNK_ROWS))
+        if not batch:
+            return
+        yield b"".join(dumps(row) + b"\n" for row in batch)
+
+
+def _msgpack_chunks(rows: Iterator[Dict[str, Any]]) -> Iterator[bytes]:
+    while True:
+        batch = list(islice(rows, EXPORT_CHUNK_ROWS))
+        if not batch:
+            return
+        yield b"".join(packb(row) for row in batch)
+
+
+def _csv_chunks(rows: Iterator[Dict[str, Any]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    while True:
+        batch = list(islice(rows, EXPORT_CHUNK_ROWS))
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+        if not batch:
+            return
+        buffer.seek(0)
+        buffer.truncate()
+
+
+@api.get("/export")
+async def export_entries(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv|msgpack)$"),
+    start: Optional[str] = Query(None),
+    end: Optional[str] = Query(None),
+    category: Optional[str] = Query(None),
+    type: Optional[str] = Query(None, pattern="^(expense|income)$"),
+):
+    """Stream every expense/income of the user across all stored periods as NDJSON, CSV or MessagePack.
+
+    Without ``format`` the Accept header picks MessagePack (a sequence of
+    packed row maps) when the server can encode it, NDJSON otherwise.
+    """
+    format = format or ("msgpack" if wants_msgpack(request.headers.get("accept")) else "ndjson")
+    if format == "msgpack" and msgpack is None:
+        raise HTTPException(status_code=406, detail="MessagePack export needs the msgpack package")
+    user_id = _get_user_id(request)
+    start_at, end_at = _parse_range_param(start, "start"), _parse_range_param(end, "end")
+    cat_id = _normalize_category(category) if category else None
+    rows = _export_rows(user_id, start_at, end_at, cat_id, type)
+    # sync generators run in the threadpool, so period files are read off the event loop
+    if format == "csv":
+        body, media_type = _csv_chunks(rows), "text/csv; charset=utf-8"
+    elif format == "msgpack":
+        body, media_type = _msgpack_chunks(rows), "application/msgpack"
+    else:
+        body, media_type = _ndjson_chunks(rows), "application/x-ndjson"
+    filename = f"xubudget-{re.sub(r'[^A-Za-z0-9_-]', '_', user_id)}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Vary": "Accept"}
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+
+@api.get("/metrics")
+async def response_metrics(reset: bool = Query(False)):
+    """Per-route response sizes (raw vs. sent), encode and compression times, chat latencies and cache counters."""
+    routes = RESPONSE_METRICS.snapshot()
+    latency = CHAT_METRICS.snapshot()
+    chat_cache = CHAT_CACHE.stats()
+    if reset:
+        RESPONSE_METRICS.reset()
+        CHAT_METRICS.reset()
+        CHAT_CACHE.reset_stats()
+    return {
+        "encodings": {"gzip": True, "brotli": brotli is not None, "msgpack": msgpack is not None},
+        "compress_min_bytes": COMPRESS_MIN_BYTES,
+        "routes": routes,
+        "latency": latency,
+        "chat_cache": chat_cache,
+    }
 
 
 @api.get("/daily_briefing")
 async def daily_briefing(request: Request):
     user_id = _get_user_id(request)
     state = load_user_state(user_id)
-    summary = _build_dashboard_summary(state)
+    summary = _dashboard_summary(state)
     text = _build_daily_briefing(summary)
     return {"date": datetime.now().strftime("%Y-%m-%d"), "text": text}
 
@@ -1536,72 +2775,167 @@ async def list_goals(request: Request, period: Optional[str] = Query(None)):
     return {"items": state.get("goals", [])}
 
 
-@api.post("/goals")
-async def create_goal(payload: GoalCreateRequest):
+@api.post("/goals", response_class=StateResponse)
+async def create_goal(payload: GoalCreateRequest, request: Request):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    goal = {
-        "id": str(uuid4()),
-        "name": payload.name,
-        "target_amount": float(payload.target_amount),
-        "saved_amount": float(payload.saved_amount or 0.0),
-        "status": payload.status or "active",
-        "created_at": datetime.now().isoformat(),
-    }
-    state.setdefault("goals", []).append(goal)
-    save_user_state(state)
-    return {"status": "ok", "goal": goal, "state": _state_public(state)}
+    async with state_transaction_async(user_id) as state:
+        goal = _add_goal(state, payload)
+    return _mutation_response(request, {"status": "ok", "goal": goal, "state": _state_public(state)}, state)
 
 
-@api.patch("/goals/{goal_id}")
-async def update_goal(goal_id: str, payload: GoalUpdateRequest):
+@api.patch("/goals/{goal_id}", response_class=StateResponse)
+async def update_goal(goal_id: str, payload: GoalUpdateRequest, request: Request):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    goals = state.setdefault("goals", [])
-    goal = next((g for g in goals if g.get("id") == goal_id), None)
-    if not goal:
-        raise HTTPException(status_code=404, detail="Goal not found")
+    async with state_transaction_async(user_id) as state:
+        goal = _update_goal(state, goal_id, payload)
+        if not goal:
+            raise HTTPException(status_code=404, detail="Goal not found")
+    return _mutation_response(request, {"status": "ok", "goal": goal, "state": _state_public(state)}, state)
 
-    if payload.name is not None:
-        goal["name"] = payload.name
-    if payload.target_amount is not None:
-        goal["target_amount"] = float(payload.target_amount)
-    if payload.saved_amount is not None:
-        goal["saved_amount"] = float(payload.saved_amount)
-    if payload.status is not None:
-        goal["status"] = payload.status
-
-    save_user_state(state)
-    return {"status": "ok", "goal": goal, "state": _state_public(state)}
 
-
-@api.delete("/goals/{goal_id}")
-async def delete_goal(goal_id: str, user_id: str = Query("default", alias="user_id")):
-    state = load_user_state(user_id)
-    goals = state.get("goals", [])
-    new_goals = [g for g in goals if g.get("id") != goal_id]
-    if len(new_goals) == len(goals):
-        raise HTTPException(status_code=404, detail="Goal not found")
-    state["goals"] = new_goals
-    save_user_state(state)
-    return {"status": "ok", "goal_id": goal_id, "state": _state_public(state)}
+@api.delete("/goals/{goal_id}", response_class=StateResponse)
+async def delete_goal(goal_id: str, request: Request, user_id: str = Query("default", alias="user_id")):
+    async with state_transaction_async(user_id) as state:
+        if not _delete_goal(state, goal_id):
+            raise HTTPException(status_code=404, detail="Goal not found")
+    return _mutation_response(request, {"status": "ok", "goal_id": goal_id, "state": _state_public(state)}, state)
 
 
 @api.post("/expense/reclassify")
 async def reclassify_expense(payload: ReclassifyRequest):
     user_id = payload.user_id or "default"
-    state = load_user_state(user_id)
-    target = None
-    for entry in state.get("history", []):
-        if entry.get("id") == payload.expense_id:
-            target = entry
-            break
-    if not target:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    target["category"] = _normalize_category(payload.new_category)
-    _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "expense": {"id": target["id"], "category": target["category"]}}
+    async with state_transaction_async(user_id) as state:
+        target = _reclassify_expense(state, payload.expense_id, payload.new_category)
+        if not target:
+            raise HTTPException(status_code=404, detail="Expense not found")
+        return {"status": "ok", "expense": {"id": target["id"], "category": target["category"]}}
+
+
+BATCH_OPERATIONS = (
+    "add_expense", "update_expense", "delete_expense", "reclassify",
+    "add_income", "update_income", "delete_income",
+    "add_goal", "update_goal", "delete_goal",
+    "set_budget", "set_category_budget",
+)
+
+
+def _apply_batch_operation(state: Dict[str, Any], op: BatchOperation) -> Dict[str, Any]:
+    """Apply one /batch operation without refreshing the budget totals; errors raise HTTPException."""
+    name, data = op.op, op.data
+    if name not in BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown operation: {name}")
+    if name.startswith(("update_", "delete_")) or name == "reclassify":
+        if not op.id:
+            raise HTTPException(status_code=400, detail=f"{name} needs an id")
+
+    if name == "add_expense":
+        payload = AddExpenseRequest(**data)
+        expense = _add_expense(
+            state,
+            amount=payload.amount,
+            description=payload.description,
+            category=payload.subcategory or payload.category,
+            timestamp=payload.timestamp,
+            merchant=payload.merchant,
+            refresh_totals=False,
+        )
+        return {"id": expense["id"], "expense": expense}
+    if name == "update_expense":
+        entry = _update_expense(state, op.id, UpdateExpenseRequest(**data), refresh_totals=False)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Expense not found")
+        return {"id": op.id, "expense": _expense_public(entry)}
+    if name == "delete_expense":
+        if not _delete_expense(state, op.id, refresh_totals=False):
+            raise HTTPException(status_code=404, detail="Expense not found")
+        return {"id": op.id}
+    if name == "reclassify":
+        category = data.get("new_category") or data.get("category")
+        if not category:
+            raise HTTPException(status_code=400, detail="reclassify needs a category")
+        entry = _reclassify_expense(state, op.id, str(category), refresh_totals=False)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Expense not found")
+        return {"id": op.id, "category": entry["category"]}
+    if name == "add_income":
+        payload = AddIncomeRequest(**data)
+        income = _add_income(state, payload.amount, payload.source, payload.timestamp)
+        return {"id": income["id"], "income": income}
+    if name == "update_income":
+        entry = _update_income(state, op.id, UpdateIncomeRequest(**data), refresh_totals=False)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Income not found")
+        return {"id": op.id, "income": _income_public(entry)}
+    if name == "delete_income":
+        if not _delete_income(state, op.id, refresh_totals=False):
+            raise HTTPException(status_code=404, detail="Income not found")
+        return {"id": op.id}
+    if name == "add_goal":
+        goal = _add_goal(state, GoalCreateRequest(**data))
+        return {"id": goal["id"], "goal": goal}
+    if name == "update_goal":
+        goal = _update_goal(state, op.id, GoalUpdateRequest(**data))
+        if not goal:
+            raise HTTPException(status_code=404, detail="Goal not found")
+        return {"id": op.id, "goal": goal}
+    if name == "delete_goal":
+        if not _delete_goal(state, op.id):
+            raise HTTPException(status_code=404, detail="Goal not found")
+        return {"id": op.id}
+    if name == "set_budget":
+        state["budget"] = float(SetBudgetRequest(**data).budget)
+        _track_field(state, "budget")
+        return {"budget": state["budget"]}
+    payload = SetCategoryBudgetRequest(**data)
+    return {"category_id": _set_category_budget(state, payload.category_id, payload.budget), "budget": float(payload.budget)}
+
+
+@api.post("/batch", response_class=StateResponse)
+async def batch(payload: BatchRequest, request: Request):
+    """Apply an ordered list of mutations to one period in a single transaction.
+
+    Totals are refreshed and the state saved once for the whole list. Failed
+    operations are reported per index; with ``atomic`` the first failure
+    discards every change and the request fails.
+    """
+    user_id = payload.user_id or "default"
+    if len(payload.operations) > BATCH_MAX_OPS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_OPS} operations per batch")
+    try:
+        period_key = _resolve_period_key(payload.period)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    async with state_transaction_async(user_id, period=period_key) as state:
+        results: List[Dict[str, Any]] = []
+        failed = 0
+        for index, op in enumerate(payload.operations):
+            try:
+                result = _apply_batch_operation(state, op)
+            except HTTPException as exc:
+                code, detail = exc.status_code, exc.detail
+            except ValidationError as exc:
+                code, detail = 422, exc.errors(include_url=False, include_context=False)
+            except (TypeError, ValueError) as exc:
+                code, detail = 400, str(exc)
+            else:
+                results.append({"index": index, "op": op.op, "status": "ok", **result})
+                continue
+            failed += 1
+            results.append({"index": index, "op": op.op, "status": "error", "code": code, "detail": detail})
+            if payload.atomic:
+                # raising inside the transaction drops the half-applied state unsaved
+                raise HTTPException(status_code=code, detail={"failed_index": index, "results": results})
+
+        _refresh_budget_totals(state)
+        content = {
+            "status": "ok" if not failed else "partial",
+            "applied": len(results) - failed,
+            "failed": failed,
+            "results": results,
+            "state": _state_public(state),
+        }
+    return _mutation_response(request, content, state)
 
 
 def _parse_amount(text: str) -> Optional[float]:
@@ -1615,8 +2949,7 @@ def _parse_amount(text: str) -> Optional[float]:
         return None
 
 
-def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
-    state = load_user_state(user_id)
+async def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
     lower = text.lower()
     amount = _parse_amount(lower)
 
@@ -1631,8 +2964,10 @@ def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
             "status": "active",
             "created_at": datetime.now().isoformat(),
         }
-        state.setdefault("goals", []).append(goal)
-        save_user_state(state)
+        async with state_transaction_async(user_id) as state:
+            goals = state.setdefault("goals", [])
+            goals.append(goal)
+            _track_row(state, "goals", goal, index=len(goals) - 1)
         return {"type": "create_goal", "reply": f"Goal created: {goal['name']} ({goal['target_amount']:.2f})", "goal": goal}
 
     if any(keyword in lower for keyword in ["spent", "spend", "expense", "bought", "paid"]):
@@ -1640,7 +2975,8 @@ def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
             raise HTTPException(status_code=400, detail="I didn't understand the expense amount")
         match = re.search(r"(?:on|em) ([a-zA-ZA-y\s]+)", text)
         category = match.group(1) if match else "other"
-        expense = _add_expense(state, amount, text, category)
+        async with state_transaction_async(user_id) as state:
+            expense = _add_expense(state, amount, text, category)
         return {
             "type": "add_expense",
             "reply": f"Expense of {amount:.2f} recorded in {expense['category_name']}",
@@ -1650,7 +2986,8 @@ def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
     if any(keyword in lower for keyword in ["income", "received", "earned", "salary"]):
         if not amount:
             raise HTTPException(status_code=400, detail="I didn't understand the income amount")
-        income = _add_income(state, amount, text)
+        async with state_transaction_async(user_id) as state:
+            income = _add_income(state, amount, text)
         return {
             "type": "add_income",
             "reply": f"Income of {amount:.2f} recorded.",
@@ -1663,7 +3000,7 @@ def _handle_intent(user_id: str, text: str) -> Dict[str, Any]:
 @api.post("/intent")
 async def intent_endpoint(payload: IntentRequest):
     user_id = payload.user_id or "default"
-    result = _handle_intent(user_id, payload.text)
+    result = await _handle_intent(user_id, payload.text)
     return result
 
 @api.get("/ai/rules")
@@ -1678,35 +3015,33 @@ async def learn_merchant_category(payload: MerchantLearnRequest):
     if not normalized_merchant:
         raise HTTPException(status_code=400, detail="Merchant name cannot be empty")
     category_id = _normalize_category(payload.category)
-    state = load_user_state(user_id)
-    state.setdefault("merchant_rules", {})[normalized_merchant] = category_id
+    async with state_transaction_async(user_id) as state:
+        state.setdefault("merchant_rules", {})[normalized_merchant] = category_id
+        _track_key(state, "merchant_rules", normalized_merchant)
 
-    updated = 0
-    for entry in state.get("history", []):
-        if entry.get("type") != "expense":
-            continue
-        entry_merchant = _normalize_merchant_name(entry.get("merchant") or entry.get("description"))
-        if entry_merchant == normalized_merchant:
-            entry["category"] = category_id
-            updated += 1
+        updated = 0
+        for entry in state.get("history", []):
+            if entry.get("type") != "expense":
+                continue
+            entry_merchant = _normalize_merchant_name(entry.get("merchant") or entry.get("description"))
+            if entry_merchant == normalized_merchant:
+                before = dict(entry)
+                entry["category"] = category_id
+                _track_row(state, "history", entry)
+                _apply_history_delta(state, before, entry)
+                updated += 1
 
-    if updated:
-        _refresh_financials(state)
-    save_user_state(state)
-    return {"status": "ok", "merchant": normalized_merchant, "category": category_id, "updated": updated}
+        return {"status": "ok", "merchant": normalized_merchant, "category": category_id, "updated": updated}
 
 
 
 
 
 # --- Ollama helpers ---
-def check_ollama() -> bool:
-    """Check if Ollama is running"""
-    try:
-        r = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=3)
-        return r.status_code == 200
-    except Exception:
-        return False
+async def check_ollama() -> bool:
+    """Cached Ollama status; False while the circuit is open (server or model down)."""
+    await OLLAMA_HEALTH.ensure_fresh()
+    return OLLAMA_HEALTH.allow()
 
 
 FALLBACK_RULES = [
@@ -1747,22 +3082,117 @@ def fallback_response(prompt: str) -> str:
     return "I understand! Check the dashboard for detailed information. How else can I help you with your budget?"
 
 
-def chat_ollama(prompt: str, user_id: str = "default", state: Optional[Dict[str, Any]] = None) -> str:
-    """Chat with Ollama, enriched with state, memory and RAG context"""
+async def chat_ollama(
+    prompt: str,
+    user_id: str = "default",
+    state: Optional[Dict[str, Any]] = None,
+    cache_key: Optional[ChatKey] = None,
+) -> str:
+    """Chat with Ollama, enriched with state, memory and RAG context; a model reply is stored under ``cache_key``"""
     if not prompt:
         return "I need a message to help."
 
-    if not check_ollama():
-        logger.warning("Ollama offline, using fallback")
+    if not await check_ollama():
+        logger.warning("Ollama unavailable (%s), using fallback", OLLAMA_HEALTH.error or "model not installed")
         return fallback_response(prompt)
 
+    full_prompt = _build_chat_prompt(prompt, user_id, state)
+    started = time.perf_counter()
+    try:
+        data = await OLLAMA.generate(full_prompt, options=CHAT_OPTIONS)
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        # the server went away between probes: open the circuit until the monitor sees it again
+        OLLAMA_HEALTH.record_failure(e)
+        logger.error("Ollama unreachable: %s", e)
+        return fallback_response(prompt)
+    except Exception as e:
+        logger.error("Ollama error: %s", e)
+        return fallback_response(prompt)
+    OLLAMA_HEALTH.record_success()
+    CHAT_METRICS.record("generate_ms", (time.perf_counter() - started) * 1000)
+    _record_prefill(data)
+    reply = data.get("response") or data.get("text")
+    if not reply:
+        return fallback_response(prompt)
+    if cache_key is not None:
+        CHAT_CACHE.put(cache_key, reply)
+    return reply
+
+
+async def chat_ollama_stream(
+    prompt: str,
+    user_id: str = "default",
+    state: Optional[Dict[str, Any]] = None,
+    cache_key: Optional[ChatKey] = None,
+) -> AsyncIterator[str]:
+    """Like chat_ollama, but yields the reply piece by piece as Ollama generates it.
+
+    Fallback text comes as a single piece. A failure after the first token
+    raises OllamaError once the partial reply has been yielded; only
+    complete replies are cached.
+    """
+    if not prompt:
+        yield "I need a message to help."
+        return
+
+    if not await check_ollama():
+        logger.warning("Ollama unavailable (%s), using fallback", OLLAMA_HEALTH.error or "model not installed")
+        yield fallback_response(prompt)
+        return
+
+    full_prompt = _build_chat_prompt(prompt, user_id, state)
+    started = time.perf_counter()
+    pieces: List[str] = []
+    error: Optional[Exception] = None
+    try:
+        async for chunk in OLLAMA.generate_stream(full_prompt, options=CHAT_OPTIONS):
+            if chunk.get("done"):
+                _record_prefill(chunk)
+            text = chunk.get("response") or ""
+            if not text:
+                continue
+            if not pieces:
+                CHAT_METRICS.record("ttft_ms", (time.perf_counter() - started) * 1000)
+            pieces.append(text)
+            yield text
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        OLLAMA_HEALTH.record_failure(e)
+        logger.error("Ollama unreachable: %s", e)
+        error = e
+    except Exception as e:
+        logger.error("Ollama stream error: %s", e)
+        error = e
+    else:
+        OLLAMA_HEALTH.record_success()
+        CHAT_METRICS.record("stream_ms", (time.perf_counter() - started) * 1000)
+        if pieces and cache_key is not None:
+            CHAT_CACHE.put(cache_key, "".join(pieces))
+    if not pieces:
+        yield fallback_response(prompt)
+    elif error is not None:
+        raise OllamaError(f"reply cut off: {type(error).__name__}: {error}") from error
+
+
+def _record_prefill(data: Dict[str, Any]) -> None:
+    """Prompt evaluation time of a finished generation (shrinks when Ollama reuses the cached prefix)."""
+    if data.get("prompt_eval_duration"):
+        CHAT_METRICS.record("prefill_ms", data["prompt_eval_duration"] / 1e6)
+
+
+def _build_chat_prompt(prompt: str, user_id: str, state: Optional[Dict[str, Any]]) -> str:
+    """System prompt plus state, memory and RAG context for one chat message.
+
+    BASE_SYSTEM_PROMPT comes first and never changes, so Ollama can reuse its
+    evaluated prefix across requests; everything that varies (date, period,
+    snapshot, notes, RAG hits, the message) follows it, least volatile first.
+    """
     context_sections: List[str] = []
     summary: Optional[Dict[str, Any]] = None
     formatter = None
 
     if state:
         try:
-            summary = _build_dashboard_summary(state)
+            summary = _dashboard_summary(state)
             currency_code = (summary.get("currency") or state.get("currency") or "USD").upper()
             symbol_map = {"USD": "$", "CAD": "$", "BRL": "R$", "EUR": "\u20ac", "GBP": "\u00a3"}
             currency_symbol = symbol_map.get(currency_code)
@@ -1849,71 +3279,171 @@ def chat_ollama(prompt: str, user_id: str = "default", state: Optional[Dict[str,
         current_key = _current_period_key()
         temporal_lines.append(f"- Current period: {_format_period_label(current_key)} ({_period_key_to_external(current_key)})")
 
-    system_context = "CURRENT CONTEXT:\n" + "\n".join(temporal_lines)
-    system = f"{system_context}\n\n{BASE_SYSTEM_PROMPT}"
-    prompt_parts = [system, ""]
+    prompt_parts = ["CURRENT CONTEXT:\n" + "\n".join(temporal_lines)]
     if context_block:
         prompt_parts.append("Context:")
         prompt_parts.append(context_block)
     prompt_parts.append(f"User: {prompt}")
     prompt_parts.append("Xuzinha:")
-    full_prompt = "\n".join(part for part in prompt_parts if part)
+    return BASE_SYSTEM_PROMPT + "\n".join(part for part in prompt_parts if part)
 
-    try:
-        r = requests.post(
-            f"{OLLAMA_HOST}/api/generate",
-            json={
-                "model": OLLAMA_MODEL,
-                "prompt": full_prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "num_predict": 200
-                }
-            },
-            timeout=OLLAMA_TIMEOUT
-        )
-        r.raise_for_status()
-        data = r.json()
-        return data.get("response") or data.get("text") or fallback_response(prompt)
-    except Exception as e:
-        logger.error("Ollama error: %s", e)
-        return fallback_response(prompt)
 
+BENCH_QUESTIONS = (
+    "How much can I still spend this month?",
+    "Am I over budget on groceries?",
+    "What's my balance?",
+    "Give me one tip to save money this week.",
+)
 
-@api.post("/chat")
-async def chat_endpoint(payload: ChatRequest, request: Request):
+
+async def benchmark_prefill(user_id: str = "default", rounds: int = 5) -> Dict[str, Any]:
+    """Prefill time of chat prompts with the shared prefix ("reuse") and with it displaced ("cold").
+
+    Every request asks a different question and generates a single token, so
+    the timings are prompt evaluation. "cold" puts a unique line in front of
+    the system prompt, as the old context-first layout did, which defeats
+    Ollama's prompt cache. Each mode starts with one uncounted warm-up call.
+    """
+    if not await OLLAMA_HEALTH.check() or not OLLAMA_HEALTH.allow():
+        raise RuntimeError(f"Ollama unavailable: {OLLAMA_HEALTH.error or 'model not installed'}")
+    state = load_user_state(user_id)
+    options = {**CHAT_OPTIONS, "num_predict": 1}
+    results: Dict[str, Any] = {"model": OLLAMA.model, "rounds": rounds, "keep_alive": OLLAMA.keep_alive}
+    for mode in ("cold", "reuse"):
+        samples: List[Dict[str, Any]] = []
+        for run in range(rounds + 1):
+            question = f"{BENCH_QUESTIONS[run % len(BENCH_QUESTIONS)]} ({mode} {run})"
+            prompt = _build_chat_prompt(question, user_id, state)
+            if mode == "cold":
+                prompt = f"[benchmark request {uuid4().hex}]\n{prompt}"
+            data = await OLLAMA.generate(prompt, options=options)
+            if run:
+                samples.append(data)
+        prefill = sorted(item.get("prompt_eval_duration", 0) / 1e6 for item in samples)
+        results[mode] = {
+            "avg_prefill_ms": round(sum(prefill) / len(prefill), 1),
+            "p50_prefill_ms": round(prefill[len(prefill) // 2], 1),
+            "avg_evaluated_tokens": round(sum(item.get("prompt_eval_count", 0) for item in samples) / len(samples), 1),
+            "avg_total_ms": round(sum(item.get("total_duration", 0) for item in samples) / len(samples) / 1e6, 1),
+        }
+    if results["reuse"]["avg_prefill_ms"]:
+        results["speedup"] = round(results["cold"]["avg_prefill_ms"] / results["reuse"]["avg_prefill_ms"], 2)
+    return results
+
+
+async def _chat_prelude(payload: ChatRequest, request: Request) -> Tuple[str, Dict[str, Any], str, Optional[Dict[str, Any]]]:
+    """Everything before the model call: (user_id, state, message, reply when no model call is needed)."""
     user_id = payload.user_id or _get_user_id(request)
     state = load_user_state(user_id)
 
     message = (payload.message or "").strip()
     if is_recent_duplicate(user_id, message):
-        return {"response": "That message already came through recently. All good!", "state": _state_public(state), "duplicate": True}
+        return user_id, state, message, {"response": "That message already came through recently. All good!", "state": _state_public(state), "duplicate": True}
 
     lower = message.lower()
     if any(trigger in lower for trigger in ["lembra", "lembre", "lembrete", "nota", "memoriza"]):
         MEMORY_STORE.add(user_id, message, tags=["note"], ts=datetime.now().isoformat())
+        CHAT_CACHE.invalidate_user(user_id)
 
     # Try to handle as intent first
     try:
-        intent_result = _handle_intent(user_id, message)
+        intent_result = await _handle_intent(user_id, message)
         if intent_result.get("type") in ["add_expense", "add_income", "create_goal"]:
-            return {"response": intent_result.get("reply", ""), "spoken": intent_result.get("reply", ""), "state": _state_public(state), "intent_handled": True}
+            return user_id, state, message, {"response": intent_result.get("reply", ""), "spoken": intent_result.get("reply", ""), "state": _state_public(state), "intent_handled": True}
     except Exception as e:
         print(f"Intent handling failed: {e}")
-    
-    reply = chat_ollama(message, user_id=user_id, state=state)
+    return user_id, state, message, None
+
+
+def _chat_cache_key(user_id: str, state: Dict[str, Any], message: str, request: Request) -> ChatKey:
+    """(user, state version, normalized message, language); the prompt also carries today's date."""
+    version = (state.get("period"), state.get("revision", 0), datetime.now().date().isoformat())
+    language = request.headers.get("accept-language", "").split(",")[0].split(";")[0].split("-")[0].strip().lower()
+    return user_id, version, normalize_message(message), language or "en"
+
+
+async def _chat_reply(payload: ChatRequest, request: Request) -> Dict[str, Any]:
+    user_id, state, message, early = await _chat_prelude(payload, request)
+    if early is not None:
+        return early
+    cache_key = _chat_cache_key(user_id, state, message, request)
+    reply = CHAT_CACHE.get(cache_key)
+    if reply is not None:
+        return {"response": reply, "spoken": reply, "state": _state_public(state), "cached": True}
+    reply = await chat_ollama(message, user_id=user_id, state=state, cache_key=cache_key)
     return {"response": reply, "spoken": reply, "state": _state_public(state)}
 
 
-@api.post("/chat_legacy")
+@api.post("/chat", response_class=StateResponse)
+async def chat_endpoint(payload: ChatRequest, request: Request):
+    return StateResponse(await _chat_reply(payload, request))
+
+
+@api.post("/chat/stream")
+async def chat_stream(payload: ChatRequest, request: Request):
+    """Server-Sent Events variant of /chat: "token" events as the reply is generated, then "done".
+
+    "done" carries the full reply, the state after any intent it triggered,
+    and the time to the first token. Intents, cached replies and fallbacks
+    arrive as one token. A reply cut off mid-stream is followed by an "error"
+    event and "done" has "truncated": true.
+    """
+    started = time.perf_counter()
+    user_id, state, message, early = await _chat_prelude(payload, request)
+    cache_key = None
+    if early is None:
+        cache_key = _chat_cache_key(user_id, state, message, request)
+        cached = CHAT_CACHE.get(cache_key)
+        if cached is not None:
+            early = {"response": cached, "spoken": cached, "cached": True}
+
+    async def events():
+        first_token_ms: Optional[float] = None
+        error: Optional[str] = None
+        if early is not None:
+            pieces = [early["response"]]
+            first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+            yield format_event("token", {"text": early["response"]})
+        else:
+            pieces = []
+            try:
+                async for text in chat_ollama_stream(message, user_id=user_id, state=state, cache_key=cache_key):
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                    pieces.append(text)
+                    yield format_event("token", {"text": text})
+            except OllamaError as exc:
+                error = str(exc)
+                yield format_event("error", {"detail": error})
+        reply = "".join(pieces)
+        done = {key: value for key, value in (early or {}).items() if key != "state"}
+        done.update({
+            "response": reply,
+            "spoken": reply,
+            "state": _state_public(load_user_state(user_id)),
+            "first_token_ms": first_token_ms,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            "truncated": error is not None,
+        })
+        if error is not None:
+            done["error"] = error
+        yield format_event("done", done)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api.post("/chat_legacy", response_class=StateResponse)
 async def chat_legacy(payload: ChatRequest, request: Request):
-    result = await chat_endpoint(payload, request)
-    return {
+    result = await _chat_reply(payload, request)
+    return StateResponse({
         "reply": result.get("response"),
         "spoken": result.get("spoken", result.get("response")),
         "state": result.get("state"),
-    }
+    })
 
 
 
@@ -1927,12 +3457,14 @@ async def list_memory(request: Request):
 async def add_memory(payload: MemoryItemPayload):
     user_id = payload.user_id or "default"
     MEMORY_STORE.add(user_id, payload.text, tags=payload.tags or [], ts=datetime.now().isoformat())
+    CHAT_CACHE.invalidate_user(user_id)
     return {"status": "ok"}
 
 
 @api.post("/rag/add")
 async def rag_add(doc: RagDocPayload):
     RAG_INDEX.add_doc(doc.title, doc.text, meta=doc.meta or {})
+    CHAT_CACHE.clear()
     try:
         RAG_INDEX.save()
     except Exception as exc:
@@ -1957,8 +3489,8 @@ async def rag_search(q: str, k: int = 3):
 
 @api.get("/ollama_test")
 async def ollama_test():
-    online = check_ollama()
-    return {"status": "online" if online else "offline", "host": OLLAMA_HOST}
+    await OLLAMA_HEALTH.ensure_fresh()
+    return {**OLLAMA_HEALTH.status(), "host": OLLAMA_HOST}
 
 
 # Incluir router
@@ -1971,6 +3503,37 @@ if flutter_dir.exists():
 
 # Run
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=5002)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Xubudget assistant server")
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="regenerate every user's period manifest and rollups from storage, then exit",
+    )
+    parser.add_argument(
+        "--bench-prefill",
+        type=int,
+        metavar="ROUNDS",
+        help="time Ollama prompt prefill with and without the shared prompt prefix, then exit",
+    )
+    parser.add_argument("--user-id", default="default", help="state used to build the --bench-prefill prompts")
+    args = parser.parse_args()
+    if args.rebuild_rollups:
+        for user_id, count in rebuild_period_rollups().items():
+            print(f"{user_id}: {count} periods")
+    elif args.bench_prefill:
+        async def _bench() -> Dict[str, Any]:
+            try:
+                return await benchmark_prefill(args.user_id, max(1, args.bench_prefill))
+            finally:
+                await OLLAMA.aclose()
+
+        try:
+            print(json.dumps(asyncio.run(_bench()), indent=2))
+        except RuntimeError as exc:
+            parser.exit(1, f"{exc}\n")
+    else:
+        import uvicorn
+        uvicorn.run(app, host="127.0.0.1", port=5002)
 
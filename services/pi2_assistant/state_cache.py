@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# In-process LRU of hydrated user states keyed by (user_id, period).
+#
+# Each entry remembers the backend signature (file mtime/size for JSON, an
+# internal version counter for SQLite) it was loaded or saved with; a
+# different signature on lookup means someone else wrote the period and the
+# entry is dropped. Mutations happen on the cached dict itself, so after a
+# save only the signature needs refreshing.
+
+CacheKey = Tuple[str, str]
+
+
+class StateCache:
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[CacheKey, Tuple[Dict[str, Any], Optional[Hashable]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: CacheKey, signature: Optional[Hashable]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            state, cached_signature = entry
+            if cached_signature != signature:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return state
+
+    def put(self, key: CacheKey, state: Dict[str, Any], signature: Optional[Hashable]) -> None:
+        with self._lock:
+            self._entries[key] = (state, signature)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Optional[CacheKey] = None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Hashable, List, Optional
+
+
+class LockTimeout(TimeoutError):
+    """Raised when a keyed lock cannot be acquired within the timeout."""
+
+
+class KeyedLocks:
+    """Mutual exclusion per key (e.g. ``(user_id, period)``) for threads and coroutines.
+
+    Every key maps to a plain ``threading.Lock``. Threads block on it;
+    coroutines poll it with a short, growing sleep so the event loop keeps
+    serving other users and a cancelled waiter can never end up owning the
+    lock. Entries are reference counted and dropped once nobody holds or
+    waits for them, so the table only grows with concurrent keys.
+
+    The locks are not re-entrant: take them at the endpoint level only.
+    """
+
+    def __init__(self, poll_interval: float = 0.001, max_poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._guard = threading.Lock()
+        self._locks: Dict[Hashable, List] = {}  # key -> [lock, refcount]
+
+    def _checkout(self, key: Hashable) -> threading.Lock:
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, key: Hashable) -> None:
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._locks[key]
+
+    @contextmanager
+    def hold(self, key: Hashable, timeout: Optional[float] = None):
+        lock = self._checkout(key)
+        try:
+            if not lock.acquire(timeout=-1 if timeout is None else timeout):
+                raise LockTimeout(f"Timed out waiting for state lock {key!r}")
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._checkin(key)
+
+    @asynccontextmanager
+    async def hold_async(self, key: Hashable, timeout: Optional[float] = None):
+        lock = self._checkout(key)
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = None if timeout is None else loop.time() + timeout
+            delay = self.poll_interval
+            while not lock.acquire(blocking=False):
+                if deadline is not None and loop.time() >= deadline:
+                    raise LockTimeout(f"Timed out waiting for state lock {key!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._checkin(key)
+
+    def __len__(self) -> int:
+        with self._guard:
+            return len(self._locks)
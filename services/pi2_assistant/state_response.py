@@ -0,0 +1,184 @@
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+try:
+    import orjson
+except ImportError:  # stdlib encoder, same output
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # clients asking for MessagePack get JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# Response classes that encode user state straight to bytes.
+#
+# Endpoints wrap the state dict in PublicState instead of copying it; the
+# encoder projects it on the fly (top-level "_" keys are in-memory caches and
+# never leave the server), so a response is serialized exactly once. Build the
+# response while the state lock is held: rendering happens in the constructor.
+# StreamingStateResponse encodes everything but its streamed row lists in the
+# constructor too, and streams shallow copies of those rows, so the body never
+# reads the live state after the handler returns.
+# Single-body responses report their encode time in a Server-Timing header.
+
+
+class PublicState:
+    """Marker for a state dict that should be encoded without its "_" keys."""
+
+    __slots__ = ("state",)
+
+    def __init__(self, state: Dict[str, Any]):
+        self.state = state
+
+    def projection(self) -> Dict[str, Any]:
+        # shallow: values are encoded in place, nothing is deep-copied
+        return {k: v for k, v in self.state.items() if not k.startswith("_")}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return default if key.startswith("_") else self.state.get(key, default)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, PublicState):
+        return obj.projection()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def packb(content: Any) -> bytes:
+    return msgpack.packb(content, default=_default, use_bin_type=True)
+
+
+def _media_qualities(accept: str) -> Dict[str, float]:
+    """Media range -> q from an Accept header (a range listed twice keeps its highest q)."""
+    qualities: Dict[str, float] = {}
+    for part in accept.lower().split(","):
+        media, *params = (piece.strip() for piece in part.split(";"))
+        if not media:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[media] = max(quality, qualities.get(media, 0.0))
+    return qualities
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """True when Accept names MessagePack, ranked at least as high as JSON, and the encoder is installed.
+
+    Wildcards alone never select MessagePack; they only count toward JSON.
+    """
+    if msgpack is None or not accept:
+        return False
+    qualities = _media_qualities(accept)
+    packed = max((qualities.get(media, 0.0) for media in MSGPACK_MEDIA_TYPES), default=0.0)
+    if packed <= 0:
+        return False
+    for media in ("application/json", "application/*", "*/*"):
+        if media in qualities:
+            return packed >= qualities[media]
+    return True
+
+
+class _TimedRender:
+    encode_ms: Optional[float] = None
+
+    def init_headers(self, headers: Optional[Dict[str, str]] = None) -> None:
+        super().init_headers(headers)
+        if self.encode_ms is not None:
+            self.raw_headers.append((b"server-timing", b"encode;dur=%.2f" % self.encode_ms))
+
+
+class StateResponse(_TimedRender, JSONResponse):
+    """JSON response that understands PublicState values."""
+
+    def render(self, content: Any) -> bytes:
+        started = time.perf_counter()
+        body = dumps(content)
+        self.encode_ms = (time.perf_counter() - started) * 1000
+        return body
+
+
+class MsgpackResponse(_TimedRender, Response):
+    """MessagePack counterpart of StateResponse (same projection, binary encoding)."""
+
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        started = time.perf_counter()
+        body = packb(content)
+        self.encode_ms = (time.perf_counter() - started) * 1000
+        return body
+
+
+def negotiated_response(accept: Optional[str], content: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    """MsgpackResponse when the client accepts it, StateResponse otherwise; both vary on Accept."""
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if wants_msgpack(accept):
+        return MsgpackResponse(content, headers=headers)
+    return StateResponse(content, headers=headers)
+
+
+def _snapshot(content: Any, stream_keys: Sequence[str]) -> List[Union[bytes, List[Any]]]:
+    """Encoded pieces of ``content``; streamed row lists are kept as copied lists of copied rows."""
+    if isinstance(content, PublicState):
+        content = content.projection()
+    if not isinstance(content, dict):
+        return [dumps(content)]
+    parts: List[Union[bytes, List[Any]]] = [b"{"]
+    for position, (key, value) in enumerate(content.items()):
+        parts.append((b"," if position else b"") + dumps(str(key)) + b":")
+        if key in stream_keys and isinstance(value, list):
+            parts.append([dict(row) if isinstance(row, dict) else row for row in value])
+        elif isinstance(value, PublicState):
+            parts.extend(_snapshot(value, stream_keys))
+        else:
+            parts.append(dumps(value))
+    parts.append(b"}")
+    return parts
+
+
+def _iter_json(parts: List[Union[bytes, List[Any]]], batch_size: int) -> Iterator[bytes]:
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+            continue
+        yield b"["
+        for start in range(0, len(part), batch_size):
+            yield (b"," if start else b"") + dumps(part[start:start + batch_size])[1:-1]
+        yield b"]"
+
+
+class StreamingStateResponse(StreamingResponse):
+    """Streams a payload, emitting large row lists (history by default) in batches."""
+
+    def __init__(
+        self,
+        content: Any,
+        stream_keys: Sequence[str] = ("history",),
+        batch_size: int = 500,
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(
+            _iter_json(_snapshot(content, tuple(stream_keys)), batch_size),
+            status_code=status_code,
+            headers=headers,
+            media_type="application/json",
+        )
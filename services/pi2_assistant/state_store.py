@@ -0,0 +1,810 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from state_locks import KeyedLocks
+
+# Storage backends for per-user, per-period budget state.
+#
+# Every backend stores the same dict shape that pi2_server works with
+# (history/incomes/goals lists, budget dicts, settings...). Callers pass an
+# optional list of change records to ``save`` so backends that can write
+# incrementally only touch what changed:
+#
+#   {"op": "upsert", "coll": "history", "row": {...}, "index": 0}
+#   {"op": "delete", "coll": "history", "id": "..."}
+#   {"op": "put", "coll": "merchant_rules", "key": "starbucks"}
+#   {"op": "replace", "coll": "category_budgets"}
+#   {"op": "field", "coll": "budget"}
+#
+# "field" marks a changed top-level value (budget, settings...); backends
+# always write those with the period header, so it only keeps the change set
+# known. ``changes=None`` means "unknown", and the whole state is written.
+
+logger = logging.getLogger("xubudget")
+
+ROW_COLLECTIONS = ("history", "incomes", "goals")
+MAP_COLLECTIONS = ("category_budgets", "merchant_rules")
+
+_STATE_FILE_RE = re.compile(r"^(?P<user>.+)_(?P<period>\d{4}_\d{2})$")
+
+
+def _period_from_stem(stem: str, user_id: str) -> Optional[str]:
+    match = _STATE_FILE_RE.match(stem)
+    if not match or match.group("user") != user_id:
+        return None
+    return match.group("period")
+
+
+def _atomic_write_text(path: Path, text: str, fsync: bool = True) -> None:
+    """Write to a sibling temp file and rename it over ``path``."""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write(text)
+        fh.flush()
+        if fsync:
+            os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+class StateBackend:
+    """Common interface for state persistence."""
+
+    name = "base"
+
+    def exists(self, user_id: str, period: str) -> bool:
+        raise NotImplementedError
+
+    def load(self, user_id: str, period: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def save(
+        self,
+        user_id: str,
+        period: str,
+        state: Dict[str, Any],
+        changes: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        raise NotImplementedError
+
+    def list_periods(self, user_id: str) -> List[str]:
+        raise NotImplementedError
+
+    def list_users(self) -> List[str]:
+        raise NotImplementedError
+
+    def signature(self, user_id: str, period: str) -> Optional[Hashable]:
+        """Cheap token that changes whenever the stored period changes (None if missing)."""
+        raise NotImplementedError
+
+    def export_json(self, user_id: str, period: str, path: Path) -> bool:
+        data = self.load(user_id, period)
+        if data is None:
+            return False
+        path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        return True
+
+    def import_json(self, user_id: str, period: str, path: Path) -> None:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        self.save(user_id, period, data)
+
+
+class JsonStateBackend(StateBackend):
+    """One ``{user}_{YYYY_MM}.json`` file per period (the original layout)."""
+
+    name = "json"
+
+    def __init__(self, states_dir: Path, fsync: bool = True):
+        self.states_dir = states_dir
+        self.fsync = fsync
+
+    def path_for(self, user_id: str, period: str) -> Path:
+        return self.states_dir / f"{user_id}_{period}.json"
+
+    def exists(self, user_id: str, period: str) -> bool:
+        return self.path_for(user_id, period).exists()
+
+    def load(self, user_id: str, period: str) -> Optional[Dict[str, Any]]:
+        path = self.path_for(user_id, period)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def save(self, user_id, period, state, changes=None) -> None:
+        # callers serialize writers per (user, period); the rename keeps readers safe
+        _atomic_write_text(
+            self.path_for(user_id, period),
+            json.dumps(state, ensure_ascii=False, indent=2),
+            fsync=self.fsync,
+        )
+
+    def list_periods(self, user_id: str) -> List[str]:
+        periods = []
+        for path in self.states_dir.glob(f"{user_id}_*.json"):
+            period = _period_from_stem(path.stem, user_id)
+            if period:
+                periods.append(period)
+        return sorted(periods)
+
+    def list_users(self) -> List[str]:
+        users = set()
+        for path in self.states_dir.glob("*.json"):
+            match = _STATE_FILE_RE.match(path.stem)
+            if match:
+                users.add(match.group("user"))
+        return sorted(users)
+
+    def signature(self, user_id: str, period: str) -> Optional[Hashable]:
+        try:
+            st = self.path_for(user_id, period).stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+
+class JournaledJsonStateBackend(JsonStateBackend):
+    """JSON snapshots plus an append-only ``{user}_{period}.journal.jsonl``.
+
+    A save with change records appends one JSON line per change (and per
+    changed top-level field) instead of rewriting the snapshot, so the write
+    cost follows the size of the change. Loading replays the journal over the
+    snapshot. Once a journal passes ``max_ops`` lines or ``max_bytes`` a
+    background thread folds it into a new snapshot. Replay is idempotent, so
+    a crash between the snapshot rename and the journal truncation is safe.
+    """
+
+    name = "json+journal"
+
+    def __init__(
+        self,
+        states_dir: Path,
+        volatile_keys: Iterable[str] = (),
+        max_ops: int = 500,
+        max_bytes: int = 1 << 20,
+        fsync: bool = True,
+    ):
+        super().__init__(states_dir, fsync=fsync)
+        # derived fields that are recomputed on every load; never journaled
+        self.volatile_keys = frozenset(volatile_keys)
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        # per-period: appends for different users never wait on each other
+        self._key_locks = KeyedLocks()
+        self._compacting_lock = threading.Lock()
+        self._headers: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self._journal_ops: Dict[Tuple[str, str], int] = {}
+        self._generations: Dict[Tuple[str, str], int] = {}
+        self._compacting: Set[Tuple[str, str]] = set()
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-compactor")
+
+    def journal_path(self, user_id: str, period: str) -> Path:
+        return self.states_dir / f"{user_id}_{period}.journal.jsonl"
+
+    def _header_fingerprint(self, state: Dict[str, Any]) -> Dict[str, str]:
+        return {
+            k: json.dumps(v, ensure_ascii=False, sort_keys=True)
+            for k, v in state.items()
+            if not k.startswith("_")
+            and k not in ROW_COLLECTIONS
+            and k not in MAP_COLLECTIONS
+            and k not in self.volatile_keys
+        }
+
+    def load(self, user_id: str, period: str) -> Optional[Dict[str, Any]]:
+        key = (user_id, period)
+        with self._key_locks.hold(key):
+            state = super().load(user_id, period)
+            if state is None:
+                return None
+            journal = self.journal_path(user_id, period)
+            data = journal.read_bytes() if journal.exists() else b""
+            records = _parse_journal(data, journal)
+            _replay_journal(state, records)
+            self._journal_ops[key] = len(records)
+            self._headers[key] = self._header_fingerprint(state)
+        return state
+
+    def save(self, user_id, period, state, changes=None) -> None:
+        key = (user_id, period)
+        if changes is None:
+            with self._key_locks.hold(key):
+                _atomic_write_text(
+                    self.path_for(user_id, period),
+                    json.dumps(state, ensure_ascii=False, indent=2),
+                    fsync=self.fsync,
+                )
+                self.journal_path(user_id, period).unlink(missing_ok=True)
+                self._journal_ops[key] = 0
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._headers[key] = self._header_fingerprint(state)
+            return
+
+        journal = self.journal_path(user_id, period)
+        with self._key_locks.hold(key):
+            records: List[Dict[str, Any]] = []
+            previous = self._headers.get(key, {})
+            current = self._header_fingerprint(state)
+            for field, encoded in current.items():
+                if previous.get(field) != encoded:
+                    records.append({"op": "set", "key": field, "value": state[field]})
+            for field in previous.keys() - current.keys():
+                records.append({"op": "unset", "key": field})
+            for change in changes:
+                if change.get("op") != "field":  # covered by the header diff above
+                    records.append(_journal_record(state, change))
+            if not records:
+                return
+
+            payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            with open(journal, "a", encoding="utf-8") as fh:
+                fh.write(payload)
+                fh.flush()
+                if self.fsync:
+                    os.fsync(fh.fileno())
+                size = fh.tell()
+            ops = self._journal_ops.get(key, 0) + len(records)
+            self._journal_ops[key] = ops
+            self._headers[key] = current
+        if ops >= self.max_ops or size >= self.max_bytes:
+            self._schedule_compaction(user_id, period)
+
+    def signature(self, user_id: str, period: str) -> Optional[Hashable]:
+        snapshot = super().signature(user_id, period)
+        if snapshot is None:
+            return None
+        try:
+            st = self.journal_path(user_id, period).stat()
+        except FileNotFoundError:
+            return snapshot
+        return snapshot + (st.st_mtime_ns, st.st_size)
+
+    def _schedule_compaction(self, user_id: str, period: str) -> None:
+        key = (user_id, period)
+        with self._compacting_lock:
+            if key in self._compacting:
+                return
+            self._compacting.add(key)
+        self._compactor.submit(self._compact_in_background, user_id, period)
+
+    def _compact_in_background(self, user_id: str, period: str) -> None:
+        try:
+            self.compact(user_id, period)
+        except Exception as exc:
+            logger.warning("Journal compaction failed for %s/%s: %s", user_id, period, exc)
+        finally:
+            with self._compacting_lock:
+                self._compacting.discard((user_id, period))
+
+    def compact(self, user_id: str, period: str) -> bool:
+        """Fold the journal into a fresh snapshot; appends made meanwhile are kept."""
+        key = (user_id, period)
+        path = self.path_for(user_id, period)
+        journal = self.journal_path(user_id, period)
+        with self._key_locks.hold(key):
+            if not path.exists() or not journal.exists():
+                return False
+            generation = self._generations.get(key, 0)
+            snapshot_text = path.read_text(encoding="utf-8")
+            data = journal.read_bytes()
+
+        # the expensive part runs without the lock
+        state = json.loads(snapshot_text)
+        _replay_journal(state, _parse_journal(data, journal))
+        tmp = path.with_name(path.name + ".compact")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(json.dumps(state, ensure_ascii=False, indent=2))
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+
+        with self._key_locks.hold(key):
+            if self._generations.get(key, 0) != generation:
+                # a full save replaced the snapshot while we were compacting
+                tmp.unlink(missing_ok=True)
+                return False
+            with open(journal, "rb") as fh:
+                fh.seek(len(data))
+                tail = fh.read()
+            os.replace(tmp, path)
+            if tail:
+                tail_tmp = journal.with_name(journal.name + ".tmp")
+                tail_tmp.write_bytes(tail)
+                os.replace(tail_tmp, journal)
+            else:
+                journal.unlink(missing_ok=True)
+            self._journal_ops[key] = tail.count(b"\n")
+        logger.debug("Compacted journal for %s/%s (%d bytes folded)", user_id, period, len(data))
+        return True
+
+
+def _journal_record(state: Dict[str, Any], change: Dict[str, Any]) -> Dict[str, Any]:
+    op = change.get("op")
+    coll = change.get("coll")
+    if op == "put":
+        return {"op": "put", "coll": coll, "key": change.get("key"), "value": (state.get(coll) or {}).get(change.get("key"))}
+    if op == "replace":
+        return {"op": "replace", "coll": coll, "value": state.get(coll) or {}}
+    return dict(change)
+
+
+def _parse_journal(data: bytes, path: Path) -> List[Dict[str, Any]]:
+    records: List[Dict[str, Any]] = []
+    for line in data.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # torn write from a crash: everything before it is still valid
+            logger.warning("Ignoring truncated journal line in %s", path.name)
+            break
+    return records
+
+
+def _replay_journal(state: Dict[str, Any], records: List[Dict[str, Any]]) -> None:
+    if not records:
+        return
+    by_id: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    deleted: Set[str] = set()
+    for record in records:
+        op = record.get("op")
+        coll = record.get("coll")
+        if op == "set":
+            state[record["key"]] = record.get("value")
+        elif op == "unset":
+            state.pop(record["key"], None)
+        elif op in ("upsert", "delete") and coll in ROW_COLLECTIONS:
+            rows = state.setdefault(coll, [])
+            index = by_id.get(coll)
+            if index is None:
+                index = by_id[coll] = {r.get("id"): r for r in rows}
+            if op == "delete":
+                if index.pop(record.get("id"), None) is not None:
+                    deleted.add(coll)
+                continue
+            row = record.get("row") or {}
+            existing = index.get(row.get("id"))
+            if existing is not None:
+                existing.clear()
+                existing.update(row)
+            else:
+                row = dict(row)
+                index[row.get("id")] = row
+                if record.get("index") == 0:
+                    rows.insert(0, row)
+                else:
+                    rows.append(row)
+        elif op == "put" and coll in MAP_COLLECTIONS:
+            mapping = state.setdefault(coll, {})
+            if record.get("value") is None:
+                mapping.pop(record.get("key"), None)
+            else:
+                mapping[record.get("key")] = record.get("value")
+        elif op == "replace" and coll in MAP_COLLECTIONS:
+            state[coll] = dict(record.get("value") or {})
+    for coll in deleted:
+        live = by_id[coll]
+        state[coll] = [r for r in state[coll] if live.get(r.get("id")) is r]
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS periods (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, period)
+);
+CREATE TABLE IF NOT EXISTS history (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT,
+    timestamp TEXT,
+    amount REAL,
+    category TEXT,
+    merchant TEXT,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, period, id)
+);
+CREATE INDEX IF NOT EXISTS idx_history_seq ON history (user_id, period, seq);
+CREATE INDEX IF NOT EXISTS idx_history_ts ON history (user_id, period, timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_category ON history (user_id, period, category);
+CREATE TABLE IF NOT EXISTS incomes (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT,
+    amount REAL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, period, id)
+);
+CREATE INDEX IF NOT EXISTS idx_incomes_seq ON incomes (user_id, period, seq);
+CREATE INDEX IF NOT EXISTS idx_incomes_ts ON incomes (user_id, period, timestamp);
+CREATE TABLE IF NOT EXISTS goals (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    status TEXT,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, period, id)
+);
+CREATE INDEX IF NOT EXISTS idx_goals_seq ON goals (user_id, period, seq);
+CREATE TABLE IF NOT EXISTS budgets (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    category_id TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (user_id, period, category_id)
+);
+CREATE TABLE IF NOT EXISTS merchant_rules (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    merchant TEXT NOT NULL,
+    category TEXT NOT NULL,
+    PRIMARY KEY (user_id, period, merchant)
+);
+"""
+
+# collection -> indexed columns copied out of the row document
+_ROW_COLUMNS = {
+    "history": ("type", "timestamp", "amount", "category", "merchant"),
+    "incomes": ("timestamp", "amount"),
+    "goals": ("status",),
+}
+
+# state field -> (table, key column, value column)
+_MAP_TABLES = {
+    "category_budgets": ("budgets", "category_id", "amount"),
+    "merchant_rules": ("merchant_rules", "merchant", "category"),
+}
+
+
+class SqliteStateBackend(StateBackend):
+    """Indexed SQLite storage that writes one row per tracked mutation.
+
+    Period files found in ``import_dir`` are imported the first time a user
+    is touched, so an existing ``states/`` directory migrates transparently.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: Path, import_dir: Optional[Path] = None):
+        self.db_path = db_path
+        self.import_dir = import_dir
+        # re-entrant: importing legacy files saves while the lock is held
+        self._lock = threading.RLock()
+        self._imported_users: Set[str] = set()
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SQLITE_SCHEMA)
+
+    # --- import of legacy JSON files ---
+    def _import_user_files(self, user_id: str) -> None:
+        if user_id in self._imported_users:
+            return
+        if self.import_dir:
+            # each period commits on its own; a failed import is retried on the
+            # next access and skips the periods that already made it in
+            json_backend = JsonStateBackend(self.import_dir)
+            for period in json_backend.list_periods(user_id):
+                if self._has_period(user_id, period):
+                    continue
+                data = json_backend.load(user_id, period)
+                if data is not None:
+                    self.save(user_id, period, data)
+        self._imported_users.add(user_id)
+
+    def _has_period(self, user_id: str, period: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM periods WHERE user_id = ? AND period = ?", (user_id, period)
+        ).fetchone()
+        return row is not None
+
+    # --- StateBackend API ---
+    def exists(self, user_id: str, period: str) -> bool:
+        with self._lock:
+            self._import_user_files(user_id)
+            return self._has_period(user_id, period)
+
+    def load(self, user_id: str, period: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._import_user_files(user_id)
+            row = self._conn.execute(
+                "SELECT doc FROM periods WHERE user_id = ? AND period = ?", (user_id, period)
+            ).fetchone()
+            if row is None:
+                return None
+            state: Dict[str, Any] = json.loads(row["doc"])
+            for coll in ROW_COLLECTIONS:
+                rows = self._conn.execute(
+                    f"SELECT doc FROM {coll} WHERE user_id = ? AND period = ? ORDER BY seq",
+                    (user_id, period),
+                )
+                state[coll] = [json.loads(r["doc"]) for r in rows]
+            for field, (table, key_col, value_col) in _MAP_TABLES.items():
+                rows = self._conn.execute(
+                    f"SELECT {key_col}, {value_col} FROM {table} WHERE user_id = ? AND period = ?",
+                    (user_id, period),
+                )
+                state[field] = {r[0]: r[1] for r in rows}
+            return state
+
+    def save(self, user_id, period, state, changes=None) -> None:
+        with self._lock:
+            with self._conn:
+                self._write_header(user_id, period, state)
+                if changes is None:
+                    self._write_full(user_id, period, state)
+                else:
+                    for change in changes:
+                        self._apply_change(user_id, period, state, change)
+            key = (user_id, period)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def list_periods(self, user_id: str) -> List[str]:
+        with self._lock:
+            self._import_user_files(user_id)
+            rows = self._conn.execute(
+                "SELECT period FROM periods WHERE user_id = ? ORDER BY period", (user_id,)
+            )
+            return [r["period"] for r in rows]
+
+    def list_users(self) -> List[str]:
+        with self._lock:
+            users = {r["user_id"] for r in self._conn.execute("SELECT DISTINCT user_id FROM periods")}
+        if self.import_dir:
+            # users whose legacy files have not been imported yet
+            users.update(JsonStateBackend(self.import_dir).list_users())
+        return sorted(users)
+
+    def signature(self, user_id: str, period: str) -> Optional[Hashable]:
+        # the database is owned by this process, so a write counter is enough
+        with self._lock:
+            if not self.exists(user_id, period):
+                return None
+            return self._versions.get((user_id, period), 0)
+
+    # --- write helpers (caller holds the lock and the transaction) ---
+    def _write_header(self, user_id: str, period: str, state: Dict[str, Any]) -> None:
+        header = {
+            k: v for k, v in state.items()
+            if not k.startswith("_") and k not in ROW_COLLECTIONS and k not in MAP_COLLECTIONS
+        }
+        self._conn.execute(
+            "INSERT INTO periods (user_id, period, doc) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, period) DO UPDATE SET doc = excluded.doc",
+            (user_id, period, json.dumps(header, ensure_ascii=False)),
+        )
+
+    def _write_full(self, user_id: str, period: str, state: Dict[str, Any]) -> None:
+        for coll in ROW_COLLECTIONS:
+            self._conn.execute(f"DELETE FROM {coll} WHERE user_id = ? AND period = ?", (user_id, period))
+            for seq, row in enumerate(state.get(coll) or []):
+                self._upsert_row(user_id, period, coll, row, seq)
+        for field in MAP_COLLECTIONS:
+            self._replace_map(user_id, period, field, state.get(field) or {})
+
+    def _apply_change(self, user_id: str, period: str, state: Dict[str, Any], change: Dict[str, Any]) -> None:
+        op = change.get("op")
+        coll = change.get("coll")
+        if op == "upsert" and coll in _ROW_COLUMNS:
+            seq = self._next_seq(user_id, period, coll, front=change.get("index") == 0)
+            self._upsert_row(user_id, period, coll, change["row"], seq)
+        elif op == "delete" and coll in _ROW_COLUMNS:
+            self._conn.execute(
+                f"DELETE FROM {coll} WHERE user_id = ? AND period = ? AND id = ?",
+                (user_id, period, change.get("id")),
+            )
+        elif op == "put" and coll in _MAP_TABLES:
+            table, key_col, value_col = _MAP_TABLES[coll]
+            key = change.get("key")
+            value = (state.get(coll) or {}).get(key)
+            if value is None:
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE user_id = ? AND period = ? AND {key_col} = ?",
+                    (user_id, period, key),
+                )
+            else:
+                self._conn.execute(
+                    f"INSERT INTO {table} (user_id, period, {key_col}, {value_col}) VALUES (?, ?, ?, ?) "
+                    f"ON CONFLICT(user_id, period, {key_col}) DO UPDATE SET {value_col} = excluded.{value_col}",
+                    (user_id, period, key, value),
+                )
+        elif op == "replace" and coll in _MAP_TABLES:
+            self._replace_map(user_id, period, coll, state.get(coll) or {})
+
+    def _next_seq(self, user_id: str, period: str, coll: str, front: bool) -> int:
+        # New history/income rows are inserted at the top of the list, goals
+        # are appended; ``seq`` keeps that order without renumbering rows.
+        func = "MIN(seq) - 1" if front else "MAX(seq) + 1"
+        row = self._conn.execute(
+            f"SELECT COALESCE({func}, 0) FROM {coll} WHERE user_id = ? AND period = ?",
+            (user_id, period),
+        ).fetchone()
+        return int(row[0])
+
+    def _upsert_row(self, user_id: str, period: str, coll: str, row: Dict[str, Any], seq: int) -> None:
+        row.setdefault("id", str(uuid4()))
+        columns = _ROW_COLUMNS[coll]
+        values = [row.get(col) for col in columns]
+        col_list = ", ".join(columns)
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{col} = excluded.{col}" for col in columns + ("doc",))
+        self._conn.execute(
+            f"INSERT INTO {coll} (user_id, period, id, seq, {col_list}, doc) "
+            f"VALUES (?, ?, ?, ?, {placeholders}, ?) "
+            f"ON CONFLICT(user_id, period, id) DO UPDATE SET {updates}",
+            (user_id, period, row["id"], seq, *values, json.dumps(row, ensure_ascii=False)),
+        )
+
+    def _replace_map(self, user_id: str, period: str, field: str, mapping: Dict[str, Any]) -> None:
+        table, key_col, value_col = _MAP_TABLES[field]
+        self._conn.execute(f"DELETE FROM {table} WHERE user_id = ? AND period = ?", (user_id, period))
+        self._conn.executemany(
+            f"INSERT INTO {table} (user_id, period, {key_col}, {value_col}) VALUES (?, ?, ?, ?)",
+            [(user_id, period, key, value) for key, value in mapping.items()],
+        )
+
+
+class PeriodManifest:
+    """Per-user index of stored periods with a little metadata each.
+
+    ``manifest_dir/{user}.json`` maps period -> {created_at, updated_at,
+    entries, spent, budget, rollup}, where the rollup carries the period's
+    headline totals. It is kept in memory, rewritten atomically whenever a
+    period is saved, and rebuilt from the backend when missing or unreadable,
+    so listing a user's periods never scans the states directory or loads
+    period state.
+    ``describe(user_id, period, raw_state)`` supplies metadata on rebuild.
+    """
+
+    def __init__(
+        self,
+        manifest_dir: Path,
+        backend: StateBackend,
+        describe: Optional[Callable[[str, str, Dict[str, Any]], Dict[str, Any]]] = None,
+    ):
+        self.manifest_dir = manifest_dir
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        self.backend = backend
+        self.describe = describe
+        self._manifests: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._guard = threading.Lock()
+        self._user_locks = KeyedLocks()
+
+    def path_for(self, user_id: str) -> Path:
+        return self.manifest_dir / f"{user_id}.json"
+
+    def periods(self, user_id: str) -> List[str]:
+        manifest = self._manifest(user_id)
+        with self._guard:
+            return sorted(manifest)
+
+    def has(self, user_id: str, period: str) -> bool:
+        return period in self._manifest(user_id)
+
+    def entries(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        manifest = self._manifest(user_id)
+        with self._guard:
+            return {period: dict(meta) for period, meta in manifest.items()}
+
+    def record(self, user_id: str, period: str, meta: Dict[str, Any]) -> None:
+        """Create or update one period's entry and persist the manifest."""
+        now = datetime.now().isoformat()
+        with self._user_locks.hold(user_id):
+            manifest = self._load_locked(user_id)
+            with self._guard:
+                entry = dict(manifest.get(period) or {"created_at": now})
+                entry.update(meta)
+                entry["updated_at"] = now
+                manifest[period] = entry
+            self._write_locked(user_id, manifest)
+
+    def rebuild(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        """Regenerate a user's manifest from the backend's stored periods."""
+        with self._user_locks.hold(user_id):
+            return self._rebuild_locked(user_id)
+
+    def users(self) -> List[str]:
+        """Users with a manifest file or with periods in the backend."""
+        users = {path.stem for path in self.manifest_dir.glob("*.json")}
+        users.update(self.backend.list_users())
+        return sorted(users)
+
+    def rebuild_all(self) -> Dict[str, int]:
+        """Rebuild every user's manifest; returns user -> number of periods."""
+        return {user_id: len(self.rebuild(user_id)) for user_id in self.users()}
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """Forget cached manifests; the next lookup re-reads the file."""
+        with self._guard:
+            if user_id is None:
+                self._manifests.clear()
+            else:
+                self._manifests.pop(user_id, None)
+
+    def _manifest(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._guard:
+            manifest = self._manifests.get(user_id)
+        if manifest is not None:
+            return manifest
+        with self._user_locks.hold(user_id):
+            return self._load_locked(user_id)
+
+    # --- helpers below run with the user's lock held ---
+    def _load_locked(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._guard:
+            manifest = self._manifests.get(user_id)
+        if manifest is not None:
+            return manifest
+        path = self.path_for(user_id)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            manifest = dict(data["periods"])
+        except FileNotFoundError:
+            return self._rebuild_locked(user_id)
+        except (ValueError, KeyError, TypeError) as exc:
+            logger.warning("Unreadable period manifest %s (%s); rebuilding", path.name, exc)
+            return self._rebuild_locked(user_id)
+        with self._guard:
+            self._manifests[user_id] = manifest
+        return manifest
+
+    def _rebuild_locked(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        now = datetime.now().isoformat()
+        periods: Dict[str, Dict[str, Any]] = {}
+        for period in self.backend.list_periods(user_id):
+            raw = self.backend.load(user_id, period)
+            if raw is None:
+                continue
+            meta: Dict[str, Any] = {"created_at": raw.get("period_started_at") or now}
+            if self.describe is not None:
+                try:
+                    meta.update(self.describe(user_id, period, raw))
+                except Exception as exc:
+                    logger.warning("Failed describing %s/%s for the manifest: %s", user_id, period, exc)
+            meta["updated_at"] = now
+            periods[period] = meta
+        with self._guard:
+            self._manifests[user_id] = periods
+        self._write_locked(user_id, periods)
+        logger.info("Rebuilt period manifest for %s (%d periods)", user_id, len(periods))
+        return periods
+
+    def _write_locked(self, user_id: str, periods: Dict[str, Dict[str, Any]]) -> None:
+        with self._guard:
+            snapshot = json.dumps({"user_id": user_id, "periods": periods}, ensure_ascii=False)
+        # metadata is rebuildable from the period files, so skip fsync
+        _atomic_write_text(self.path_for(user_id), snapshot, fsync=False)
+
+
+def create_state_backend(
+    kind: str,
+    states_dir: Path,
+    db_path: Optional[str] = None,
+    journal: bool = False,
+    **journal_options: Any,
+) -> StateBackend:
+    kind = (kind or "json").strip().lower()
+    if kind == "sqlite":
+        path = Path(db_path) if db_path else states_dir / "xubudget.db"
+        return SqliteStateBackend(path, import_dir=states_dir)
+    if kind != "json":
+        raise ValueError(f"Unknown state backend: {kind}")
+    if journal:
+        return JournaledJsonStateBackend(states_dir, **journal_options)
+    return JsonStateBackend(states_dir)
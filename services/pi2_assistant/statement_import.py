@@ -0,0 +1,282 @@
+import codecs
+import csv
+import hashlib
+import re
+from datetime import datetime
+from collections import Counter
+from typing import AsyncIterable, AsyncIterator, Dict, Iterator, List, Optional, Union
+
+from history_index import parse_timestamp
+
+# Incremental parsers for bank statements (CSV and OFX/QFX).
+#
+# parse_statement() consumes the upload as an async stream of byte chunks and
+# yields one ImportRow (or RowError) per transaction as soon as its lines are
+# complete, so a statement is never held in memory as a whole. Amounts are
+# signed: negative is money out. Every row carries an ``import_id``
+# fingerprint (the OFX FITID when present) that lets re-imports skip rows
+# that are already stored; identical rows within one statement (two coffees
+# on the same day) are told apart by their occurrence number.
+
+DATE_FORMATS = (
+    "%Y-%m-%d", "%Y/%m/%d", "%Y%m%d", "%d %b %Y", "%d %B %Y", "%b %d, %Y", "%B %d, %Y",
+)
+MONTH_FIRST_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d.%m.%Y")
+DAY_FIRST_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d.%m.%Y", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y")
+
+CSV_COLUMNS = {
+    "date": ("date", "transaction date", "posted date", "posting date", "booking date", "value date", "data"),
+    "amount": ("amount", "transaction amount", "value", "valor"),
+    "debit": ("debit", "debit amount", "withdrawal", "withdrawals", "money out", "paid out"),
+    "credit": ("credit", "credit amount", "deposit", "deposits", "money in", "paid in"),
+    "description": ("description", "details", "memo", "narrative", "transaction description", "descricao", "name"),
+    "merchant": ("merchant", "payee", "merchant name"),
+    "category": ("category", "categoria"),
+}
+
+
+class RowError(ValueError):
+    def __init__(self, line: int, message: str):
+        super().__init__(message)
+        self.line = line
+
+
+class ImportRow:
+    __slots__ = ("line", "timestamp", "amount", "description", "merchant", "category", "import_id")
+
+    def __init__(
+        self,
+        line: int,
+        timestamp: datetime,
+        amount: float,
+        description: str,
+        merchant: str = "",
+        category: Optional[str] = None,
+        import_id: Optional[str] = None,
+    ):
+        self.line = line
+        self.timestamp = timestamp
+        self.amount = amount
+        self.description = description
+        self.merchant = merchant
+        self.category = category
+        self.import_id = import_id or _fingerprint(timestamp, amount, description)
+
+
+ParseResult = Union[ImportRow, RowError]
+
+
+def _fingerprint(timestamp: datetime, amount: float, description: str) -> str:
+    token = f"{timestamp.date().isoformat()}|{amount:.2f}|{description.strip().lower()}"
+    return "sha1:" + hashlib.sha1(token.encode("utf-8")).hexdigest()[:20]
+
+
+def parse_amount(text: str) -> float:
+    """Parse "1,234.56", "(12.30)", "12.30-", "$ -5", "1.234,56" style amounts."""
+    value = (text or "").strip()
+    negative = False
+    if value.startswith("(") and value.endswith(")"):
+        negative, value = True, value[1:-1]
+    if value.endswith("-"):
+        negative, value = True, value[:-1]
+    value = re.sub(r"[^0-9,.\-]", "", value)
+    if value.startswith("-"):
+        negative, value = not negative, value[1:]
+    if re.fullmatch(r"\d{1,3}(\.\d{3})*,\d{1,2}|\d+,\d{1,2}", value):
+        value = value.replace(".", "").replace(",", ".")
+    else:
+        value = value.replace(",", "")
+    if not value:
+        raise ValueError(f"Invalid amount: {text!r}")
+    amount = float(value)
+    return -amount if negative else amount
+
+
+def parse_date(text: str, dayfirst: bool = False) -> datetime:
+    value = (text or "").strip()
+    parsed = parse_timestamp(value)
+    if parsed is not None:
+        return parsed
+    for fmt in DATE_FORMATS + (DAY_FIRST_FORMATS if dayfirst else MONTH_FIRST_FORMATS):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date: {text!r}")
+
+
+class CsvStatementParser:
+    """Feed physical lines; yields a result per record (quoted fields may span lines)."""
+
+    def __init__(self, dayfirst: bool = False, expenses_positive: bool = False):
+        self.dayfirst = dayfirst
+        self.expenses_positive = expenses_positive
+        self.columns: Optional[Dict[str, int]] = None
+        self.dialect: Optional[type] = None
+        self._pending: List[str] = []
+        self._pending_line = 0
+
+    def feed(self, line: str, line_no: int) -> Iterator[ParseResult]:
+        if not self._pending:
+            if not line.strip():
+                return
+            self._pending_line = line_no
+        self._pending.append(line)
+        record = "\n".join(self._pending)
+        if record.count('"') % 2:
+            return  # inside a quoted field
+        self._pending = []
+        yield from self._record(record, self._pending_line)
+
+    def close(self) -> Iterator[ParseResult]:
+        if self._pending:
+            yield RowError(self._pending_line, "Unterminated quoted field")
+            self._pending = []
+
+    def _record(self, record: str, line_no: int) -> Iterator[ParseResult]:
+        if self.dialect is None:
+            try:
+                self.dialect = csv.Sniffer().sniff(record, delimiters=",;\t|")
+            except csv.Error:
+                self.dialect = csv.excel
+        fields = next(csv.reader([record], self.dialect), [])
+        if self.columns is None:
+            self.columns = self._map_header(fields)
+            if "date" not in self.columns or not ({"amount", "debit", "credit"} & set(self.columns)):
+                raise ValueError("CSV header needs a date column and an amount (or debit/credit) column")
+            return
+        try:
+            yield self._row(fields, line_no)
+        except (ValueError, IndexError) as exc:
+            yield RowError(line_no, str(exc))
+
+    @staticmethod
+    def _map_header(fields: List[str]) -> Dict[str, int]:
+        names = [f.strip().lower() for f in fields]
+        columns: Dict[str, int] = {}
+        for key, aliases in CSV_COLUMNS.items():
+            for pos, name in enumerate(names):
+                if name in aliases and pos not in columns.values():
+                    columns[key] = pos
+                    break
+        return columns
+
+    def _field(self, fields: List[str], key: str) -> str:
+        pos = self.columns.get(key)
+        return fields[pos].strip() if pos is not None and pos < len(fields) else ""
+
+    def _row(self, fields: List[str], line_no: int) -> ImportRow:
+        timestamp = parse_date(self._field(fields, "date"), self.dayfirst)
+        if self._field(fields, "amount"):
+            amount = parse_amount(self._field(fields, "amount"))
+            if self.expenses_positive:
+                amount = -amount
+        else:
+            debit, credit = self._field(fields, "debit"), self._field(fields, "credit")
+            if not debit and not credit:
+                raise ValueError("Missing amount")
+            amount = (abs(parse_amount(credit)) if credit else 0.0) - (abs(parse_amount(debit)) if debit else 0.0)
+        description = self._field(fields, "description") or self._field(fields, "merchant")
+        return ImportRow(
+            line_no,
+            timestamp,
+            amount,
+            description,
+            merchant=self._field(fields, "merchant"),
+            category=self._field(fields, "category") or None,
+        )
+
+
+_OFX_BLOCK_END = re.compile(r"</STMTTRN>", re.IGNORECASE)
+_OFX_FIELD = re.compile(r"<(\w+)>([^<\r\n]*)")
+
+
+class OfxStatementParser:
+    """Feed physical lines; yields a result per <STMTTRN> block (SGML or XML OFX)."""
+
+    def __init__(self) -> None:
+        self._block: Optional[List[str]] = None
+        self._block_line = 0
+
+    def feed(self, line: str, line_no: int) -> Iterator[ParseResult]:
+        upper = line.upper()
+        start = upper.find("<STMTTRN>")
+        if start >= 0:
+            self._block = []
+            self._block_line = line_no
+            line = line[start + len("<STMTTRN>"):]
+        if self._block is None:
+            return
+        end = _OFX_BLOCK_END.search(line)
+        self._block.append(line[:end.start()] if end else line)
+        if end:
+            block, self._block = "".join(self._block), None
+            try:
+                yield self._row(block, self._block_line)
+            except ValueError as exc:
+                yield RowError(self._block_line, str(exc))
+
+    def close(self) -> Iterator[ParseResult]:
+        if self._block is not None:
+            yield RowError(self._block_line, "Unterminated <STMTTRN> block")
+            self._block = None
+
+    @staticmethod
+    def _row(block: str, line_no: int) -> ImportRow:
+        fields = {tag.upper(): value.strip() for tag, value in _OFX_FIELD.findall(block)}
+        posted = fields.get("DTPOSTED", "")
+        digits = re.match(r"\d{8}(\d{6})?", posted)
+        if not digits:
+            raise ValueError(f"Invalid DTPOSTED: {posted!r}")
+        text = digits.group(0)
+        timestamp = datetime.strptime(text, "%Y%m%d%H%M%S" if len(text) == 14 else "%Y%m%d")
+        amount = parse_amount(fields.get("TRNAMT", ""))
+        name = fields.get("NAME") or fields.get("PAYEE") or ""
+        description = fields.get("MEMO") or name
+        fitid = fields.get("FITID")
+        return ImportRow(line_no, timestamp, amount, description, merchant=name, import_id=f"fitid:{fitid}" if fitid else None)
+
+
+async def _iter_lines(chunks: AsyncIterable[bytes], encoding: str = "utf-8-sig") -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tail = ""
+    async for chunk in chunks:
+        text = tail + decoder.decode(chunk)
+        lines = text.split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail.rstrip("\r")
+
+
+async def parse_statement(
+    chunks: AsyncIterable[bytes],
+    fmt: Optional[str] = None,
+    dayfirst: bool = False,
+    expenses_positive: bool = False,
+) -> AsyncIterator[ParseResult]:
+    """Yield rows from a CSV or OFX byte stream; ``fmt`` None sniffs it from the first line."""
+    parser: Union[CsvStatementParser, OfxStatementParser, None] = None
+    occurrences: Counter = Counter()
+    line_no = 0
+    async for line in _iter_lines(chunks):
+        line_no += 1
+        if parser is None:
+            if not line.strip():
+                continue
+            head = line.lstrip().upper()
+            if fmt is None:
+                fmt = "ofx" if head.startswith("OFXHEADER") or head.startswith("<OFX") or head.startswith("<?XML") else "csv"
+            parser = OfxStatementParser() if fmt == "ofx" else CsvStatementParser(dayfirst, expenses_positive)
+        for result in parser.feed(line, line_no):
+            if isinstance(result, ImportRow) and result.import_id.startswith("sha1:"):
+                seen = occurrences[result.import_id]
+                occurrences[result.import_id] += 1
+                if seen:
+                    result.import_id = f"{result.import_id}#{seen}"
+            yield result
+    if parser is not None:
+        for result in parser.close():
+            yield result
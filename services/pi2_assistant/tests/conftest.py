@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# pi2_server reads its settings at import time: point it at a scratch states
+# directory and turn on aggregate verification before any test imports it.
+os.environ.setdefault("XU_STATES_DIR", tempfile.mkdtemp(prefix="xubudget-tests-"))
+os.environ.setdefault("XU_VERIFY_AGGREGATES", "1")
+os.environ.setdefault("OLLAMA_HOST", "http://127.0.0.1:9")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
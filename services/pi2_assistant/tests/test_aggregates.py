@@ -0,0 +1,193 @@
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import pi2_server as server
+
+# The incremental aggregates (_apply_history_delta) must always match a full
+# _refresh_financials recompute. conftest.py sets XU_VERIFY_AGGREGATES=1, so
+# every refreshed delta is also checked inside the server itself.
+
+
+def assert_consistent(state):
+    assert server._verify_aggregates(state) == []
+
+
+@pytest.fixture
+def state():
+    state = server.load_user_state(f"agg-{uuid4().hex[:8]}")
+    state["budget"] = 2000.0
+    server._set_category_budget(state, "groceries", 400.0)
+    server._set_category_budget(state, "food_dining", 150.0)
+    server._refresh_financials(state)
+    assert_consistent(state)
+    return state
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.app)
+
+
+def _last_month(state):
+    start, _ = server._period_start_end(state["period"])
+    return (start - timedelta(days=2)).isoformat()
+
+
+def test_verify_mode_is_on():
+    assert server.VERIFY_AGGREGATES
+
+
+def test_single_row_mutations(state):
+    coffee = server._add_expense(state, 4.5, "Coffee", "food_dining", merchant="Starbucks")
+    assert_consistent(state)
+    groceries = server._add_expense(state, 82.3, "Weekly shop", "groceries", merchant="Costco")
+    assert_consistent(state)
+    old = server._add_expense(state, 20.0, "Late receipt", "groceries", timestamp=_last_month(state))
+    assert_consistent(state)
+    server._add_expense(state, 12.0, "Starbucks again", None, merchant="Starbucks")
+    assert_consistent(state)
+
+    update = server.UpdateExpenseRequest
+    server._update_expense(state, coffee["id"], update(amount=6.25))
+    assert_consistent(state)
+    server._update_expense(state, groceries["id"], update(category="home_supplies", merchant="Costco Wholesale"))
+    assert_consistent(state)
+    # moving a row into and out of the period changes the period total only
+    server._update_expense(state, old["id"], update(timestamp=state["history"][-1]["timestamp"]))
+    assert_consistent(state)
+    server._update_expense(state, coffee["id"], update(timestamp=_last_month(state)))
+    assert_consistent(state)
+
+    server._reclassify_expense(state, groceries["id"], "groceries")
+    assert_consistent(state)
+    server._reclassify_expense(state, old["id"], "entertainment")
+    assert_consistent(state)
+
+    assert server._delete_expense(state, coffee["id"])
+    assert_consistent(state)
+    assert server._delete_expense(state, groceries["id"])
+    assert_consistent(state)
+    assert not server._delete_expense(state, "missing")
+    assert_consistent(state)
+
+
+def test_incomes_do_not_touch_expense_totals(state):
+    server._add_expense(state, 30.0, "Lunch", "food_dining")
+    income = server._add_income(state, 1500.0, "Salary")
+    assert_consistent(state)
+    server._update_income(state, income["id"], server.UpdateIncomeRequest(amount=1600.0))
+    assert_consistent(state)
+    assert server._delete_income(state, income["id"])
+    assert_consistent(state)
+
+
+def test_deferred_refresh_matches_after_batch(state):
+    ids = []
+    for amount, category in ((10.0, "groceries"), (25.5, "food_dining"), (7.25, "fuel"), (99.0, "rent")):
+        ids.append(server._add_expense(state, amount, f"row {amount}", category, refresh_totals=False)["id"])
+    server._refresh_budget_totals(state)
+    assert_consistent(state)
+
+    server._update_expense(state, ids[0], server.UpdateExpenseRequest(amount=11.0, category="fuel"), refresh_totals=False)
+    server._reclassify_expense(state, ids[1], "groceries", refresh_totals=False)
+    server._delete_expense(state, ids[2], refresh_totals=False)
+    server._add_expense(state, 3.0, "Old row", "fuel", timestamp=_last_month(state), refresh_totals=False)
+    server._refresh_budget_totals(state)
+    assert_consistent(state)
+
+
+def test_batch_operations_without_refresh(state):
+    added = server._apply_batch_operation(
+        state, server.BatchOperation(op="add_expense", data={"amount": 42.0, "description": "Dinner", "category": "food_dining"})
+    )
+    second = server._apply_batch_operation(
+        state, server.BatchOperation(op="add_expense", data={"amount": 18.0, "description": "Bus pass", "category": "public_transport"})
+    )
+    server._apply_batch_operation(state, server.BatchOperation(op="update_expense", id=added["id"], data={"amount": 45.0}))
+    server._apply_batch_operation(state, server.BatchOperation(op="reclassify", id=second["id"], data={"new_category": "fuel"}))
+    server._apply_batch_operation(state, server.BatchOperation(op="set_category_budget", data={"category_id": "fuel", "budget": 80}))
+    server._apply_batch_operation(state, server.BatchOperation(op="set_budget", data={"budget": 2500}))
+    server._refresh_budget_totals(state)
+    assert_consistent(state)
+
+    server._apply_batch_operation(state, server.BatchOperation(op="delete_expense", id=added["id"]))
+    server._refresh_budget_totals(state)
+    assert_consistent(state)
+
+
+def test_batch_endpoint(client):
+    user_id = f"agg-{uuid4().hex[:8]}"
+    response = client.post("/api/batch", json={
+        "user_id": user_id,
+        "operations": [
+            {"op": "add_expense", "data": {"amount": 12.0, "description": "Tim Hortons", "category": "food_dining"}},
+            {"op": "add_expense", "data": {"amount": 60.0, "description": "Groceries", "category": "groceries"}},
+            {"op": "add_income", "data": {"amount": 900.0, "source": "Freelance"}},
+            {"op": "delete_expense", "id": "missing"},
+        ],
+    })
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == ["ok", "ok", "ok", "error"]
+    expense_id = results[0]["id"]
+
+    response = client.post("/api/batch", json={
+        "user_id": user_id,
+        "atomic": True,
+        "operations": [
+            {"op": "update_expense", "id": expense_id, "data": {"amount": 14.0}},
+            {"op": "reclassify", "id": expense_id, "data": {"new_category": "groceries"}},
+        ],
+    })
+    assert response.status_code == 200
+    assert_consistent(server.load_user_state(user_id))
+
+
+def test_learn_merchant_reclassifies_history(client):
+    user_id = f"agg-{uuid4().hex[:8]}"
+    state = server.load_user_state(user_id)
+    for amount in (5.0, 6.5, 7.0):
+        server._add_expense(state, amount, "Starbucks", "other", merchant="Starbucks")
+    server._add_expense(state, 20.0, "Costco", "groceries", merchant="Costco")
+    server.save_user_state(state)
+
+    response = client.post("/api/ai/learn_merchant_category", json={"user_id": user_id, "merchant": "Starbucks", "category": "food_dining"})
+    assert response.status_code == 200
+    assert response.json()["updated"] == 3
+
+    state = server.load_user_state(user_id)
+    assert_consistent(state)
+    assert state["_category_totals"]["food_dining"]["transactions"] == 3
+    assert "other" not in state["_category_totals"]
+
+
+def test_divergence_is_reported(state):
+    server._add_expense(state, 10.0, "Snack", "food_dining")
+    state["_category_totals"]["food_dining"]["spent"] += 1.0
+    assert server._verify_aggregates(state)
+    with pytest.raises(RuntimeError, match="diverged"):
+        server._add_expense(state, 2.0, "Gum", "food_dining")
+
+
+@pytest.mark.parametrize("eager", [True, False])
+def test_columnar_view_follows_row_changes(state, monkeypatch, eager):
+    monkeypatch.setattr(server, "HISTORY_COLUMNS", eager)
+    server._refresh_financials(state)
+    columns = server._history_columns(state)
+    stamp = state["history"][-1]["timestamp"] if state["history"] else None
+
+    first = server._add_expense(state, 4.5, "Coffee", "food_dining", merchant="Starbucks")
+    second = server._add_expense(state, 9.0, "Tea", "food_dining", merchant="Starbucks", timestamp=first["timestamp"])
+    old = server._add_expense(state, 20.0, "Late receipt", "groceries", timestamp=_last_month(state))
+    server._add_income(state, 300.0, "Refund")
+    server._update_expense(state, first["id"], server.UpdateExpenseRequest(amount=5.0, category="groceries"))
+    server._update_expense(state, old["id"], server.UpdateExpenseRequest(timestamp=stamp or first["timestamp"]))
+    server._delete_expense(state, second["id"])
+
+    assert state["_history_columns"] is columns
+    assert len(columns) == sum(1 for row in state["history"] if row.get("type") == "expense")
+    assert server._column_rows(columns) == server._column_rows(server.HistoryColumns(server._history_index(state), server._merchant_label))
+    assert_consistent(state)
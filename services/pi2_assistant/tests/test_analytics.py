@@ -0,0 +1,69 @@
+import warnings
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+pytest.importorskip("pandas")
+
+import analytics
+import pi2_server as server
+
+
+def _frame(rows):
+    return analytics.ExpenseFrame(analytics.expense_block(rows, "2026_10", lambda row: row.get("merchant", "")))
+
+
+ROWS = [
+    {"id": "a", "type": "expense", "timestamp": "2026-10-01T12:00:00+00:00", "amount": 5.0},
+    {"id": "b", "type": "expense", "timestamp": "2026-10-01T14:00:00+00:00", "amount": 7.0},
+    {"id": "c", "type": "expense", "timestamp": "2026-10-02T09:00:00+00:00", "amount": 11.0},
+]
+
+
+@pytest.mark.parametrize("offset", [0, 2, -5])
+def test_window_accepts_aware_bounds(offset):
+    frame = _frame(ROWS)
+    tz = timezone(timedelta(hours=offset))
+    # 13:00 UTC expressed in another offset: the same instant splits a/b either way
+    start = datetime(2026, 10, 1, 13, tzinfo=timezone.utc).astimezone(tz)
+    end = datetime(2026, 10, 2, 9, tzinfo=timezone.utc).astimezone(tz)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        window = frame.window(start, end)
+    assert list(window["id"]) == ["b"]
+
+
+def test_aware_and_naive_local_bounds_agree():
+    frame = _frame(ROWS)
+    aware = datetime(2026, 10, 1, 13, tzinfo=timezone.utc)
+    naive_local = datetime.fromtimestamp(aware.timestamp())
+    assert list(frame.window(aware)["id"]) == list(frame.window(naive_local)["id"]) == ["b", "c"]
+
+
+def test_rolling_daily_with_aware_range():
+    frame = _frame(ROWS)
+    start = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        series = analytics.rolling_daily(frame, start, start + timedelta(days=2), window=1)
+    assert sum(point["total"] for point in series) == pytest.approx(23.0)
+
+
+def test_category_average_spans_period_files():
+    user_id = f"avg-{uuid4().hex[:8]}"
+    now = datetime.now()
+    last_month = (now.replace(day=1) - timedelta(days=1)).replace(day=10, hour=12)
+    previous = server.load_user_state(user_id, period=f"{last_month.year}_{last_month.month:02d}")
+    server._add_expense(previous, 60.0, "Weekly shop", "groceries", timestamp=last_month.isoformat())
+    server.save_user_state(previous)
+    current = server.load_user_state(user_id)
+    server._add_expense(current, 30.0, "Weekly shop", "groceries")
+    server.save_user_state(current)
+
+    response = TestClient(server.app).get("/api/category_analysis/groceries", headers={"X-User-ID": user_id})
+    assert response.status_code == 200
+    assert response.json()["avg_recent"] == 45.0
+    # without analytics only the current period file is read
+    assert server._build_category_analysis(server.load_user_state(user_id), "groceries")["avg_recent"] == 30.0
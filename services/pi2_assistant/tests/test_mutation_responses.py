@@ -0,0 +1,66 @@
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import pi2_server as server
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.app)
+
+
+@pytest.fixture
+def user_id():
+    return f"mut-{uuid4().hex[:8]}"
+
+
+def _stored(client, user_id):
+    response = client.get("/api/state", headers={"X-User-ID": user_id})
+    assert response.status_code == 200
+    return response.json()["revision"], response.headers["etag"]
+
+
+def test_echoed_revision_and_etag_match_stored_state(client, user_id):
+    response = client.post("/api/set_budget", json={"user_id": user_id, "budget": 1800})
+    assert response.status_code == 200
+    assert (response.json()["revision"], response.headers["etag"]) == _stored(client, user_id)
+
+    response = client.post("/api/add_expense", json={"user_id": user_id, "amount": 9.5, "description": "Lunch"})
+    assert response.status_code == 200
+    echoed = response.json()["state"]["revision"]
+    revision, etag = _stored(client, user_id)
+    assert echoed == revision
+    assert response.headers["etag"] == etag
+
+    expense_id = response.json()["expense"]["id"]
+    response = client.delete(f"/api/expenses/{expense_id}", params={"user_id": user_id})
+    assert response.status_code == 200
+    assert response.json()["state"]["revision"] == revision + 1
+    assert response.headers["etag"] == _stored(client, user_id)[1]
+
+
+def test_mutation_etag_revalidates(client, user_id):
+    response = client.post("/api/add_income", json={"user_id": user_id, "amount": 1200, "source": "Salary"})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    cached = client.get("/api/state", headers={"X-User-ID": user_id, "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    client.post("/api/add_income", json={"user_id": user_id, "amount": 50, "source": "Refund"})
+    stale = client.get("/api/state", headers={"X-User-ID": user_id, "If-None-Match": etag})
+    assert stale.status_code == 200
+
+
+def test_minimal_response_carries_etag(client, user_id):
+    response = client.post(
+        "/api/add_expense",
+        json={"user_id": user_id, "amount": 3.0, "description": "Gum"},
+        headers={"Prefer": "return=minimal"},
+    )
+    assert response.status_code == 200
+    assert "state" not in response.json()
+    assert response.headers["preference-applied"] == "return=minimal"
+    assert response.headers["etag"] == _stored(client, user_id)[1]
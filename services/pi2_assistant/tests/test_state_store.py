@@ -0,0 +1,225 @@
+import copy
+import json
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import pi2_server as server
+import state_store
+from state_store import JournaledJsonStateBackend, JsonStateBackend, SqliteStateBackend
+
+PERIOD = "2026_10"
+
+
+def sample_state():
+    return {
+        "user_id": "alice",
+        "period": PERIOD,
+        "revision": 3,
+        "budget": 2000.0,
+        "history": [
+            {"id": "e2", "type": "expense", "timestamp": "2026-10-03T09:00:00", "amount": 12.5, "category": "food_dining", "merchant": "Cafe"},
+            {"id": "e1", "type": "expense", "timestamp": "2026-10-01T18:30:00", "amount": 80.0, "category": "groceries", "merchant": "Costco"},
+        ],
+        "incomes": [{"id": "i1", "timestamp": "2026-10-01T08:00:00", "amount": 1500.0, "source": "Salary"}],
+        "goals": [{"id": "g1", "name": "Trip", "target": 900.0, "status": "active"}],
+        "category_budgets": {"groceries": 400.0, "food_dining": 150.0},
+        "merchant_rules": {"costco": "groceries"},
+    }
+
+
+def apply_changes(state):
+    """Mutate ``state`` the way the server does and return the matching change set."""
+    new = {"id": "e3", "type": "expense", "timestamp": "2026-10-04T12:00:00", "amount": 7.25, "category": "fuel", "merchant": "Shell"}
+    state["history"].insert(0, new)
+    state["history"][2]["amount"] = 82.0
+    state["incomes"] = []
+    state["goals"].append({"id": "g2", "name": "Laptop", "target": 1200.0, "status": "active"})
+    state["category_budgets"]["fuel"] = 90.0
+    state["merchant_rules"] = {"shell": "fuel"}
+    state["revision"] = 4
+    return [
+        {"op": "upsert", "coll": "history", "row": new, "index": 0},
+        {"op": "upsert", "coll": "history", "row": state["history"][2]},
+        {"op": "delete", "coll": "incomes", "id": "i1"},
+        {"op": "upsert", "coll": "goals", "row": state["goals"][-1]},
+        {"op": "put", "coll": "category_budgets", "key": "fuel"},
+        {"op": "replace", "coll": "merchant_rules"},
+    ]
+
+
+def test_sqlite_round_trip(tmp_path):
+    db = tmp_path / "states.db"
+    state = sample_state()
+    backend = SqliteStateBackend(db)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    assert SqliteStateBackend(db).load("alice", PERIOD) == state
+
+    changes = apply_changes(state)
+    backend.save("alice", PERIOD, copy.deepcopy(state), changes)
+    reopened = SqliteStateBackend(db)
+    assert reopened.load("alice", PERIOD) == state
+    assert reopened.list_periods("alice") == [PERIOD]
+
+
+def write_legacy(states_dir, user_id, period, state):
+    JsonStateBackend(states_dir).save(user_id, period, state)
+
+
+def test_sqlite_imports_legacy_files(tmp_path):
+    legacy = tmp_path / "states"
+    legacy.mkdir()
+    september = dict(sample_state(), period="2026_09")
+    write_legacy(legacy, "alice", "2026_09", september)
+    write_legacy(legacy, "alice", PERIOD, sample_state())
+
+    backend = SqliteStateBackend(tmp_path / "states.db", import_dir=legacy)
+    assert backend.list_users() == ["alice"]
+    assert backend.list_periods("alice") == ["2026_09", PERIOD]
+    assert backend.load("alice", "2026_09") == september
+
+    # imported rows live in the database now; the files are no longer read
+    (legacy / f"alice_{PERIOD}.json").write_text(json.dumps({"user_id": "alice"}), encoding="utf-8")
+    assert SqliteStateBackend(tmp_path / "states.db", import_dir=legacy).load("alice", PERIOD) == sample_state()
+
+
+def test_sqlite_retries_failed_import(tmp_path, monkeypatch):
+    legacy = tmp_path / "states"
+    legacy.mkdir()
+    write_legacy(legacy, "alice", "2026_09", dict(sample_state(), period="2026_09"))
+    write_legacy(legacy, "alice", PERIOD, sample_state())
+
+    original_load = JsonStateBackend.load
+    calls = []
+
+    def flaky_load(self, user_id, period):
+        calls.append(period)
+        if period == PERIOD and calls.count(PERIOD) == 1:
+            raise OSError("disk hiccup")
+        return original_load(self, user_id, period)
+
+    monkeypatch.setattr(state_store.JsonStateBackend, "load", flaky_load)
+    backend = SqliteStateBackend(tmp_path / "states.db", import_dir=legacy)
+    with pytest.raises(OSError):
+        backend.load("alice", PERIOD)
+
+    # the period that failed is picked up on the next access; the one already
+    # committed is not imported twice
+    assert backend.load("alice", PERIOD) == sample_state()
+    assert calls == ["2026_09", PERIOD, PERIOD]
+    assert backend.list_periods("alice") == ["2026_09", PERIOD]
+
+
+def journaled(states_dir, **options):
+    return JournaledJsonStateBackend(states_dir, volatile_keys=("cached_total",), fsync=False, **options)
+
+
+def test_journal_round_trip(tmp_path):
+    state = sample_state()
+    backend = journaled(tmp_path)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    state["cached_total"] = 92.5
+    changes = apply_changes(state)
+    backend.save("alice", PERIOD, copy.deepcopy(state), changes)
+    assert backend.journal_path("alice", PERIOD).exists()
+
+    loaded = journaled(tmp_path).load("alice", PERIOD)
+    del state["cached_total"]
+    assert {k: v for k, v in loaded.items() if k != "cached_total"} == state
+    assert loaded["revision"] == 4
+
+
+def test_journal_replay_after_compaction(tmp_path):
+    state = sample_state()
+    backend = journaled(tmp_path)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    changes = apply_changes(state)
+    backend.save("alice", PERIOD, copy.deepcopy(state), changes)
+
+    assert backend.compact("alice", PERIOD)
+    assert not backend.journal_path("alice", PERIOD).exists()
+    assert json.loads(backend.path_for("alice", PERIOD).read_text(encoding="utf-8")) == state
+
+    # later appends replay over the compacted snapshot
+    state["history"].pop()
+    state["revision"] = 5
+    backend.save("alice", PERIOD, copy.deepcopy(state), [{"op": "delete", "coll": "history", "id": "e1"}])
+    assert journaled(tmp_path).load("alice", PERIOD) == state
+
+
+def test_compaction_keeps_appends_made_meanwhile(tmp_path, monkeypatch):
+    state = sample_state()
+    backend = journaled(tmp_path)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    changes = apply_changes(state)
+    backend.save("alice", PERIOD, copy.deepcopy(state), changes)
+
+    replay = state_store._replay_journal
+    late = {"id": "e4", "type": "expense", "timestamp": "2026-10-05T10:00:00", "amount": 3.0, "category": "fuel", "merchant": "Shell"}
+
+    def append_while_compacting(target, records):
+        replay(target, records)
+        monkeypatch.setattr(state_store, "_replay_journal", replay)
+        state["history"].insert(0, late)
+        backend.save("alice", PERIOD, copy.deepcopy(state), [{"op": "upsert", "coll": "history", "row": late, "index": 0}])
+
+    monkeypatch.setattr(state_store, "_replay_journal", append_while_compacting)
+    assert backend.compact("alice", PERIOD)
+    assert backend.journal_path("alice", PERIOD).read_text(encoding="utf-8").count("\n") == 1
+    assert journaled(tmp_path).load("alice", PERIOD) == state
+
+
+def test_compaction_yields_to_a_full_save(tmp_path, monkeypatch):
+    state = sample_state()
+    backend = journaled(tmp_path)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    changes = apply_changes(state)
+    backend.save("alice", PERIOD, copy.deepcopy(state), changes)
+
+    replay = state_store._replay_journal
+    rewritten = dict(sample_state(), budget=2500.0, revision=9)
+
+    def full_save_while_compacting(target, records):
+        replay(target, records)
+        monkeypatch.setattr(state_store, "_replay_journal", replay)
+        backend.save("alice", PERIOD, copy.deepcopy(rewritten))
+
+    monkeypatch.setattr(state_store, "_replay_journal", full_save_while_compacting)
+    # the generation moved on, so the stale compacted snapshot is discarded
+    assert not backend.compact("alice", PERIOD)
+    assert not list(tmp_path.glob("*.compact"))
+    assert journaled(tmp_path).load("alice", PERIOD) == rewritten
+
+
+def test_journal_skips_field_changes(tmp_path):
+    state = sample_state()
+    backend = journaled(tmp_path)
+    backend.save("alice", PERIOD, copy.deepcopy(state))
+    state["budget"] = 2400.0
+    backend.save("alice", PERIOD, copy.deepcopy(state), [{"op": "field", "coll": "budget"}])
+
+    lines = backend.journal_path("alice", PERIOD).read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == [{"op": "set", "key": "budget", "value": 2400.0}]
+    assert journaled(tmp_path).load("alice", PERIOD) == state
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/api/set_budget", {"budget": 1750}),
+    ("/api/set_budget_mode", {"mode": "strict"}),
+    ("/api/set_subcategory_budget_v2", {"category": "food_dining", "subcategory": "coffee", "monthly_budget": 40}),
+    ("/api/activate_icon", {"category_id": "fuel"}),
+    ("/api/batch", {"operations": [{"op": "set_budget", "data": {"budget": 1900}}]}),
+])
+def test_budget_endpoints_save_change_sets(path, body, monkeypatch):
+    client = TestClient(server.app)
+    user_id = f"chg-{uuid4().hex[:8]}"
+    # the first save of a period is always a full write
+    assert client.post("/api/set_category_budget", json={"user_id": user_id, "category_id": "groceries", "budget": 300}).status_code == 200
+
+    saved = []
+    original_save = server.STATE_BACKEND.save
+    monkeypatch.setattr(server.STATE_BACKEND, "save", lambda *args: saved.append(args[3]) or original_save(*args))
+    assert client.post(path, json={"user_id": user_id, **body}).status_code == 200
+    assert len(saved) == 1 and saved[0] is not None
+    assert saved[0][-1]["op"] == "field"
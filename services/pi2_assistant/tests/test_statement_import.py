@@ -0,0 +1,156 @@
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import pi2_server as server
+from statement_import import ImportRow, RowError, parse_amount, parse_statement
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def parse(name, chunk_size=7, **kwargs):
+    """Parse a fixture fed in small chunks, so rows and characters straddle chunk edges."""
+    data = (FIXTURES / name).read_bytes()
+
+    async def chunks():
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    async def collect():
+        return [result async for result in parse_statement(chunks(), **kwargs)]
+
+    return asyncio.run(collect())
+
+
+def rows(results):
+    return [r for r in results if isinstance(r, ImportRow)]
+
+
+def test_quoted_field_spanning_lines():
+    results = parse("statement_multiline.csv")
+    market = rows(results)[0]
+    assert market.description == "Farmers market\nstall 12, cash"
+    assert market.amount == -23.50
+    assert market.category == "Groceries"
+    assert market.line == 2
+    # the record after the two-line field keeps its physical line number
+    assert rows(results)[1].line == 4
+
+
+def test_bad_rows_are_reported_not_fatal():
+    results = parse("statement_multiline.csv")
+    errors = [r for r in results if isinstance(r, RowError)]
+    assert [e.line for e in errors] == [7]
+    assert "Invalid date" in str(errors[0])
+    assert len(rows(results)) == 4
+
+
+def test_identical_rows_get_distinct_import_ids():
+    coffee = [r for r in rows(parse("statement_multiline.csv")) if r.description == "Coffee"]
+    assert len(coffee) == 2
+    assert coffee[0].import_id.startswith("sha1:")
+    assert coffee[1].import_id == coffee[0].import_id + "#1"
+
+
+def test_dayfirst():
+    monthfirst = [r.timestamp for r in rows(parse("statement_dayfirst.csv"))]
+    dayfirst = [r.timestamp for r in rows(parse("statement_dayfirst.csv", dayfirst=True))]
+    assert monthfirst == [datetime(2026, 3, 9), datetime(2026, 12, 9)]
+    assert dayfirst == [datetime(2026, 9, 3), datetime(2026, 9, 12)]
+
+
+def test_signed_amounts_expenses_negative():
+    parsed = rows(parse("statement_multiline.csv"))
+    assert [r.amount for r in parsed] == [-23.50, 2500.00, -4.25, -4.25]
+
+
+def test_expenses_positive_flips_signs():
+    plain = [r.amount for r in rows(parse("statement_dayfirst.csv", dayfirst=True))]
+    flipped = [r.amount for r in rows(parse("statement_dayfirst.csv", dayfirst=True, expenses_positive=True))]
+    assert plain == [4.50, -20.00]
+    assert flipped == [-4.50, 20.00]
+
+
+def test_debit_credit_columns():
+    parsed = rows(parse("statement_debit_credit.csv"))
+    assert [(r.amount, r.merchant) for r in parsed] == [(-120.00, "Hydro"), (15.00, "Refund")]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,234.56", 1234.56),
+    ("(12.30)", -12.30),
+    ("12.30-", -12.30),
+    ("$ -5", -5.0),
+    ("1.234,56", 1234.56),
+])
+def test_parse_amount(text, expected):
+    assert parse_amount(text) == expected
+
+
+@pytest.mark.parametrize("name", ["statement_sgml.ofx", "statement_xml.ofx"])
+def test_ofx(name):
+    results = parse(name)
+    assert not [r for r in results if isinstance(r, RowError)]
+    fuel, transfer = rows(results)
+    assert (fuel.timestamp, fuel.amount, fuel.description, fuel.merchant) == (datetime(2026, 9, 5, 12), -42.10, "Fuel", "SHELL STATION")
+    assert fuel.import_id == "fitid:20260905001"
+    assert (transfer.timestamp, transfer.amount, transfer.description) == (datetime(2026, 9, 6), 100.00, "TRANSFER IN")
+
+
+def test_sgml_and_xml_ofx_agree():
+    def key(r):
+        return r.timestamp, r.amount, r.description, r.merchant, r.import_id
+
+    assert [key(r) for r in rows(parse("statement_sgml.ofx"))] == [key(r) for r in rows(parse("statement_xml.ofx"))]
+
+
+@pytest.mark.parametrize("name, fmt", [
+    ("statement_multiline.csv", None),
+    ("statement_sgml.ofx", None),
+    ("statement_xml.ofx", "ofx"),
+])
+def test_reimport_skips_duplicates(name, fmt):
+    client = TestClient(server.app)
+    user_id = f"imp-{uuid4().hex[:8]}"
+    body = (FIXTURES / name).read_bytes()
+    params = {"user_id": user_id, **({"format": fmt} if fmt else {})}
+
+    first = client.post("/api/import", params=params, content=body)
+    assert first.status_code == 200
+    report = first.json()
+    imported = report["imported"]["expenses"] + report["imported"]["incomes"]
+    assert imported == len(rows(parse(name)))
+    assert report["duplicates"] == 0
+
+    second = client.post("/api/import", params=params, content=body)
+    assert second.status_code == 200
+    again = second.json()
+    assert again["imported"] == {"expenses": 0, "incomes": 0}
+    assert again["duplicates"] == imported
+
+
+def test_import_commits_each_batch(monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_BATCH", 3)
+    client = TestClient(server.app)
+    user_id = f"imp-{uuid4().hex[:8]}"
+    body = (FIXTURES / "statement_multiline.csv").read_bytes()
+
+    saved = []
+    original_save = server.STATE_BACKEND.save
+    monkeypatch.setattr(server.STATE_BACKEND, "save", lambda *args: saved.append(args[3]) or original_save(*args))
+
+    report = client.post("/api/import", params={"user_id": user_id}, content=body).json()
+    # four rows in one period: a batch of three, then one, each saved on its own
+    assert report["imported"] == {"expenses": 3, "incomes": 1}
+    assert len(saved) == 2
+    assert [c["row"]["import_id"] for c in saved[1] if c["op"] == "upsert"] == [rows(parse("statement_multiline.csv"))[-1].import_id]
+
+    saved.clear()
+    again = client.post("/api/import", params={"user_id": user_id}, content=body).json()
+    assert again["duplicates"] == 4
+    # duplicate-only batches save an empty change set rather than the whole state
+    assert saved == [[], []]